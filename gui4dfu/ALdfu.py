@@ -4,11 +4,16 @@
 Simplified firmware upgrader script for the Astera Taurus and Taurus1 devices.
 """
 import argparse
+import atexit
 import datetime
 import logging
 import os
 import sys
 
+import firmware_async
+import firmware_bus
+import firmware_prevalidate
+import firmware_shared
 import firmware_upgrader
 from module_info import *
 
@@ -62,6 +67,34 @@ def create_logger(log_port):
     return logger
 
 
+def switch_dev_file(port):
+    """
+    Returns the EEPROM device file of a switch port, or None if the switch
+    has no such port
+    """
+    dev_file_cs8000 = "/sys/devices/platform/soc/fd8be100.spi_aux/spi_master/spi1/spi1.0/i2c-34/i2c-" + str(
+        __eeprom_map_cs8000[port]) + "/" + str(__eeprom_map_cs8000[port]) + "-0050/eeprom"
+    dev_file_cs8260 = "/sys/devices/platform/soc/fd820000.pcie-external1/pci0002:00/0002:00:00.0/0002:01:00.0/i2c-" + str(
+        __eeprom_map_cs8260[port]) + "/" + str(__eeprom_map_cs8260[port]) + "-0050/eeprom"
+    if (os.path.isfile(dev_file_cs8000)):
+        return dev_file_cs8000
+    elif (os.path.isfile(dev_file_cs8260)):
+        return dev_file_cs8260
+
+    return None
+
+
+def configure_upgrader(upgrader, args):
+    """
+    Apply the command line settings to an upgrader
+    """
+    #  targets whose erased (0xFF) data isn't sent after the 0101 erase
+    upgrader.sparse_targets = tuple(firmware_upgrader.Header.MAP_TARGET_DEVICE_ARG[target]
+                                    for target in args.sparse.split(",") if target)
+    #  reuse the precomputed frames of earlier DFUs of the same image
+    upgrader.plan_dir = args.plan_dir
+
+
 def print_version(upgrader):
     """
     Prints version information for all components
@@ -104,22 +137,42 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Script to perform a DFU on the MCU, MSA, or DSP (or multiple components)')
     parser.add_argument('-device', '-d', action='store', help='I2C Device: switch, arduino, aardvark, linux')
-    parser.add_argument('-port', '-p', action='store', help='Switch port or serial port number')
+    parser.add_argument('-port', '-p', action='store',
+                        help='Switch port or serial port number, comma separated switch ports are upgraded together')
     parser.add_argument('-component', '-c', action='store', default='MCU',
                         help='Component to upgrade: MCU, MSA, DSP, SUP, ALL')
     parser.add_argument('-binary', '-b', action='store', default=None,
-                        help='Path to binary or folder containing DFU binary')
+                        help='Path to binary, folder containing DFU binary, or firmware bundle')
     parser.add_argument('-version', '-v', action='store_true', default=None,
                         help='Report version number for currently active firmware image')
     parser.add_argument('-switch', '-s', action='store_true', default=None,
                         help='Switch to the slot not currently in use (MCU and MSA only)')
+    parser.add_argument('-converge', '-u', action='store_true', default=False,
+                        help='Only upgrade components not already running the binary version')
+    parser.add_argument('-page_tracking', '-t', action='store_true', default=False,
+                        help='Skip redundant page-select writes (driver must accept page=None)')
+    parser.add_argument('-sparse', action='store', default='',
+                        help='Comma separated image targets (stm32, taurus, taurus1) to skip erased 0xFF data for')
+    parser.add_argument('-plan_dir', action='store', default=None,
+                        help='Folder to store and reuse precomputed DFU plans in')
+    parser.add_argument('-shared_images', action='store_true', default=False,
+                        help='Share the firmware images with the other ALdfu processes through shared memory')
+    parser.add_argument('-transfer_slots', type=int, default=None,
+                        help='Ports per bus segment that may transfer images at the same time (several -port)')
+    parser.add_argument('-make_bundle', action='store', default=None,
+                        help='Write the images of the -binary folder to this firmware bundle and exit')
     args = parser.parse_args()
 
+    if args.make_bundle:
+        firmware_upgrader.FirmwareBundle.create(args.make_bundle, args.binary or DFU_BIN_PATH)
+        sys.exit(0)
+
     #  2023-Aug-14: CHL
     #  Adding max_chunk as a param, default 64
     max_chunk = 64
     log_port = ""
     rc = 0
+    ports = None
     if args.device == "arduino":
         import i2c_driver_arduino as i2c_driver
 
@@ -139,15 +192,8 @@ if __name__ == "__main__":
             raise Exception("Error: No port specified.")
         import i2c_driver_switch as i2c_driver
 
-        port = int(args.port)
-        dev_file_cs8000 = "/sys/devices/platform/soc/fd8be100.spi_aux/spi_master/spi1/spi1.0/i2c-34/i2c-" + str(
-            __eeprom_map_cs8000[port]) + "/" + str(__eeprom_map_cs8000[port]) + "-0050/eeprom"
-        dev_file_cs8260 = "/sys/devices/platform/soc/fd820000.pcie-external1/pci0002:00/0002:00:00.0/0002:01:00.0/i2c-" + str(
-            __eeprom_map_cs8260[port]) + "/" + str(__eeprom_map_cs8260[port]) + "-0050/eeprom"
-        if (os.path.isfile(dev_file_cs8000)):
-            dev_file = dev_file_cs8000
-        elif (os.path.isfile(dev_file_cs8260)):
-            dev_file = dev_file_cs8260
+        ports = [int(port) for port in args.port.split(",")]
+        dev_file = switch_dev_file(ports[0])
     else:
         logger.error("No driver found for {}.".format(args.device))
         sys.exit(1)
@@ -156,20 +202,88 @@ if __name__ == "__main__":
     logger = create_logger(log_port)
     logger.info(f'Starting ALdfu: device {args.device}, dev_file {dev_file}, max_chunk {max_chunk}')
 
-    driver = i2c_driver.I2CDriver(device_filename=dev_file)
-
-    if args.device == "arduino":
-        logger.info("Controller FW version: {}".format(driver.get_driver_object().fw_version()))
-
     if not args.binary:
         upgrade_file = DFU_BIN_PATH
     else:
         upgrade_file = args.binary
 
     args.component = args.component.upper()
-    upgrader = firmware_upgrader.FirmwareUpgrader(driver_object=driver, component=args.component, logger=logger)
-    #  parameterized and passing max_chunk to the upgrader
-    upgrader.chunk_size = max_chunk
+
+    #  check the firmware images before touching the module, bundled images
+    #  are checked when the upgrader opens the bundle
+    if not args.version and not args.switch and os.path.exists(upgrade_file) \
+            and not firmware_upgrader.FirmwareBundle.is_bundle(upgrade_file):
+        results = firmware_prevalidate.prevalidate(upgrade_file, logger=logger)
+        components = firmware_upgrader.FirmwareUpgrader.GROUP_COMPONENTS.get(args.component, [args.component])
+        rejected = firmware_prevalidate.rejected_candidates(upgrade_file, components, results)
+        if rejected:
+            for filename, error in rejected.items():
+                logger.error("Refusing firmware image {}: {}".format(filename, error))
+            sys.exit(1)
+
+        #  one copy of each image in RAM for all ports of the station
+        if args.shared_images:
+            shared = firmware_shared.share_images(upgrade_file, components, logger=logger)
+            atexit.register(firmware_shared.release_images, shared)
+
+    #  several ports are upgraded by one asyncio event loop, not one thread each
+    if ports and len(ports) > 1:
+        if args.version or args.switch:
+            logger.error("-version and -switch take a single port.")
+            sys.exit(1)
+
+        #  ports on the same mux share the bus, their transactions are scheduled
+        #  per bus segment and batched per mux channel
+        dev_files = {port: switch_dev_file(port) for port in ports}
+        scheduler = firmware_bus.BusScheduler(firmware_bus.BusTopology.from_dev_files(dev_files))
+        #  only the transfers are limited, ports waiting for their module don't take a slot
+        phases = firmware_async.AsyncPhaseScheduler({"transfer": args.transfer_slots}, scheduler.topology)
+        for segment, segment_ports in scheduler.topology.segments().items():
+            logger.info(f'Bus segment {segment}: ports {segment_ports}')
+        #  one I/O thread per bus segment keeps every segment busy
+        firmware_async.AsyncFirmwareUpgrader.executor_workers = max(
+            firmware_async.AsyncFirmwareUpgrader.executor_workers, len(scheduler.topology.segments()))
+
+        upgraders = {}
+        for port in ports:
+            driver = firmware_bus.ScheduledDriver(i2c_driver.I2CDriver(device_filename=dev_files[port]), scheduler, port)
+            if args.page_tracking:
+                driver = firmware_upgrader.PageTrackingDriver(driver)
+            #  parameterized and passing max_chunk to the upgrader, the port keys the learned CDB timing
+            upgrader = firmware_async.AsyncFirmwareUpgrader(driver_object=driver, component=args.component,
+                                                            logger=logger.getChild(f'port{port}'),
+                                                            chunk_size=max_chunk, port=port, phases=phases)
+            configure_upgrader(upgrader, args)
+            upgraders[port] = upgrader
+
+        results = firmware_async.run_ports(upgraders, upgrade_file, verify=True, phases=phases,
+                                           skip_status_check=False, converge=args.converge)
+        logger.info(f'Bus scheduler: {scheduler.stats}')
+        for stage, stats in phases.stats.items():
+            logger.info(f'Stage {stage}: {stats["count"]} times, {stats["queued"]:.1f}s queued, {stats["busy"]:.1f}s busy')
+        for port, result in sorted(results.items()):
+            if isinstance(result, firmware_upgrader.FirmwareUpgraderException):
+                logger.error(f'Port {port}: {result.get_message()}')
+                rc = 1
+            elif isinstance(result, BaseException):
+                logger.error(f'Port {port}: {result}')
+                rc = 1
+            else:
+                logger.info(f'Port {port}: upgraded')
+
+        sys.exit(rc)
+
+    driver = i2c_driver.I2CDriver(device_filename=dev_file)
+    if args.page_tracking:
+        driver = firmware_upgrader.PageTrackingDriver(driver)
+
+    if args.device == "arduino":
+        logger.info("Controller FW version: {}".format(driver.get_driver_object().fw_version()))
+
+    #  parameterized and passing max_chunk to the upgrader, the port keys the learned CDB timing
+    upgrader = firmware_upgrader.FirmwareUpgrader(driver_object=driver, component=args.component, logger=logger,
+                                                  chunk_size=max_chunk, port=args.port)
+    configure_upgrader(upgrader, args)
 
     print_version(upgrader)
     rc = 0
@@ -182,7 +296,8 @@ if __name__ == "__main__":
         print_version(upgrader)
     else:
         try:
-            fw_info_dict = upgrader.upgrade_firmware(upgrade_file, verify=True, skip_status_check=False)
+            fw_info_dict = upgrader.upgrade_firmware(upgrade_file, verify=True, skip_status_check=False,
+                                                     converge=args.converge)
         except firmware_upgrader.FirmwareUpgraderException as err:
             logger.error("FirmwareUpgraderException occurred!")
             logger.info(err.get_message())
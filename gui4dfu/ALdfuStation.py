@@ -0,0 +1,389 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+DFU station for the Astera Taurus and Taurus1 devices.
+
+Runs the firmware upgrade of any number of station slots with one code path.
+A port map gives the I2C port of every slot.  The slots are paired into
+cables: the T1 end of cable N is in slot 2N-1 and the T2 end in slot 2N.  The
+T1 end waits for its T2 end and reports the result of the cable to MES.
+
+All slots run in one process, so they share the firmware image cache of the
+upgrader, and their results are collected in a TestMonitor.CableMonitor that
+wakes the T1 end as soon as its T2 end finished.  At most max_concurrent
+slots transfer images at the same time, the slots that only wait for their
+module (erase, restart, retimer) don't count.
+"""
+import argparse
+import datetime
+import os
+from pathlib import Path
+import sys
+import time
+import traceback
+import uuid
+
+import pymssql
+from PyQt5.QtCore import *
+
+import DbProvider as DB
+import TestMonitor
+import firmware_prevalidate
+import firmware_upgrader
+from MesTest import MesPostResult
+from module_info import *
+
+# Station slot -> I2C port of the UTB
+PORT_MAP = {1: 3, 2: 4, 3: 5, 4: 6}
+
+
+class UDPThread(QThread):
+    ResultEvent = pyqtSignal(int, str)
+
+    def __init__(self, *args, **kwargs):
+        super(UDPThread, self).__init__()
+        self.station = kwargs.get('station')
+        self.slot = kwargs.get('slot')
+        self.SN = kwargs.get('SN')
+        self.Logger = kwargs.get('logger')
+        self.form = kwargs.get('form')
+        self.ResultEvent.connect(self.form.ChResultShow)
+        self.start_date_time = kwargs.get('start_date_time')
+        self.time_string = kwargs.get('time_string')
+
+    def run(self):
+        result = self.station.upgrade_slot(self.slot, self.SN, self.Logger, self.start_date_time, self.time_string)
+        if (result == True):
+            ret = 'OK'
+        else:
+            ret = 'NG'
+        print('UDPThreadResult' + ret)
+        self.ResultEvent.emit(self.slot, ret)
+
+
+class DfuStation(object):
+    """
+    Upgrades the modules in the slots of a station.
+    """
+    # Seconds the T1 end of a cable waits for its T2 end before it reports
+    # the cable as failed
+    partner_timeout = 30 * 60
+
+    def __init__(self, port_map=None, max_concurrent=None, **kwargs):
+        """
+        Constructor.
+
+        Args:
+            port_map: dict: Station slot -> I2C port, defaults to PORT_MAP
+            max_concurrent: int: Number of slots that may transfer images at
+                the same time, defaults to all of them
+            kwargs: Defaults for the ALdfu arguments (device, component,
+                binary, converge)
+        """
+        self.port_map = dict(port_map or PORT_MAP)
+        self.max_concurrent = max_concurrent or len(self.port_map)
+        self.defaults = kwargs
+        self.phases = firmware_upgrader.PhaseScheduler({"transfer": self.max_concurrent})
+        self.monitor = TestMonitor.CableMonitor(self.cables())
+
+    def slots(self):
+        """
+        Returns the station slots in order.
+        """
+        return sorted(self.port_map)
+
+    def cables(self):
+        """
+        Returns the (T1 slot, T2 slot) pairs of the station.
+        """
+        slots = self.slots()
+        return [(slot, slot + 1) for slot in slots if slot % 2 and slot + 1 in self.port_map]
+
+    def partner(self, slot):
+        """
+        Returns the slot of the other end of the cable in a slot.
+        """
+        return slot + 1 if slot % 2 else slot - 1
+
+    def wait_partner(self, slot, logger):
+        """
+        Wait until the DFU of the other end of the cable in a slot finished.
+        A cable without a second slot in the port map doesn't wait.
+        """
+        if not self.monitor.wait(slot, self.partner_timeout):
+            logger.info(f'CH{self.partner(slot)} did not finish within {self.partner_timeout}s')
+
+    def reset(self):
+        """
+        Forget the results of the previous run.
+        """
+        self.monitor.reset()
+
+    def upgrade_slot(self, slot, SN, Logger, start_date_time, time_string):
+        """
+        Upgrade the module in a slot and report the result.  The T1 end of a
+        cable reports the cable to MES once its T2 end finished.  Returns True
+        if the slot passed.
+
+        Args:
+            slot: int: Station slot
+            SN: string: Serial number of the module in the slot
+            Logger: Logger: Log of the slot
+            start_date_time: datetime: Start of the run
+            time_string: string: Start of the run for the log file name
+        """
+        test_id = uuid.uuid4()
+        logger = Logger
+        sn = SN
+        partner = self.partner(slot)
+        t1 = bool(slot % 2)
+
+        try:
+            self.upgrade(self.port_map[slot], logger)
+        except ImportError:
+            traceback.print_exc()
+            self.monitor.finish(slot, False)
+            return False
+        except:
+            logger.info(traceback.format_exc())
+            if not t1:
+                upload_result_to_database(sn, logger, 'NG', start_date_time, test_id)
+                upload_log_to_database(sn, logger, test_id, time_string)
+                self.monitor.finish(slot, False)
+                return False
+
+            self.monitor.finish(slot, False)
+            self.wait_partner(slot, logger)
+            logger.info(f'CH{slot} Module Upgrade NG')
+            if not self.monitor.claim_report(slot):
+                return False
+            # Mes Communicate
+            # Mes Fail
+            if (upload_result_to_database(sn, logger, 'NG', start_date_time, test_id) != True):
+                return False
+            if (MesPostResult(DB.DbProvider.Mes.operationId, sn.split('_')[0], DB.DbProvider.Mes.userid, "FAIL",
+                              DB.DbProvider.Mes.host_postresult) != True):
+                sn_info = sn.split('_')[0]
+                logger.info(f'SN:{sn_info},Mes Post Result fail,Check the net connection and Restart')
+                return False
+            logger.info(f'Ch{slot}&{partner}:Report to Mes Result = Fail')
+            upload_log_to_database(sn, logger, test_id, time_string)
+            return False
+
+        logger.info(f'CH{slot} Module Upgrade OK')
+        if not t1:
+            if (upload_result_to_database(sn, logger, 'OK', start_date_time, test_id) != True):
+                self.monitor.finish(slot, False)
+                return False
+            if (upload_log_to_database(sn, logger, test_id, time_string) != True):
+                self.monitor.finish(slot, False)
+                return False
+            self.monitor.finish(slot, True)
+            return True
+
+        self.monitor.finish(slot, True)
+        self.wait_partner(slot, logger)
+        if not self.monitor.claim_report(slot):
+            return True
+        # Mes Communicate
+        if (upload_result_to_database(sn, logger, 'OK', start_date_time, test_id) != True):
+            return False
+        if self.monitor.result(slot):
+            # Mes Pass
+            if (MesPostResult(DB.DbProvider.Mes.operationId, sn.split('_')[0], DB.DbProvider.Mes.userid, "PASS",
+                              DB.DbProvider.Mes.host_postresult) != True):
+                sn_info = sn.split('_')[0]
+                logger.info(f'SN:{sn_info},Mes Post Result fail,Check the net connection and Restart')
+                return False
+        else:
+            # Mes Fail
+            if (MesPostResult(DB.DbProvider.Mes.operationId, sn.split('_')[0], DB.DbProvider.Mes.userid, "FAIL",
+                              DB.DbProvider.Mes.host_postresult) != True):
+                sn_info = sn.split('_')[0]
+                logger.info(f'SN:{sn_info},Mes Post Result fail,Check the net connection and Restart')
+                return False
+            logger.info(f'Ch{slot}&{partner}:Report to Mes Result = Fail')
+        if (upload_log_to_database(sn, logger, test_id, time_string) != True):
+            return False
+        return True
+
+    def upgrade(self, port, logger):
+        """
+        Upgrade the firmware of the module on a port.
+
+        Raises:
+            FirmwareUpgraderException: The upgrade failed
+        """
+        DFU_BIN_PATH = "binaries"
+        cur_file_loc = os.path.abspath(os.path.dirname(__file__))
+        sys.path.append(os.path.join(cur_file_loc, "../../"))
+        import ALSetPath
+        ALSetPath.set_path_common()
+        parser = argparse.ArgumentParser(
+            description='Script to perform a DFU on the MCU, MSA, or DSP (or multiple components)')
+        parser.add_argument('-device', '-d', action='store', default=self.defaults.get('device', 'linux'),
+                            help='I2C Device: switch, arduino, aardvark, linux')
+        parser.add_argument('-port', '-p', action='store', default=port,
+                            help='Switch port or serial port number')
+        parser.add_argument('-component', '-c', action='store', default=self.defaults.get('component', 'ALL'),
+                            help='Component to upgrade: MCU, MSA, DSP, SUP, ALL')
+        parser.add_argument('-binary', '-b', action='store',
+                            default=self.defaults.get('binary', 'firmware/EM200QDX.0.52.0'),
+                            help='Path to binary or folder containing DFU binary')
+        parser.add_argument('-version', '-v', action='store_true', default=None,
+                            help='Report version number for currently active firmware image')
+        parser.add_argument('-switch', '-s', action='store_true', default=None,
+                            help='Switch to the slot not currently in use (MCU and MSA only)')
+        parser.add_argument('-converge', '-u', action='store_true', default=self.defaults.get('converge', False),
+                            help='Only upgrade components not already running the binary version')
+        args = parser.parse_args()
+        args.port = port
+        max_chunk = 64
+        if args.device == "arduino":
+            import controller.i2c_driver_arduino as i2c_driver
+            dev_file = args.port
+        elif args.device == "aardvark":
+            import controller.i2c_driver_aardvark as i2c_driver
+            dev_file = args.port
+        elif args.device == "linux":
+            import controller.i2c_driver_linux as i2c_driver
+            dev_file = args.port
+            max_chunk = 32  # Linux SMBUS() caps at 32-bytes
+        else:
+            raise firmware_upgrader.FirmwareUpgraderException("No driver found for {}.".format(args.device))
+        driver = i2c_driver.I2CDriver(device_filename=dev_file)
+        modulesn = module_sn_info(driver=driver, logger=logger)
+        logger.info(f'Starting ALdfu: device {args.device}, dev_file {dev_file}, max_chunk {max_chunk}')
+
+        if args.device == "arduino":
+            logger.info("Controller FW version: {}".format(driver.get_driver_object().fw_version()))
+
+        if not args.binary:
+            upgrade_file = DFU_BIN_PATH
+        else:
+            upgrade_file = args.binary
+        pwd = os.path.dirname(os.path.realpath(__file__))
+        upgrade_file = f'{pwd}/{upgrade_file}'
+
+        args.component = args.component.upper()
+
+        #  wait for the check of the firmware images started with the GUI and
+        #  refuse invalid images, as ALdfu.py does
+        if not args.version and not args.switch and os.path.exists(upgrade_file) \
+                and not firmware_upgrader.FirmwareBundle.is_bundle(upgrade_file):
+            results = firmware_prevalidate.background_results(upgrade_file)
+            if results is None:
+                results = firmware_prevalidate.prevalidate(upgrade_file, logger=logger)
+            components = firmware_upgrader.FirmwareUpgrader.GROUP_COMPONENTS.get(args.component, [args.component])
+            rejected = firmware_prevalidate.rejected_candidates(upgrade_file, components, results)
+            if rejected:
+                for filename, error in rejected.items():
+                    logger.error("Refusing firmware image {}: {}".format(filename, error))
+                raise firmware_upgrader.FirmwareUpgraderException(
+                    "E004: Invalid firmware image: {}".format(", ".join(sorted(rejected))))
+
+        #  parameterized and passing max_chunk to the upgrader, the port keys the learned CDB timing
+        #  and the upgrade shares the transfer slots of the station from its first stage on
+        upgrader = firmware_upgrader.FirmwareUpgrader(driver_object=driver, component=args.component, logger=logger,
+                                                      chunk_size=max_chunk, port=args.port, phases=self.phases)
+
+        print_version(upgrader, logger)
+        if args.version:
+            # We already printed the version, so just exit
+            pass
+        elif args.switch:
+            upgrader.switch_slot(args.component)
+            upgrader.unlock_system()
+            print_version(upgrader, logger)
+        else:
+            try:
+                fw_info_dict = upgrader.upgrade_firmware(upgrade_file, verify=True, skip_status_check=False,
+                                                         converge=args.converge)
+            except firmware_upgrader.FirmwareUpgraderException as err:
+                logger.error("FirmwareUpgraderException occurred!")
+                logger.info(err.get_message())
+                logger.info(err.get_explanation())
+                raise
+            else:
+                print_version(upgrader, logger)
+
+        module_info(driver=driver, logger=logger)
+
+
+def print_version(upgrader, logger):
+    """
+    Prints version information for all components
+    """
+    # for component in ["MCU", "MSA", "DSP"]:
+    for component in upgrader.components:
+        version = upgrader.fw_info[component]["version"]
+        logger.info("###########################")
+        logger.info("Component: {}".format(component.upper()))
+        logger.info("Version: {}.{}.{}".format(version[0], version[1], (version[2] << 8) | version[3]))
+        active_slot = upgrader.get_active_image(component)
+        if active_slot:
+            logger.info("Slot: {}".format(active_slot))
+
+    logger.info("###########################")
+
+
+def read_file_as_binary(file_path):
+    try:
+        with open(file_path, 'rb') as file:
+            binary_data = file.read()
+        return binary_data
+    except Exception as e:
+        raise Exception(f"Failed to read file '{file_path}': {str(e)}")
+
+
+def upload_result_to_database(SN, logger, Result, start_date_time, test_id):
+    try:
+        conn = pymssql.connect(DB.DbProvider.Db.server, DB.DbProvider.Db.user, DB.DbProvider.Db.password,
+                               DB.DbProvider.Db.database)
+        cursor = conn.cursor()
+        result = Result
+        Date = datetime.datetime.now()
+        sqltask = f"INSERT INTO {DB.DbProvider.Db.resulttable} (Id, TestBeginTime, TestEndTime, TestUserId, SN, TestResult, TestItem, TestDetail) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+        cursor.execute(sqltask, (str(test_id), start_date_time, Date, 'TestUser', SN, result, 'DFU', 'Cable.Firmware.Version=0.52;'))
+        conn.commit()
+        time.sleep(2)
+        logger.info(f"{SN}:upload result to database success,test result:{Result}")
+        return True
+    except:
+        logger.info(f"{SN}:upload result to database fail,test result:{Result}")
+        return False
+
+
+def upload_log_to_database(sn, logger, test_id, time_string):
+    try:
+        # 连接到 SQL Server 数据库
+        conn = pymssql.connect(DB.DbProvider.Db.server, DB.DbProvider.Db.user, DB.DbProvider.Db.password,
+                               DB.DbProvider.Db.database)
+        cursor = conn.cursor()
+
+        # 获取当前时间
+        test_time = datetime.datetime.now()
+
+        # 读取日志文件并将其转换为二进制数据
+        logname = f'{sn}_DFU_{time_string}.log'
+        log_file_path = f'./DFU_LOGS.dir/{logname}'  # 替换为实际的文件路径
+        log_image = read_file_as_binary(log_file_path)
+
+        # 插入记录到数据库表
+        cursor.execute(
+            f"INSERT INTO {DB.DbProvider.Db.logtable} (Id, UTPTestID, SN, LogFileName, TestLog, TestTime) VALUES (%s, %s, %s, %s, %s, %s)",
+            (str(uuid.uuid4()), str(test_id), sn, logname, log_image, test_time))
+
+        # 提交更改并关闭连接
+        conn.commit()
+        conn.close()
+
+        Path(log_file_path).unlink()
+
+        logger.info("Log upload successful.")
+
+        return True
+
+    except Exception as e:
+        logger.info("Log upload failed: {}".format(e))
+        return False
@@ -168,9 +168,9 @@ if __name__ == "__main__":
         upgrade_file = args.binary
 
     args.component = args.component.upper()
-    upgrader = firmware_upgrader.FirmwareUpgrader(driver_object=driver, component=args.component, logger=logger)
     #  parameterized and passing max_chunk to the upgrader
-    upgrader.chunk_size = max_chunk
+    upgrader = firmware_upgrader.FirmwareUpgrader(driver_object=driver, component=args.component, logger=logger,
+                                                  chunk_size=max_chunk)
 
     print_version(upgrader)
     rc = 0
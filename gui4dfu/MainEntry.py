@@ -1,11 +1,13 @@
 #!/usr/bin/python3
 
+import multiprocessing
 import os.path
 import sys
 
 from PyQt5 import QtGui
 from PyQt5.QtWidgets import *
 
+import firmware_prevalidate
 from LoginView import *
 
 
@@ -22,6 +24,10 @@ class LoginView(QMainWindow, Ui_LoginForm):
 
 
 if __name__ == '__main__':
+    #  the firmware checks run in spawned worker processes, which start this
+    #  executable again when it is frozen by pyinstaller
+    multiprocessing.freeze_support()
+
     pwd = os.path.dirname(os.path.realpath(__file__))
 
     app = QApplication(sys.argv)
@@ -33,6 +39,10 @@ if __name__ == '__main__':
     app_icon.addFile(f'{pwd}/assets/Volex-Logo.ico', QtCore.QSize(256, 256))
     app.setWindowIcon(app_icon)
 
+    #  check the firmware images while the GUI starts, before any DFU runs
+    if os.path.isdir(f'{pwd}/firmware'):
+        firmware_prevalidate.prevalidate_in_background(f'{pwd}/firmware')
+
     main = MainView()
 
     main.show()
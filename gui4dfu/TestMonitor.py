@@ -1,9 +1,79 @@
-class TestAbout:
-    Ch1Finished = False
-    Ch2Finished = False
-    Ch3Finished = False
-    Ch4Finished = False
-    Ch1Result = False
-    Ch2Result = False
-    Ch3Result = False
-    Ch4Result = False
+import threading
+
+
+class CableMonitor(object):
+    """
+    Pairs the slots of a station into cables and tells the end of a cable
+    that reports it when the other ends finished.
+
+    A waiting end wakes as soon as the last other end finishes instead of
+    polling.  Each cable is reported once, by the end that claims it.
+    """
+
+    def __init__(self, cables):
+        """
+        Args:
+            cables: list: Slot tuples, one per cable, e.g. [(1, 2), (3, 4)]
+        """
+        self._cables = {}
+        for cable in cables:
+            for slot in cable:
+                self._cables[slot] = tuple(cable)
+        self._changed = threading.Condition()
+        self._results = {}
+        self._reported = set()
+
+    def reset(self):
+        """
+        Forget the results of the previous run.
+        """
+        with self._changed:
+            self._results = {}
+            self._reported = set()
+
+    def cable(self, slot):
+        """
+        Returns the slots of the cable of a slot.  A slot outside every
+        cable is a cable of its own.
+        """
+        return self._cables.get(slot, (slot,))
+
+    def finish(self, slot, result):
+        """
+        The DFU of a slot finished, wake the other ends of its cable.
+
+        Args:
+            slot: int: Station slot
+            result: bool: The slot passed
+        """
+        with self._changed:
+            self._results[slot] = result
+            self._changed.notify_all()
+
+    def wait(self, slot, timeout=None):
+        """
+        Wait until the other ends of the cable of a slot finished.  Returns
+        False if they didn't within timeout seconds.
+        """
+        others = [other for other in self.cable(slot) if other != slot]
+        with self._changed:
+            return self._changed.wait_for(lambda: all(other in self._results for other in others), timeout)
+
+    def result(self, slot):
+        """
+        Returns True if every end of the cable of a slot finished and passed.
+        """
+        with self._changed:
+            return all(self._results.get(other) == True for other in self.cable(slot))
+
+    def claim_report(self, slot):
+        """
+        Returns True the first time it is called for the cable of a slot,
+        the caller then reports the cable.
+        """
+        cable = self.cable(slot)
+        with self._changed:
+            if cable in self._reported:
+                return False
+            self._reported.add(cable)
+            return True
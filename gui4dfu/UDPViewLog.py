@@ -13,8 +13,7 @@ import os
 
 from PyQt5 import QtCore, QtWidgets
 
-from ALdfuCh1 import *
-from ALdfuCh2 import *
+from ALdfuStation import *
 from LogProvider import *
 
 
@@ -135,25 +134,21 @@ class Ui_Form(object):
         # time.sleep(0.1)
         # self.logger.info('start')
 
-        self.ProcessCh1 = UDPThread(SN='SN123', port=3, logger=self.logger, form=self)
-        self.ProcessCh2 = UDPThread2(SN='SN123', port=4, logger=self.logger, form=self)
-        self.ProcessCh1.start()
-        self.ProcessCh2.start()
+        start_date_time = datetime.datetime.now()
+        time_string = start_date_time.strftime("%Y%m%d_%H%M%S")
+        station = DfuStation({slot: PORT_MAP[slot] for slot in (1, 2)})
+        station.reset()
+        self.processes = [UDPThread(station=station, slot=slot, SN='SN123', logger=self.logger, form=self,
+                                    start_date_time=start_date_time, time_string=time_string)
+                          for slot in station.slots()]
+        for process in self.processes:
+            process.start()
 
     def LogWrite(self, logstring):
         self.LogTextEdit.append(logstring)
 
-    def Ch1ResultShow(self, Result):
-        self.Ch1Result.setText(Result)
-
-    def Ch2ResultShow(self, Result):
-        self.Ch2Result.setText(Result)
-
-    def Ch3ResultShow(self, Result):
-        self.Ch3Result.setText(Result)
-
-    def Ch4ResultShow(self, Result):
-        self.Ch4Result.setText(Result)
+    def ChResultShow(self, slot, Result):
+        getattr(self, f'Ch{slot}Result').setText(Result)
 
     def create_logger(self, LogTextEdit):
         """
@@ -3,10 +3,7 @@ import json
 
 from PyQt5 import QtCore, QtWidgets
 
-from ALdfuCh1 import *
-from ALdfuCh2 import *
-from ALdfuCh3 import *
-from ALdfuCh4 import *
+from ALdfuStation import *
 from LogProvider import *
 
 
@@ -22,6 +19,7 @@ class Ui_Form(object):
     def __init__(self):
         self.count = 0
         self.window = None
+        self.station = DfuStation(PORT_MAP)
 
     def setupUi(self, Window: QtWidgets.QMainWindow):
         self.window = Window
@@ -195,10 +193,7 @@ class Ui_Form(object):
         self.snA4.returnPressed.connect(self.On_Click)
         self.logThread = LogThread(self)
         self.logThreadRunning = False
-        self.loggerQ1 = self.create_logger('ALdfuCh1')
-        self.loggerQ2 = self.create_logger('ALdfuCh2')
-        self.loggerQ3 = self.create_logger('ALdfuCh3')
-        self.loggerQ4 = self.create_logger('ALdfuCh4')
+        self.loggers = {slot: self.create_logger(f'ALdfuCh{slot}') for slot in self.station.slots()}
         self.logThread.start()
 
     def retranslateUi(self, Window):
@@ -217,11 +212,15 @@ class Ui_Form(object):
         self.Ch4Result.setPlaceholderText(_translate("Window", "Result - Slot 4"))
         self.groupBox_2.setTitle(_translate("Window", "Log"))
 
+    def snEdit(self, slot):
+        return getattr(self, f'snA{slot}')
+
+    def resultEdit(self, slot):
+        return getattr(self, f'Ch{slot}Result')
+
     def preTesting(self):
-        self.snA1.setReadOnly(True)
-        self.snA2.setReadOnly(True)
-        self.snA3.setReadOnly(True)
-        self.snA4.setReadOnly(True)
+        for slot in self.station.slots():
+            self.snEdit(slot).setReadOnly(True)
         self.ClickButton.setDisabled(True)
         self.ClearButton.setDisabled(True)
         self.count = 0
@@ -230,58 +229,41 @@ class Ui_Form(object):
         self.count -= count
         if self.count != 0:
             return
-        self.snA1.setReadOnly(False)
-        self.snA2.setReadOnly(False)
-        self.snA3.setReadOnly(False)
-        self.snA4.setReadOnly(False)
+        for slot in self.station.slots():
+            self.snEdit(slot).setReadOnly(False)
         self.ClickButton.setEnabled(True)
         self.ClearButton.setEnabled(True)
 
     def validateSN(self):
-        snA1 = self.snA1.text().strip()
-        snA2 = self.snA2.text().strip()
-        snA3 = self.snA3.text().strip()
-        snA4 = self.snA4.text().strip()
-
-        validA1 = False
-        validA2 = False
-        validA3 = False
-        validA4 = False
-        try:
-            snC1T1, t1 = snA1.split('-')
-            snC1T2, t2 = snA2.split('-')
-            if snC1T1 != snC1T2 or t1 != 'T1' or t2 != 'T2':
-                raise ValueError('Slot 1 and Slot 2 SN INVALID')
-            validA1 = True
-            validA2 = True
-        except:
-            pass
-        try:
-            snC2T1, t1 = snA3.split('-')
-            snC2T2, t2 = snA4.split('-')
-            if snC2T1 != snC2T2 or t1 != 'T1' or t2 != 'T2':
-                raise ValueError('Slot 3 and Slot 4 SN INVALID')
-            validA3 = True
-            validA4 = True
-        except:
-            pass
-        try:
-            if snC1T1 == snC2T1:
-                raise ValueError('Error: Cable 1 and Cable 2 SN SAME')
-        except ValueError:
-            validA1 = False
-            validA2 = False
-            validA3 = False
-            validA4 = False
-        except:
-            pass
-
-        self.snA1.setText(snA1)
-        self.snA2.setText(snA2)
-        self.snA3.setText(snA3)
-        self.snA4.setText(snA4)
-
-        return validA1, validA2, validA3, validA4
+        """
+        Returns {slot: valid} for the SN of every slot.  Both ends of a cable
+        must carry the cable SN with -T1 and -T2, and no two cables may have
+        the same SN.
+        """
+        sns = {slot: self.snEdit(slot).text().strip() for slot in self.station.slots()}
+        valid = dict.fromkeys(sns, False)
+
+        cable_sns = {}
+        for t1_slot, t2_slot in self.station.cables():
+            try:
+                snT1, t1 = sns[t1_slot].split('-')
+                snT2, t2 = sns[t2_slot].split('-')
+                if snT1 != snT2 or t1 != 'T1' or t2 != 'T2':
+                    raise ValueError(f'Slot {t1_slot} and Slot {t2_slot} SN INVALID')
+                valid[t1_slot] = True
+                valid[t2_slot] = True
+                cable_sns[(t1_slot, t2_slot)] = snT1
+            except:
+                pass
+
+        if len(set(cable_sns.values())) != len(cable_sns):
+            # Error: two cables with the same SN
+            valid = dict.fromkeys(sns, False)
+
+        for slot, sn in sns.items():
+            self.snEdit(slot).setText(sn)
+
+        return valid
 
     def showAbout(self):
         pwd = os.path.dirname(os.path.realpath(__file__))
@@ -294,21 +276,17 @@ class Ui_Form(object):
         ))
 
     def ClearSN(self):
-        self.snA1.clear()
-        self.snA2.clear()
-        self.snA3.clear()
-        self.snA4.clear()
+        for slot in self.station.slots():
+            self.snEdit(slot).clear()
 
     def On_Click(self):
         if not self.ClickButton.isEnabled():
             return
         self.preTesting()
-        validA1, validA2, validA3, validA4 = self.validateSN()
+        valid = self.validateSN()
         self.LogTextEdit.setText('')
-        self.Ch1Result.setText('')
-        self.Ch2Result.setText('')
-        self.Ch3Result.setText('')
-        self.Ch4Result.setText('')
+        for slot in self.station.slots():
+            self.resultEdit(slot).setText('')
         # self.SNLeft.setText('lefttest')
         # self.SNRight.setText('righttest')
         # if(MesCheckSN(DB.DbProvider.Mes.operationId,self.SNLeft.toPlainText().strip(),DB.DbProvider.Mes.userid,DB.DbProvider.Mes.host_checksn) == False):
@@ -319,63 +297,36 @@ class Ui_Form(object):
         #     # return
         start_date_time = datetime.datetime.now()
         time_string = start_date_time.strftime("%Y%m%d_%H%M%S")
-        self.modify_logger_filename(self.loggerQ1, self.snA1.text(), time_string)
-        self.modify_logger_filename(self.loggerQ2, self.snA2.text(), time_string)
-        self.modify_logger_filename(self.loggerQ3, self.snA3.text(), time_string)
-        self.modify_logger_filename(self.loggerQ4, self.snA4.text(), time_string)
+        for slot in self.station.slots():
+            self.modify_logger_filename(self.loggers[slot], self.snEdit(slot).text(), time_string)
         import os
         pwd = os.path.dirname(os.path.realpath(__file__))
         os.system(f'{pwd}/utb_util -init')
 
-        TestMonitor.TestAbout.Ch1Finished = False
-        TestMonitor.TestAbout.Ch2Finished = False
-        TestMonitor.TestAbout.Ch3Finished = False
-        TestMonitor.TestAbout.Ch4Finished = False
-        TestMonitor.TestAbout.Ch1Result = False
-        TestMonitor.TestAbout.Ch2Result = False
-        TestMonitor.TestAbout.Ch3Result = False
-        TestMonitor.TestAbout.Ch4Result = False
-        # loggerCh1 = self.create_logger(self.SNLeft.toPlainText().strip()+'-T1')
-        # loggerCh2 = self.create_logger(self.SNLeft.toPlainText().strip()+'-T2')
-        self.ProcessCh1 = UDPThread(SN=self.snA1.text(), port=3, logger=self.loggerQ1, form=self,
-                                    start_date_time=start_date_time, time_string=time_string)
-        self.ProcessCh2 = UDPThread2(SN=self.snA2.text(), port=4, logger=self.loggerQ2, form=self,
-                                     start_date_time=start_date_time, time_string=time_string)
-        self.ProcessCh3 = UDPThread3(SN=self.snA3.text(), port=5, logger=self.loggerQ3, form=self,
-                                     start_date_time=start_date_time, time_string=time_string)
-        self.ProcessCh4 = UDPThread4(SN=self.snA4.text(), port=6, logger=self.loggerQ4, form=self,
-                                     start_date_time=start_date_time, time_string=time_string)
+        self.station.reset()
+        self.processes = {}
+        for slot in self.station.slots():
+            self.processes[slot] = UDPThread(station=self.station, slot=slot, SN=self.snEdit(slot).text(),
+                                             logger=self.loggers[slot], form=self,
+                                             start_date_time=start_date_time, time_string=time_string)
 
         # self.timer.start(5000)
 
-        if validA1 and validA2:
-            self.ProcessCh1.start()
-            self.ProcessCh2.start()
-            self.count += 2
-            self.Ch1Result.setText('Testing')
-            self.Ch2Result.setText('Testing')
-            self.Ch1Result.setStyleSheet("background-color: yellow;")
-            self.Ch2Result.setStyleSheet("background-color: yellow;")
-        else:
-            self.Ch1Result.setText('SN Error')
-            self.Ch1Result.setStyleSheet("background-color: red;")
-            self.Ch2Result.setText('SN Error')
-            self.Ch2Result.setStyleSheet("background-color: red;")
-        if validA3 and validA4:
-            self.ProcessCh3.start()
-            self.ProcessCh4.start()
-            self.count += 2
-            self.Ch3Result.setText('Testing')
-            self.Ch4Result.setText('Testing')
-            self.Ch3Result.setStyleSheet("background-color: yellow;")
-            self.Ch4Result.setStyleSheet("background-color: yellow;")
-        else:
-            self.Ch3Result.setText('SN Error')
-            self.Ch3Result.setStyleSheet("background-color: red;")
-            self.Ch4Result.setText('SN Error')
-            self.Ch4Result.setStyleSheet("background-color: red;")
-        
-        if not ((validA1 and validA2) or (validA3 and validA4)):
+        started = False
+        for cable in self.station.cables():
+            if all(valid[slot] for slot in cable):
+                for slot in cable:
+                    self.processes[slot].start()
+                    self.count += 1
+                    self.resultEdit(slot).setText('Testing')
+                    self.resultEdit(slot).setStyleSheet("background-color: yellow;")
+                started = True
+            else:
+                for slot in cable:
+                    self.resultEdit(slot).setText('SN Error')
+                    self.resultEdit(slot).setStyleSheet("background-color: red;")
+
+        if not started:
             self.postTesting(count=0)
 
     def On_Timer(self):
@@ -384,36 +335,12 @@ class Ui_Form(object):
     def LogWrite(self, logstring):
         self.LogTextEdit.append(logstring)
 
-    def Ch1ResultShow(self, Result):
-        self.Ch1Result.setText(Result)
-        if (Result == 'OK'):
-            self.Ch1Result.setStyleSheet("background-color: green;")
-        else:
-            self.Ch1Result.setStyleSheet("background-color: red;")
-        self.postTesting()
-
-    def Ch2ResultShow(self, Result):
-        self.Ch2Result.setText(Result)
-        if (Result == 'OK'):
-            self.Ch2Result.setStyleSheet("background-color: green;")
-        else:
-            self.Ch2Result.setStyleSheet("background-color: red;")
-        self.postTesting()
-
-    def Ch3ResultShow(self, Result):
-        self.Ch3Result.setText(Result)
-        if (Result == 'OK'):
-            self.Ch3Result.setStyleSheet("background-color: green;")
-        else:
-            self.Ch3Result.setStyleSheet("background-color: red;")
-        self.postTesting()
-
-    def Ch4ResultShow(self, Result):
-        self.Ch4Result.setText(Result)
+    def ChResultShow(self, slot, Result):
+        self.resultEdit(slot).setText(Result)
         if (Result == 'OK'):
-            self.Ch4Result.setStyleSheet("background-color: green;")
+            self.resultEdit(slot).setStyleSheet("background-color: green;")
         else:
-            self.Ch4Result.setStyleSheet("background-color: red;")
+            self.resultEdit(slot).setStyleSheet("background-color: red;")
         self.postTesting()
 
     def create_logger(self, classname):
@@ -0,0 +1,284 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+asyncio engine for upgrading many ports from one thread.
+
+A FirmwareUpgrader spends most of an upgrade sleeping: before the first
+CDB status poll and between polls, in the 0101 erase, in the reset after
+the restart, while the module changes power mode and while the retimer
+loads its firmware.  Run from one thread per port, a station of 32 ports
+parks 32 OS threads in time.sleep().
+
+AsyncFirmwareUpgrader runs the same steps of the upgrade on an event loop,
+see Upgrade Steps in firmware_upgrader.  The sleeps and polls are awaited,
+and the blocking driver calls go to a small thread pool shared by all
+upgraders, so one event loop keeps dozens of ports busy with a fixed number
+of threads.  The sequence of commands sent to a module is the same as with
+FirmwareUpgrader.upgrade_firmware().
+
+The stages of the upgrade can be limited per bus segment with an
+AsyncPhaseScheduler, see PhaseScheduler.
+
+Example:
+    upgraders = {port: AsyncFirmwareUpgrader(driver, "MCU", logger) for port, driver in drivers.items()}
+    results = run_ports(upgraders, "firmware/EM200QDX.0.52.0", verify=True,
+                        phases=AsyncPhaseScheduler({"transfer": 8}))
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+
+from firmware_upgrader import (FirmwareUpgrader, FirmwareUpgraderException, Io, PhaseScheduler, Result, Sleep,
+                               Stage, monotonic, next_step)
+
+
+class AsyncFirmwareUpgrader(FirmwareUpgrader):
+    """
+    Firmware upgrader whose upgrade runs on an asyncio event loop.
+
+    The steps of the upgrade are the ones of FirmwareUpgrader, only run by
+    _run_async() instead of _run(): Io steps go to the executor and Sleep
+    steps are awaited.
+
+    The constructor doesn't touch the module, await open() before the first
+    upgrade.  The synchronous methods of FirmwareUpgrader keep working, but
+    block the event loop when called from it.
+    """
+    # Threads for the blocking driver calls of all upgraders.  One thread is
+    # enough for a single bus, add threads for ports on separate buses.
+    executor_workers = 4
+    executor = None
+
+    # Progress is logged in these steps, as ports would garble a shared
+    # progress bar
+    progress_percent = 10
+
+    def _prepare_module(self):
+        """
+        The module is prepared by open().
+        """
+        self._opened = False
+
+    async def open(self):
+        """
+        Check that the module can be upgraded, unlock it and read the
+        firmware info.
+
+        Raises:
+            FirmwareUpgraderException: The module can't be upgraded
+        """
+        async with self._stage("unlock"):
+            await self._run_async(self._prepare_steps())
+        self._opened = True
+
+    async def upgrade_firmware_async(self, upgrade_file, verify=False, **kwargs):
+        """
+        Coroutine version of upgrade_firmware(), see there for the arguments.
+
+        Returns:
+            A dictionary with upgraded firmware version and CRC info
+        Raises:
+            FirmwareUpgraderException: An error occurred during the upgrade process
+        """
+        if not self._opened:
+            await self.open()
+
+        return await self._run_async(self._upgrade_firmware_steps(upgrade_file, verify, kwargs))
+
+    async def dfu_async(self, filename, limit=None, resume_address=None, image=None):
+        """
+        Coroutine version of dfu(), see there for the arguments.
+
+        Returns:
+            CRC of the image file
+        """
+        return await self._run_async(self._dfu_steps(filename, limit, False, resume_address, image))
+
+    async def cdb_cmd_async(self, cmd=0x0, lpl=bytes(0), rlpl_len=0):
+        """
+        Coroutine version of cdb_cmd().
+
+        Args:
+            cmd: int: CDB command
+            lpl: list: LPL data packet
+            rlpl_len: int: RLPL length
+        """
+        await self._run_async(self._cdb_cmd_steps(cmd, lpl, rlpl_len))
+
+    async def set_low_power_mode_async(self, lp_mode=True, wait=False):
+        """
+        Coroutine version of set_low_power_mode().
+
+        Args:
+          lp_mode: bool: True to move to Low Power Mode, False to move to Normal mode
+          wait: bool: Wait until target state is reached
+        """
+        return await self._run_async(self._low_power_steps(lp_mode, wait))
+
+    async def _run_async(self, steps):
+        """
+        Run a generator of steps on the event loop and return its result.
+        """
+        step = next_step(steps)
+        while not isinstance(step, Result):
+            try:
+                value = await self._perform_async(step)
+            except (FirmwareUpgraderException, Exception) as exc:
+                step = next_step(steps, error=exc)
+            else:
+                step = next_step(steps, value)
+
+        return step.value
+
+    async def _perform_async(self, step):
+        """
+        Do what a step asks for and return its value.
+        """
+        if isinstance(step, Io):
+            return await self._call(step.function, *step.args)
+
+        if isinstance(step, Sleep):
+            await asyncio.sleep(step.seconds)
+            return None
+
+        if isinstance(step, Stage):
+            async with self._stage(step.stage):
+                return await self._run_async(step.steps)
+
+        return await self._run_async(step.steps)
+
+    def _progress(self, count, total, process):
+        """
+        Log the progress of a port.
+        """
+        self.logger.info("Port {}: {} {}%".format(self.port, process, int(100.0 * count / float(total))))
+
+    def _stage(self, stage):
+        """
+        Returns an async context manager running a stage of the upgrade,
+        see AsyncPhaseScheduler.
+        """
+        if self.phases is None:
+            return _no_stage()
+
+        return self.phases.stage(self.port, stage)
+
+    async def _call(self, function, *args):
+        """
+        Run a blocking function, e.g. a driver transaction, in the executor
+        and return its result.
+        """
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(self._executor(), functools.partial(function, *args))
+
+    @classmethod
+    def _executor(cls):
+        """
+        Returns the thread pool shared by all upgraders, created on first use.
+        """
+        if AsyncFirmwareUpgrader.executor is None:
+            AsyncFirmwareUpgrader.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=cls.executor_workers, thread_name_prefix="dfu_io")
+
+        return AsyncFirmwareUpgrader.executor
+
+
+class AsyncPhaseScheduler(PhaseScheduler):
+    """
+    PhaseScheduler for AsyncFirmwareUpgrader, the ports wait for a stage
+    on the event loop.
+    """
+
+    def __init__(self, limits=None, topology=None):
+        super(AsyncPhaseScheduler, self).__init__(limits, topology)
+        self._loop = None
+
+    @contextlib.asynccontextmanager
+    async def stage(self, port, stage):
+        """
+        Async context manager running a stage of the upgrade of a port.
+        """
+        slots = self._stage_slots(port, stage)
+
+        queued = monotonic()
+        if slots is not None:
+            await slots.acquire()
+        started = self._enter(port, stage, queued)
+        try:
+            yield
+        finally:
+            self._leave(port, stage, started)
+            if slots is not None:
+                slots.release()
+
+    def _stage_slots(self, port, stage):
+        """
+        Returns the semaphore limiting a stage on the segment of a port, or
+        None if the stage has no limit.
+        """
+        # Semaphores belong to an event loop, start over on a new one
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._slots = {}
+            self._loop = loop
+
+        return super(AsyncPhaseScheduler, self)._stage_slots(port, stage)
+
+    def _new_slots(self, limit):
+        """
+        Returns a semaphore for limit ports.
+        """
+        return asyncio.Semaphore(limit)
+
+
+@contextlib.asynccontextmanager
+async def _no_stage():
+    """
+    Stage of an upgrader without a PhaseScheduler.
+    """
+    yield
+
+
+async def upgrade_ports(upgraders, upgrade_file, verify=False, phases=None, **kwargs):
+    """
+    Upgrade every port at the same time and return {port: result}.  The
+    result of a port is its firmware info, or the exception its upgrade
+    failed with, so one failed port doesn't stop the others.
+
+    Args:
+        upgraders: dict: Port -> AsyncFirmwareUpgrader
+        upgrade_file: String: path to folder containing upgrade binaries, or to a firmware bundle
+        verify: boolean: if true, needs to verify the firmware version after upgrade
+        phases: AsyncPhaseScheduler: Scheduler for the stages of the upgrades
+        **kwargs: dict: vendor options of upgrade_firmware()
+    """
+    ports = list(upgraders)
+    for port in ports:
+        if upgraders[port].port is None:
+            upgraders[port].port = port
+        if phases is not None:
+            upgraders[port].phases = phases
+
+    results = await asyncio.gather(
+        *(_upgrade_port(upgraders[port], upgrade_file, verify, kwargs) for port in ports))
+
+    return dict(zip(ports, results))
+
+
+def run_ports(upgraders, upgrade_file, verify=False, phases=None, **kwargs):
+    """
+    Run upgrade_ports() on a new event loop and return {port: result}.
+    """
+    return asyncio.run(upgrade_ports(upgraders, upgrade_file, verify, phases, **kwargs))
+
+
+async def _upgrade_port(upgrader, upgrade_file, verify, kwargs):
+    """
+    Upgrade one port and return the firmware info or the exception.
+    """
+    try:
+        return await upgrader.upgrade_firmware_async(upgrade_file, verify=verify, **kwargs)
+    except (FirmwareUpgraderException, Exception) as exc:
+        return exc
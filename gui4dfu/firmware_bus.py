@@ -0,0 +1,253 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Bus topology aware scheduling of the I2C transactions of many ports.
+
+Ports behind the same adapter share one wire.  On the CS8000 switch every
+port is a channel of the mux on the SPI-aux adapter i2c-34, so only one
+transaction can be on the bus at a time, and every transaction to another
+channel than the last one first reselects the mux.  Ports on different
+adapters, like the per-port adapters of the CS8260, don't contend at all.
+
+BusTopology models this as adapter -> mux channel -> port.  The adapter a
+port is reached through is its bus segment.  BusScheduler hands out
+transaction slots per segment: one port at a time per segment, but all
+segments in parallel.  Ports waiting for the mux channel that is already
+selected go first, up to max_batch slots in a row, so the mux is
+reselected once per batch instead of on nearly every transaction when
+several ports are busy.  ScheduledDriver wraps the driver of a port so
+that all of its transactions go through the scheduler.
+
+Example:
+    topology = BusTopology.from_dev_files({port: dev_file, ...})
+    scheduler = BusScheduler(topology)
+    driver = ScheduledDriver(i2c_driver.I2CDriver(device_filename=dev_file), scheduler, port)
+"""
+import contextlib
+import os
+import re
+import threading
+
+# Name of an adapter in sysfs, e.g. i2c-34
+ADAPTER_PATTERN = re.compile(r"^i2c-(\d+)$")
+
+
+class BusTopology(object):
+    """
+    The bus segment and mux channel of each port.
+    """
+
+    def __init__(self):
+        self._ports = {}
+
+    @classmethod
+    def from_dev_files(cls, dev_files):
+        """
+        Returns the topology of ports given as {port: device file}.  Ports
+        without a device file are left out, so each is a segment of its own.
+
+        Args:
+            dev_files: dict: Port -> device file of the module, e.g. its
+                EEPROM below /sys/devices
+        """
+        topology = cls()
+        for port, dev_file in dev_files.items():
+            if dev_file is None:
+                continue
+            segment, channel = cls.parse(dev_file)
+            topology.add(port, segment, channel)
+
+        return topology
+
+    @staticmethod
+    def parse(dev_file):
+        """
+        Returns the (segment, channel) of a device file.  The segment is the
+        first adapter in the sysfs path, the channel the adapter of the mux
+        channel below it, or None for a device directly on the adapter.  A
+        device file outside sysfs, e.g. a serial port, is its own segment.
+
+        Args:
+            dev_file: string: Device file of the module
+        """
+        path = os.path.realpath(dev_file)
+        adapters = [name for name in path.split(os.sep) if ADAPTER_PATTERN.match(name)]
+        if not adapters:
+            return path, None
+
+        if len(adapters) == 1:
+            return adapters[0], None
+
+        return adapters[0], adapters[-1]
+
+    def add(self, port, segment, channel=None):
+        """
+        Add a port.
+
+        Args:
+            port: Port number or name
+            segment: Bus segment, e.g. the adapter name
+            channel: Mux channel on the segment, None without a mux
+        """
+        self._ports[port] = (segment, channel)
+
+    def segment(self, port):
+        """
+        Returns the (segment, channel) of a port.  An unknown port is a
+        segment of its own.
+        """
+        return self._ports.get(port, (("port", port), None))
+
+    def segments(self):
+        """
+        Returns {segment: [ports]}.
+        """
+        segments = {}
+        for port, (segment, _) in sorted(self._ports.items(), key=lambda item: str(item[0])):
+            segments.setdefault(segment, []).append(port)
+
+        return segments
+
+
+class BusScheduler(object):
+    """
+    Grants transaction slots per bus segment, see the module documentation.
+
+    A slot is held for a single transaction, or for a burst of them, and
+    must never be held while waiting for the module.
+    """
+    # Slots granted in a row to the selected mux channel while ports on
+    # other channels of the segment are waiting
+    max_batch = 8
+
+    def __init__(self, topology):
+        self.topology = topology
+        self._lock = threading.Lock()
+        self._segments = {}
+        self.stats = {
+            "slots": 0,
+            "waits": 0,
+            "channel_switches": 0
+        }
+
+    @contextlib.contextmanager
+    def slot(self, port):
+        """
+        Context manager holding a transaction slot on the segment of a port.
+        """
+        self.acquire(port)
+        try:
+            yield
+        finally:
+            self.release(port)
+
+    def acquire(self, port):
+        """
+        Wait for the segment of a port to be free and take it.
+        """
+        segment, channel = self.topology.segment(port)
+
+        with self._lock:
+            state = self._segments.get(segment)
+            if state is None:
+                state = {"busy": False, "channel": None, "batch": 0, "waiting": {},
+                         "free": threading.Condition(self._lock)}
+                self._segments[segment] = state
+
+            if not self._grantable(state, channel):
+                self.stats["waits"] += 1
+                state["waiting"][channel] = state["waiting"].get(channel, 0) + 1
+                try:
+                    while not self._grantable(state, channel):
+                        state["free"].wait()
+                finally:
+                    state["waiting"][channel] -= 1
+                    if not state["waiting"][channel]:
+                        del state["waiting"][channel]
+
+            state["busy"] = True
+            if channel != state["channel"]:
+                if state["channel"] is not None:
+                    self.stats["channel_switches"] += 1
+                state["channel"] = channel
+                state["batch"] = 0
+            state["batch"] += 1
+            self.stats["slots"] += 1
+
+    def release(self, port):
+        """
+        Give the segment of a port back.
+        """
+        segment, _ = self.topology.segment(port)
+
+        with self._lock:
+            state = self._segments[segment]
+            state["busy"] = False
+            if state["waiting"]:
+                state["free"].notify_all()
+
+    def _grantable(self, state, channel):
+        """
+        Returns True if a port on the given channel may take the segment.
+        """
+        if state["busy"]:
+            return False
+
+        others = any(count for waiting, count in state["waiting"].items() if waiting != channel)
+        if channel == state["channel"]:
+            # Stay on the selected channel until the batch is used up
+            return state["batch"] < self.max_batch or not others
+
+        # Switch only once the selected channel has nobody waiting, or its
+        # batch is used up
+        return not state["waiting"].get(state["channel"]) or state["batch"] >= self.max_batch
+
+
+class ScheduledDriver(object):
+    """
+    I2C driver wrapper that sends the transactions of a port through a
+    BusScheduler.  Wrap the driver before any other wrapper, e.g.
+    PageTrackingDriver(ScheduledDriver(driver, scheduler, port)).
+    """
+
+    def __init__(self, driver_object, scheduler, port):
+        self._driver = driver_object
+        self._scheduler = scheduler
+        self._port = port
+        self._held = 0
+
+    def __getattr__(self, name):
+        # Everything besides read and write goes straight to the driver
+        return getattr(self._driver, name)
+
+    @contextlib.contextmanager
+    def burst(self):
+        """
+        Context manager holding one slot for all the transactions inside,
+        e.g. the writes of a CDB command.  Bursts may be nested.
+        """
+        if self._held:
+            self._held += 1
+        else:
+            self._scheduler.acquire(self._port)
+            self._held = 1
+        try:
+            yield
+        finally:
+            self._held -= 1
+            if not self._held:
+                self._scheduler.release(self._port)
+
+    def read(self, offset, page, count=1):
+        """
+        Read count bytes from the module, see the wrapped driver.
+        """
+        with self.burst():
+            return self._driver.read(offset=offset, page=page, count=count)
+
+    def write(self, offset, data, page, *args):
+        """
+        Write data to the module, see the wrapped driver.
+        """
+        with self.burst():
+            return self._driver.write(offset, data, page, *args)
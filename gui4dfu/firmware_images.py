@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Batch inspection and stamping of firmware image headers.
+
+Works on any number of image files and folders of *.bin images in a process
+pool and reports one row per image as JSON or CSV.
+
+    inspect     Print the header fields, with -check also verify the image
+                size, the CRCs and the state section
+    stamp       Change the version, firmware ID or target of images that
+                already have a header.  Only the header is patched in place,
+                the image data is neither read nor rewritten unless
+                -update_crc asks for the image size and CRC to be refreshed.
+    create      Add a header to images that don't have one yet
+
+Example:
+    python firmware_images.py stamp -major 0 -minor 52 -build 8 -format csv firmware/EM200QDX.0.52.0
+"""
+import argparse
+import concurrent.futures
+import csv
+import json
+import multiprocessing
+import os
+import struct
+import sys
+
+import firmware_upgrader
+
+# Columns of the report, in CSV order
+FIELDS = ("file", "id", "target", "version", "image_size", "image_crc", "header_crc", "git_sha", "ok", "error")
+
+
+def inspect_image(filename, check=False):
+    """
+    Return the report row of an image.  Without check only the header is read.
+    """
+    image = firmware_upgrader.HeaderV1(filename, verbose=False)
+    if check:
+        image.load()
+        image.check()
+    else:
+        image.raw()
+        firmware_upgrader.check_magic(image.info()["magic"], firmware_upgrader.Header.IMAGE_HEADER_MAGIC)
+
+    return _row(filename, image)
+
+
+def stamp_image(filename, major=None, minor=None, build=None, image_id=None, image_target=None, update_crc=False):
+    """
+    Change the header fields of an image in place and return its report row.
+    """
+    image = firmware_upgrader.HeaderV1(filename, verbose=False)
+    image.load()
+
+    # The image data doesn't change, so keep the image CRC of the header
+    # instead of reading all of the data to calculate it again
+    if not update_crc:
+        image.set_data_crc(image.info()["image_crc"])
+
+    image.set_id(image_id, image_target)
+    image.set_version(major, minor, build)
+    image.write()
+
+    return _row(filename, image)
+
+
+def create_image(filename, image_id, image_target):
+    """
+    Add a header to an image and return its report row.
+    """
+    image = firmware_upgrader.HeaderV1(filename, verbose=False)
+    if os.path.getsize(filename) >= struct.calcsize(image.FORMAT):
+        image.raw()
+        if image.info()["magic"] == firmware_upgrader.Header.IMAGE_HEADER_MAGIC:
+            raise firmware_upgrader.FirmwareUpgraderException("E002: Image already has a header")
+
+    image = firmware_upgrader.HeaderV1(filename, verbose=False)
+    image.create(image_id, image_target)
+
+    return _row(filename, image)
+
+
+def run_batch(operation, filenames, workers=None, **kwargs):
+    """
+    Apply an operation (inspect, stamp or create) to every file in a process
+    pool and return the report rows in the order of the files.  A failure
+    is reported in the row of its file instead of stopping the batch.
+    """
+    function = {"inspect": inspect_image, "stamp": stamp_image, "create": create_image}[operation]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(_safe_call, function, filename, kwargs) for filename in filenames]
+
+        return [future.result() for future in futures]
+
+
+def expand_paths(paths):
+    """
+    Return the image files given directly and the *.bin images below the
+    given folders, sorted by name.
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                filenames.extend(os.path.join(root, name) for name in files if name.endswith(".bin"))
+        else:
+            filenames.append(path)
+
+    return sorted(set(filenames))
+
+
+def write_report(rows, output, report_format):
+    """
+    Write the report rows as JSON or CSV.
+    """
+    if report_format == "json":
+        json.dump(rows, output, indent=2)
+        output.write("\n")
+    else:
+        writer = csv.DictWriter(output, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _safe_call(function, filename, kwargs):
+    """
+    Run an operation on one file in a worker and turn errors into the row.
+    """
+    try:
+        return function(filename, **kwargs)
+    except firmware_upgrader.FirmwareUpgraderException as err:
+        error = err.get_message()
+    except Exception as err:
+        error = str(err)
+
+    row = dict.fromkeys(FIELDS, "")
+    row.update({"file": filename, "ok": False, "error": error})
+
+    return row
+
+
+def _row(filename, image):
+    """
+    Return the report row of a loaded image header.
+    """
+    info = image.info()
+    return {
+        "file": filename,
+        "id": image.MAP_FW_ID.get(info["fw_identifier"], "unknown"),
+        "target": image.MAP_TARGET_DEVICE.get(info["target_device"], "unknown"),
+        "version": "{}.{}.{}".format(*image.get_version()),
+        "image_size": info["image_size"],
+        "image_crc": "0x{:08x}".format(info["image_crc"]),
+        "header_crc": "0x{:08x}".format(info["header_crc"]),
+        "git_sha": info["git_sha"].rstrip(b"\0").decode("ascii", "replace"),
+        "ok": True,
+        "error": ""
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect, stamp or add headers to firmware images in bulk')
+    parser.add_argument('operation', choices=('inspect', 'stamp', 'create'))
+    parser.add_argument('paths', nargs='+', help='Image files or folders of *.bin images')
+    parser.add_argument('-format', '-f', choices=('json', 'csv'), default='json', help='Report format')
+    parser.add_argument('-output', '-o', action='store', default=None, help='Report file, default stdout')
+    parser.add_argument('-workers', '-w', type=int, default=None, help='Worker processes, default CPU count')
+    parser.add_argument('-check', action='store_true', default=False,
+                        help='inspect: verify the image size, CRCs and state section')
+    parser.add_argument('-major', type=int, default=None, help='stamp: major version')
+    parser.add_argument('-minor', type=int, default=None, help='stamp: minor version')
+    parser.add_argument('-build', type=int, default=None, help='stamp: build number')
+    parser.add_argument('-id', dest='image_id', default=None,
+                        choices=sorted(firmware_upgrader.Header.MAP_FW_ID_ARG), help='stamp, create: firmware ID')
+    parser.add_argument('-target', dest='image_target', default=None,
+                        choices=sorted(firmware_upgrader.Header.MAP_TARGET_DEVICE_ARG),
+                        help='stamp, create: target device')
+    parser.add_argument('-update_crc', action='store_true', default=False,
+                        help='stamp: calculate the image size and CRC from the image data again')
+    args = parser.parse_args()
+
+    if args.operation == "inspect":
+        options = {"check": args.check}
+    elif args.operation == "stamp":
+        options = {"major": args.major, "minor": args.minor, "build": args.build, "image_id": args.image_id,
+                   "image_target": args.image_target, "update_crc": args.update_crc}
+    else:
+        if not args.image_id or not args.image_target:
+            parser.error("create needs -id and -target")
+        options = {"image_id": args.image_id, "image_target": args.image_target}
+
+    rows = run_batch(args.operation, expand_paths(args.paths), args.workers, **options)
+
+    if args.output:
+        with open(args.output, "w", newline="") as output:
+            write_report(rows, output, args.format)
+    else:
+        write_report(rows, sys.stdout, args.format)
+
+    sys.exit(0 if all(row["ok"] for row in rows) else 1)
@@ -0,0 +1,292 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Pre-validation of the firmware images in a directory.
+
+Every image below the firmware directory is checked in a process pool when
+the station starts (header magic and version, image and header CRC, state
+section), before any module is unlocked.  Results are kept in a JSON file
+keyed by the SHA-256 of the file contents, so unchanged images are never
+checked twice.  The same file keeps the digests of the images by path, size
+and mtime, so only new or changed files are hashed when the station starts.  The results are handed to the shared image cache of the
+firmware upgrader: valid images are loaded without calculating their CRC
+again and invalid images are refused.
+"""
+import concurrent.futures
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+
+import firmware_upgrader
+
+CACHE_FILE = os.path.join("al_logs", "firmware_validation.json")
+
+# Results of other versions were checked differently and are discarded.
+# Version 2 finds the state section with State.locate(), version 3 adds the
+# digests of the files.
+CACHE_VERSION = 3
+
+_cache_lock = threading.Lock()
+
+# prevalidate_in_background() threads, by firmware directory
+_background = {}
+_background_lock = threading.Lock()
+
+# Digests of the files hashed by this process or found in the cache file,
+# by path: [size, mtime, SHA-256 hex digest]
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def validate_image(filename):
+    """
+    Check one image and return the result as a dictionary.  Runs in a
+    worker process.
+    """
+    result = {"ok": False, "error": None}
+    try:
+        image = firmware_upgrader.HeaderV1(filename, verbose=False)
+        image.load()
+        image.check()
+        result.update({
+            "ok": True,
+            "crc": image.get_crc(),
+            "target": image.get_target(),
+            "id": image.get_id(),
+            "version": list(image.get_version())
+        })
+    except firmware_upgrader.FirmwareUpgraderException as err:
+        result["error"] = err.get_message()
+    except Exception as err:
+        result["error"] = str(err)
+
+    return result
+
+
+def prevalidate(path, cache_file=CACHE_FILE, workers=None, image_cache=None, logger=None):
+    """
+    Validate every *.bin image below path and return {filename: result}.
+
+    Args:
+        path: string: Firmware directory, or an image inside it
+        cache_file: string: JSON file with the results keyed by content hash
+            and the digests of the files
+        workers: int: Number of worker processes, defaults to the CPU count
+        image_cache: ImageCache: Cache to seed with the results, defaults to
+            the one shared by all FirmwareUpgrader objects
+        logger: Logger: Where to report invalid images
+    """
+    if logger is None:
+        logger = logging.getLogger('firmware_prevalidate')
+
+    if image_cache is None:
+        image_cache = firmware_upgrader.FirmwareUpgrader.image_cache
+
+    if not os.path.isdir(path):
+        path = os.path.dirname(path)
+
+    with _cache_lock:
+        known = _load_cache(cache_file, logger)
+
+        # The digest is all that is needed for images that were checked
+        # before, and only files that changed since they were hashed are
+        # read to get it
+        with _digests_lock:
+            previous = dict(_digests)
+        images = {}
+        for root, _, files in os.walk(path):
+            for name in files:
+                if name.endswith(".bin"):
+                    filename = os.path.abspath(os.path.join(root, name))
+                    images[filename] = stat_and_hash(filename)
+
+        digests = {}
+        for filename, (_, _, digest) in images.items():
+            if digest not in known:
+                digests.setdefault(digest, filename)
+
+        if digests:
+            logger.info("Validating {} firmware images".format(len(digests)))
+            # Spawned workers are safe to start from the threads of the GUI
+            context = multiprocessing.get_context("spawn")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                for digest, result in zip(digests, pool.map(validate_image, digests.values())):
+                    known[digest] = result
+
+        with _digests_lock:
+            hashed = any(_digests[filename] != previous.get(filename) for filename in images)
+        if digests or hashed:
+            _save_cache(cache_file, known, logger)
+
+    results = {}
+    for filename, (size, mtime, digest) in images.items():
+        result = known[digest]
+        results[filename] = result
+
+        if result["ok"]:
+            image_cache.seed(filename, size, mtime, crc=result["crc"])
+        else:
+            image_cache.seed(filename, size, mtime, error=result["error"])
+            logger.error("Invalid firmware image {}: {}".format(filename, result["error"]))
+
+    return results
+
+
+def rejected_candidates(path, components, results):
+    """
+    Return {filename: error} for the invalid images that an upgrade of the
+    given components could pick from path.
+
+    Args:
+        path: string: Firmware directory, or an image inside it
+        components: list: Components to upgrade (MCU, MSA, DSP)
+        results: dict: Results returned by prevalidate()
+    """
+    if not os.path.isdir(path):
+        path = os.path.dirname(path)
+
+    catalog = firmware_upgrader.FirmwareCatalog.for_path(path)
+    slots = {"MCU": ("a", "b"), "MSA": (None,), "DSP": (None,)}
+
+    rejected = {}
+    for component in components:
+        for slot in slots.get(component, ()):
+            filename = catalog.find(component, slot)
+            result = results.get(os.path.abspath(filename)) if filename else None
+            if result is not None and not result["ok"]:
+                rejected[filename] = result["error"]
+
+    return rejected
+
+
+def prevalidate_in_background(path, **kwargs):
+    """
+    Run prevalidate() in a daemon thread, e.g. while the GUI starts, and
+    return the thread.  The results of the thread are returned by
+    background_results().
+    """
+    def run():
+        thread.results = prevalidate(path, **kwargs)
+
+    thread = threading.Thread(target=run, name="firmware_prevalidate")
+    thread.daemon = True
+    thread.results = None
+    with _background_lock:
+        _background[_directory(path)] = thread
+    thread.start()
+
+    return thread
+
+
+def background_results(path, timeout=None):
+    """
+    Wait for the prevalidate_in_background() run that covers path and
+    return its results, or None if there is no such run, it failed or it
+    didn't finish within timeout.
+
+    Args:
+        path: string: Firmware directory, or an image inside it
+        timeout: float: Seconds to wait for the run, forever if None
+    """
+    path = _directory(path)
+    with _background_lock:
+        runs = list(_background.items())
+
+    for directory, thread in runs:
+        if path == directory or path.startswith(directory.rstrip(os.sep) + os.sep):
+            thread.join(timeout)
+            if not thread.is_alive():
+                return thread.results
+
+    return None
+
+
+def stat_and_hash(filename):
+    """
+    Return the (size, mtime, SHA-256 hex digest) of a file.  The file is
+    only read if its size or mtime changed since it was last hashed, e.g.
+    by prevalidate().
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    with _digests_lock:
+        known = _digests.get(filename)
+    if known is not None and known[0:2] == [stat.st_size, stat.st_mtime]:
+        return stat.st_size, stat.st_mtime, known[2]
+
+    digest = hashlib.sha256()
+    with open(filename, "rb") as image:
+        for block in iter(lambda: image.read(1024 * 1024), b""):
+            digest.update(block)
+
+    with _digests_lock:
+        _digests[filename] = [stat.st_size, stat.st_mtime, digest.hexdigest()]
+
+    return stat.st_size, stat.st_mtime, digest.hexdigest()
+
+
+def _directory(path):
+    """
+    Returns the absolute firmware directory of a directory or an image.
+    """
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        path = os.path.dirname(path)
+
+    return path
+
+
+def _load_cache(cache_file, logger):
+    """
+    Load the persisted results, an unreadable file or one of another
+    version is treated as empty.  The persisted digests are added to the
+    ones of this process.
+    """
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+
+    try:
+        with open(cache_file, "r") as results_file:
+            cache = json.load(results_file)
+    except (IOError, ValueError) as exc:
+        logger.warning("Ignoring firmware validation cache {}: {}".format(cache_file, exc))
+        return {}
+
+    if cache.get("version") != CACHE_VERSION:
+        return {}
+
+    with _digests_lock:
+        for filename, known in cache["digests"].items():
+            _digests.setdefault(filename, known)
+
+    return cache["results"]
+
+
+def _save_cache(cache_file, known, logger):
+    """
+    Persist the results.  The file is replaced atomically because several
+    ALdfu.py processes may start at the same time.
+    """
+    if not cache_file:
+        return
+
+    try:
+        path = os.path.dirname(cache_file)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+
+        # Files that were removed don't need their digest any more
+        with _digests_lock:
+            digests = dict((filename, known_file) for filename, known_file in _digests.items()
+                           if os.path.exists(filename))
+
+        temp_file = "{}.{}".format(cache_file, os.getpid())
+        with open(temp_file, "w") as results_file:
+            json.dump({"version": CACHE_VERSION, "results": known, "digests": digests}, results_file,
+                      indent=2, sort_keys=True)
+        os.replace(temp_file, cache_file)
+    except (IOError, OSError) as exc:
+        logger.warning("Unable to save firmware validation cache {}: {}".format(cache_file, exc))
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Shared memory distribution of firmware images.
+
+Ports upgraded by separate ALdfu.py processes would each load their own copy
+of every image.  Instead the first process to need an image checks it and
+publishes the file contents in a POSIX shared memory segment named after the
+SHA-256 of the contents.  Every other process attaches to the same segment,
+so a station keeps one copy of each image no matter how many ports it
+upgrades.  The images are handed to dfu() as read-only views into the
+segment, through the image cache of the firmware upgrader.
+
+Each segment starts with SEGMENT_HEADER: a magic number that is written once
+the image was copied and checked, the number of processes attached, the
+image file size and the image data CRC.  The header is only changed while
+holding LOCK_FILE, and the last process to release a segment removes it.
+A process that dies without releasing its images leaves the segments behind,
+they are found again by content hash and reused by the next run.
+"""
+import contextlib
+import os
+import struct
+import sys
+import tempfile
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import firmware_prevalidate
+import firmware_upgrader
+
+SEGMENT_MAGIC = b"DFUS"
+
+# magic, reference count, image file size, image data CRC
+SEGMENT_HEADER = struct.Struct("<4sIQI")
+
+# The image contents start at a cache line boundary
+DATA_OFFSET = 64
+
+LOCK_FILE = os.path.join(tempfile.gettempdir(), "gui4dfu_shared_images.lock")
+
+_thread_lock = threading.Lock()
+
+
+class SharedImage(object):
+    """
+    A firmware image in a shared memory segment that this process attached to.
+    """
+
+    def __init__(self, filename, segment, image):
+        self.filename = filename
+        self.name = segment.name
+        self.image = image
+        self._segment = segment
+
+    def release(self, image_cache=None):
+        """
+        Detach from the segment, and remove it if no other process uses it.
+
+        Args:
+            image_cache: ImageCache: Cache the image was added to, defaults to
+                the one shared by all FirmwareUpgrader objects
+        """
+        if self._segment is None:
+            return
+
+        if image_cache is None:
+            image_cache = firmware_upgrader.FirmwareUpgrader.image_cache
+        image_cache.discard(self.filename)
+        self.image = None
+
+        with _locked():
+            magic, refs, size, crc = SEGMENT_HEADER.unpack_from(self._segment.buf, 0)
+            refs = max(refs - 1, 0)
+            SEGMENT_HEADER.pack_into(self._segment.buf, 0, magic, refs, size, crc)
+            if not refs:
+                _unlink(self._segment)
+
+        _close(self._segment)
+        self._segment = None
+
+
+def acquire(filename, image_cache=None):
+    """
+    Attach to the shared copy of an image, publishing it first if no other
+    process did, and add it to the image cache.  Returns a SharedImage.
+
+    Args:
+        filename: string: Path of the image
+        image_cache: ImageCache: Cache to add the image to, defaults to the
+            one shared by all FirmwareUpgrader objects
+
+    Raises:
+        FirmwareUpgraderException: The image doesn't match its header
+    """
+    if image_cache is None:
+        image_cache = firmware_upgrader.FirmwareUpgrader.image_cache
+
+    filename = os.path.abspath(filename)
+    # Hashed already if the images were prevalidated
+    size, mtime, digest = firmware_prevalidate.stat_and_hash(filename)
+    name = "dfu_{}".format(digest[:24])
+
+    with _locked():
+        segment = _attach(name, size)
+        if segment is None:
+            segment = _publish(name, filename, size)
+
+        magic, refs, size, crc = SEGMENT_HEADER.unpack_from(segment.buf, 0)
+        SEGMENT_HEADER.pack_into(segment.buf, 0, magic, refs + 1, size, crc)
+
+    image = firmware_upgrader.HeaderV1(filename, verbose=False)
+    image.load(contents=segment.buf[DATA_OFFSET:DATA_OFFSET + size].toreadonly(), data_crc=crc)
+    image_cache.add(filename, size, mtime, image)
+
+    return SharedImage(filename, segment, image)
+
+
+def share_images(path, components, image_cache=None, logger=None):
+    """
+    Acquire the images that an upgrade of the given components could pick
+    from path and return the list of SharedImage objects.
+
+    Args:
+        path: string: Firmware directory, or an image inside it
+        components: list: Components to upgrade (MCU, MSA, DSP)
+        image_cache: ImageCache: Cache to add the images to
+        logger: Logger: Where to report the shared images
+    """
+    if not os.path.isdir(path):
+        path = os.path.dirname(path)
+
+    catalog = firmware_upgrader.FirmwareCatalog.for_path(path)
+    slots = {"MCU": ("a", "b"), "MSA": (None,), "DSP": (None,)}
+
+    shared = []
+    for component in components:
+        for slot in slots.get(component, ()):
+            filename = catalog.find(component, slot)
+            if filename:
+                shared.append(acquire(filename, image_cache))
+                if logger:
+                    logger.info("Using shared firmware image {} ({})".format(filename, shared[-1].name))
+
+    return shared
+
+
+def release_images(shared, image_cache=None):
+    """
+    Release every SharedImage in a list, e.g. with atexit when the process ends.
+    """
+    for image in shared:
+        image.release(image_cache)
+
+
+@contextlib.contextmanager
+def _locked():
+    """
+    Serialize the segment header updates of all processes and threads.
+    """
+    with _thread_lock:
+        if fcntl is None:
+            yield
+            return
+
+        with open(LOCK_FILE, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _open_segment(name, create=False, size=0):
+    """
+    Open a segment that isn't removed when this process exits.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+
+    # Older versions remove every segment a process opened when it exits
+    segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+    resource_tracker.unregister(segment._name, "shared_memory")
+
+    return segment
+
+
+def _unlink(segment):
+    """
+    Remove a segment opened by _open_segment().
+    """
+    if sys.version_info < (3, 13):
+        # unlink() tells the resource tracker, which must know the segment
+        resource_tracker.register(segment._name, "shared_memory")
+    segment.unlink()
+
+
+def _close(segment):
+    """
+    Close a segment.  If views of it are still in use, e.g. by an upgrader
+    or the traceback of a failed check, the mapping goes away with the
+    process instead.
+    """
+    try:
+        segment.close()
+    except BufferError:
+        pass
+
+
+def _attach(name, size):
+    """
+    Return the published segment of an image, or None if there is none.  A
+    segment left incomplete by a process that died while publishing it is
+    removed.
+    """
+    try:
+        segment = _open_segment(name)
+    except FileNotFoundError:
+        return None
+
+    magic, _, segment_size, _ = SEGMENT_HEADER.unpack_from(segment.buf, 0)
+    if magic == SEGMENT_MAGIC and segment_size == size:
+        return segment
+
+    _unlink(segment)
+    segment.close()
+
+    return None
+
+
+def _publish(name, filename, size):
+    """
+    Copy an image into a new segment, check it and return the segment.
+    """
+    segment = _open_segment(name, create=True, size=DATA_OFFSET + size)
+    contents = segment.buf[DATA_OFFSET:DATA_OFFSET + size]
+    try:
+        with open(filename, "rb") as source:
+            source.readinto(contents)
+
+        image = firmware_upgrader.HeaderV1(filename, verbose=False)
+        image.load(contents=contents)
+        image.check()
+        crc = image.get_crc()
+    except BaseException as exc:
+        # The frames of the failed check hold views of the segment, drop them
+        # so that it can be closed
+        exc.__traceback__ = None
+        image = None
+        contents.release()
+        _unlink(segment)
+        _close(segment)
+        raise
+
+    # Only the views of acquire() remain
+    image = None
+    contents.release()
+
+    # The magic number marks the segment as complete
+    SEGMENT_HEADER.pack_into(segment.buf, 0, SEGMENT_MAGIC, 0, size, crc)
+
+    return segment
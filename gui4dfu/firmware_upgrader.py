@@ -6,20 +6,79 @@ This module conforms to the custom API provided by a client.
 This module must be compatible with Python 2.7 and Python 3.9
 """
 import binascii
+import collections
+import contextlib
 import datetime
 import fnmatch
+import itertools
+import json
 import logging
+import mmap
 import os
 import struct
 import sys
+import threading
 import time
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, profile files are then saved without a lock
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 
 RESET_DELAY = 1
 
 MANUFACTURER_PASSWORD = [0x88, 0x88, 0x88, 0x88]
 
+# Struct for the CDB command field block
+#   >   Big endian
+#   H   Command code (2 bytes)
+#   H   EPL length (2 bytes)
+#   B   LPL length (1 byte)
+#   B   CdbChkCode (1 byte)
+#   B   RLPLLen (1 byte)
+#   B   RLPLChkCode (1 byte)
+CDB_COMMAND_FIELDS = struct.Struct(">HHBBBB")
+
+# Struct for the address that leads the LPL data of a 0103 command
+#   >   Big endian
+#   I   Image address (4 bytes)
+CDB_IMAGE_ADDRESS = struct.Struct(">I")
+
+# First CDB EPL page.  EPL data is staged in pages A0h-AFh before a 0104 command.
+CDB_EPL_PAGE = 0xA0
+
+# Number of EPL pages for each CdbMaxPagesEPL value advertised in Page 01h,
+# byte 163, bits 3-0.  Values not listed are reserved and treated as no EPL.
+CDB_EPL_PAGES_SUPPORTED = {0x0: 0, 0x1: 1, 0x2: 2, 0x3: 4, 0x4: 8, 0x5: 16}
+
+if sys.version_info[:2] == (2, 7):
+    # time.clock is CPU time on Linux, so fall back to the wall clock
+    monotonic = time.time
+else:
+    monotonic = time.monotonic
+
+
+def cdb_chk_code(*blocks):
+    """
+    Given one or more byte strings, return the 1's complement sum of their
+    bytes as the CDB check code.
+
+    Args:
+        blocks: bytes: Data to calculate the CDB check code
+    """
+    total = 0
+    for block in blocks:
+        total += sum(bytearray(block))
+    # Convert to 1's complement by subtracting from the largest byte.  We
+    # do this so that the number returned is positive in the range of 0 to
+    # 255.  That allows for the correct convertsion to hex for transmission.
+    chk_code = 255 - (total & 0x00FF)
+
+    return chk_code
+
 
 ###################
 # Exception Class #
@@ -77,6 +136,839 @@ class FirmwareUpgraderException(BaseException):
                 self.error_explanation = "Image is corrupted!"
             elif "0x46" in self.detailed_error_message:
                 self.error_explanation = "No password or incorrect password."
+        elif "E004" in self.detailed_error_message:
+            self.error_explanation = "Image is corrupted!"
+
+
+#######################
+# CDB Timing Profiles #
+#######################
+
+class CdbTimingProfile(object):
+    """
+    Learned CDB command completion times.
+
+    The time from issuing a CDB command until its status leaves the busy
+    state is measured for every command and kept as a running average per
+    command code, module firmware version and port.  The profile is shared
+    by all upgraders in a process and can be persisted to a JSON file so
+    that later runs start from the learned values.  ALdfu.py runs one
+    process per port on the same file, so saving merges the profiles this
+    process learned into the ones on disk.
+    """
+    # Delays used until a completion time has been learned for a command.
+    #
+    # CDB 0101h commands performs a full erase of the target partition.
+    # The erase hangs the AHB bus, preventing I2C communication. So we
+    # need at most a 1.750s delay before continuing with I2C traffic.
+    # CDB 0103h/0104h commands perform flash writes. We give them a tiny
+    # amount of headroom to avoid any delays in acknowledging the
+    # subsequent status check for the same AHB bus reason above.
+    DEFAULT_DELAYS = {
+        0x0100: 0.100,
+        0x0101: 1.750,
+        0x0103: 0.001,
+        0x0104: 0.001,
+        0x0107: 0.100,
+    }
+
+    # Time allowed for status polling on top of the expected completion time
+    POLL_TIMEOUT = 0.200
+
+    # The first status poll is scheduled at this fraction of the learned
+    # completion time, after that the poll interval doubles from
+    # POLL_INTERVAL up to MAX_POLL_INTERVAL.
+    FIRST_POLL = 0.9
+    POLL_INTERVAL = 0.0005
+    MAX_POLL_INTERVAL = 0.016
+
+    # Weight of a new measurement in the running average
+    SMOOTHING = 0.2
+
+    def __init__(self, filename=None):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self._loaded = False
+        self._updated = set()
+
+    @staticmethod
+    def key(cmd, version, port):
+        """
+        Return the profile key for a command on a module firmware version
+        (major, minor) and port.
+        """
+        return "{:04X}/{}.{}/{}".format(cmd, version[0], version[1], port)
+
+    def expected(self, key):
+        """
+        Returns the learned completion time in seconds, or None if the
+        command has not been measured yet.
+        """
+        with self._lock:
+            self._load()
+            profile = self._profiles.get(key)
+
+        if profile is None:
+            return None
+
+        return profile["busy"]
+
+    def schedule(self, cmd, key):
+        """
+        Returns a tuple of the delay before the first status poll and the
+        timeout for the command, both in seconds from when it was issued.
+        """
+        default = self.DEFAULT_DELAYS.get(cmd, 0.0)
+        learned = self.expected(key)
+
+        if learned is None:
+            return default, default + self.POLL_TIMEOUT
+
+        return learned * self.FIRST_POLL, max(default, 2 * learned) + self.POLL_TIMEOUT
+
+    def record(self, key, busy):
+        """
+        Add a measured completion time in seconds to the running average.
+        """
+        with self._lock:
+            self._load()
+            profile = self._profiles.get(key)
+            if profile is None:
+                self._profiles[key] = {"busy": busy, "samples": 1}
+            else:
+                profile["busy"] += self.SMOOTHING * (busy - profile["busy"])
+                profile["samples"] += 1
+            self._updated.add(key)
+
+    def save(self):
+        """
+        Write the learned profiles to the profile file, if one is set.  The
+        profiles updated by this process replace the ones in the file, the
+        others in the file are kept.  The file is replaced atomically so that
+        it is never read half written.
+        """
+        if not self._filename:
+            return
+
+        with self._lock:
+            if not self._updated:
+                return
+
+            path = os.path.dirname(self._filename)
+            if path and not os.path.exists(path):
+                os.makedirs(path)
+
+            with open(self._filename + ".lock", "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+                profiles = self._read()
+                for key in self._updated:
+                    profiles[key] = self._profiles[key]
+
+                temp_file = "{}.{}".format(self._filename, os.getpid())
+                with open(temp_file, "w") as profile_file:
+                    json.dump(profiles, profile_file, indent=2, sort_keys=True)
+                # os.replace doesn't exist in Python 2.7
+                getattr(os, "replace", os.rename)(temp_file, self._filename)
+
+            # Pick up what the other processes learned
+            self._profiles.update(profiles)
+            self._updated = set()
+
+    def _load(self):
+        """
+        Load the profile file on first use.  Must be called with the lock held.
+        """
+        if self._loaded:
+            return
+
+        self._loaded = True
+        self._profiles.update(self._read())
+
+    def _read(self):
+        """
+        Returns the profiles in the profile file, an unreadable file is
+        treated as empty.
+        """
+        if not self._filename or not os.path.exists(self._filename):
+            return {}
+
+        try:
+            with open(self._filename, "r") as profile_file:
+                return json.load(profile_file)
+        except (IOError, ValueError) as exc:
+            logger.warning("Ignoring CDB timing profile {}: {}".format(self._filename, exc))
+            return {}
+
+
+##################
+# Driver Wrapper #
+##################
+
+class PageTrackingDriver(object):
+    """
+    I2C driver wrapper that skips redundant CMIS page-select writes.
+
+    The wrapper tracks the page currently selected in byte 127 of the
+    module and only asks the wrapped driver to select a page when it
+    changes.  Accesses to the page that is already selected, and to lower
+    memory, are passed to the wrapped driver with page=None, which the
+    driver must treat as "do not write the page-select byte".  Offsets
+    passed with page=None are absolute (128-255 for upper memory) so that
+    the driver can tell lower and upper memory apart.
+
+    All traffic for a port has to go through the same wrapper for the
+    tracking to stay correct, so create it where the driver is created and
+    hand the wrapper to everything that uses the port.
+    """
+
+    def __init__(self, driver_object):
+        self._driver = driver_object
+        self._page = None
+        self.stats = {
+            "reads": 0,
+            "writes": 0,
+            "page_selects": 0,
+            "page_selects_elided": 0
+        }
+
+    def __getattr__(self, name):
+        # Everything besides read and write goes straight to the driver
+        return getattr(self._driver, name)
+
+    def invalidate_page(self):
+        """
+        Forget the selected page, e.g. after the module was reset.
+        """
+        self._page = None
+
+    def read(self, offset, page, count=1):
+        """
+        Read count bytes from the module, see the wrapped driver.
+        """
+        self.stats["reads"] += 1
+        try:
+            offset, page = self._select(offset, page)
+            return self._driver.read(offset=offset, page=page, count=count)
+        except Exception:
+            self._page = None
+            raise
+
+    def write(self, offset, data, page, *args):
+        """
+        Write data to the module, see the wrapped driver.
+        """
+        self.stats["writes"] += 1
+        try:
+            driver_offset, driver_page = self._select(offset, page)
+            result = self._driver.write(driver_offset, data, driver_page, *args)
+        except Exception:
+            self._page = None
+            raise
+
+        # Follow direct writes to the page-select byte
+        if page == 0 and offset <= 127 < offset + len(data):
+            self._page = bytearray(data)[127 - offset]
+
+        return result
+
+    def _select(self, offset, page):
+        """
+        Return the (offset, page) arguments for the wrapped driver.
+        """
+        if page == 0 and offset < 128:
+            # Lower memory doesn't depend on the selected page
+            return offset, None
+
+        if page == self._page:
+            self.stats["page_selects_elided"] += 1
+            if offset < 128:
+                offset += 128
+            return offset, None
+
+        self.stats["page_selects"] += 1
+        self._page = page
+        return offset, page
+
+
+###############
+# Image Cache #
+###############
+
+class ImageCache(object):
+    """
+    Thread-safe cache of loaded firmware images shared by every upgrader in
+    the process.
+
+    Images are keyed by (path, size, mtime), so a binary that is replaced on
+    disk is loaded again.  Each image is loaded and its CRC calculated once,
+    before it is put in the cache, and the least recently used images are
+    evicted when the image data held exceeds max_bytes.  The
+    cached HeaderV1 objects are shared between threads and must not be
+    modified by the users of the cache.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        Constructor.
+
+        Args:
+            max_bytes: int: Upper bound of the image data held by the cache,
+                including data mapped from a file or shared memory
+        """
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._images = collections.OrderedDict()
+        self._bytes = 0
+
+        # Locks of the images being loaded, by key
+        self._loading = {}
+
+        # Results of validating files outside of the cache, keyed by
+        # (path, size, mtime): the image data CRC or the reason to reject it
+        self._crcs = {}
+        self._rejected = {}
+
+    def seed(self, filename, size, mtime, crc=None, error=None):
+        """
+        Record the result of validating a file before it is used, so that
+        loading it skips the CRC calculation or refuses the file.
+
+        Args:
+            filename: string: Path of the image
+            size: int: File size the result applies to
+            mtime: float: File mtime the result applies to
+            crc: int: Image data CRC of a valid image
+            error: string: Reason to reject an invalid image
+        """
+        key = (os.path.abspath(filename), size, mtime)
+        with self._lock:
+            if error is not None:
+                self._rejected[key] = error
+            elif crc is not None:
+                self._crcs[key] = crc
+
+    def get(self, filename):
+        """
+        Returns the loaded HeaderV1 image of a file.
+
+        Args:
+            filename: string: Path of the image
+        """
+        filename = os.path.abspath(filename)
+
+        # Images inside a firmware bundle change with the bundle file
+        bundle = FirmwareBundle.containing(filename)
+        try:
+            stat = os.stat(bundle.filename if bundle else filename)
+        except (IOError, OSError):
+            raise FirmwareUpgraderException("E001: File not found")
+        key = (filename, stat.st_size, stat.st_mtime)
+
+        image = self._cached(key)
+        if image is not None:
+            return image
+
+        # Loading under a lock of the file makes the other channels wait for
+        # the first one instead of loading the same image in parallel, while
+        # other files are loaded at the same time
+        with self._lock:
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        with loading:
+            image = self._cached(key)
+            if image is not None:
+                return image
+
+            try:
+                image = self._load(key, bundle)
+            finally:
+                with self._lock:
+                    if self._loading.get(key) is loading:
+                        del self._loading[key]
+
+        return image
+
+    def _load(self, key, bundle):
+        """
+        Load the image of a key and put it in the cache.
+        """
+        filename = key[0]
+        if bundle:
+            image = bundle.image(filename)
+        else:
+            image = HeaderV1(filename)
+            image.load()
+
+        # Use the CRC from a validation of the same file if there is one.
+        # The CRC and header are completed before the image is shared, so
+        # the upgraders only ever read it.
+        with self._lock:
+            crc = self._crcs.get(key)
+        if crc is not None:
+            image.set_data_crc(crc)
+        image.get_crc()
+
+        with self._lock:
+            self.stats["misses"] += 1
+
+            # Older versions of the file won't be asked for again
+            for stale in [other for other in self._images if other[0] == filename]:
+                self._evict(stale)
+
+            self._images[key] = image
+            self._bytes += self._sizeof(image)
+            self._trim()
+
+        return image
+
+    def _cached(self, key):
+        """
+        Returns the cached image of a key and marks it most recently used,
+        or None if it isn't cached.
+        """
+        with self._lock:
+            if key in self._rejected:
+                raise FirmwareUpgraderException("E004: Rejected image {}: {}".format(key[0], self._rejected[key]))
+
+            image = self._images.pop(key, None)
+            if image is None:
+                return None
+
+            # Most recently used images are kept at the end
+            self.stats["hits"] += 1
+            self._images[key] = image
+
+        return image
+
+    def _trim(self):
+        """
+        Evict the least recently used images until the cache is within
+        max_bytes, keeping at least the most recent one.
+        """
+        while self._bytes > self.max_bytes and len(self._images) > 1:
+            self._evict(next(iter(self._images)))
+
+    def add(self, filename, size, mtime, image):
+        """
+        Put an image that was loaded elsewhere, e.g. from shared memory, in
+        the cache.  It is returned by get() while the file keeps its size
+        and mtime.
+
+        Args:
+            filename: string: Path of the image
+            size: int: File size the image was loaded from
+            mtime: float: File mtime the image was loaded from
+            image: HeaderV1: Loaded image
+        """
+        filename = os.path.abspath(filename)
+        image.get_crc()
+        with self._lock:
+            self.discard(filename, locked=True)
+            self._images[(filename, size, mtime)] = image
+            self._bytes += self._sizeof(image)
+            self._trim()
+
+    def discard(self, filename, locked=False):
+        """
+        Drop the cached images of a file.
+        """
+        filename = os.path.abspath(filename)
+        if not locked:
+            with self._lock:
+                return self.discard(filename, locked=True)
+
+        for key in [other for other in self._images if other[0] == filename]:
+            self._evict(key)
+
+    def clear(self):
+        """
+        Drop every cached image and validation result.
+        """
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+            self._crcs.clear()
+            self._rejected.clear()
+
+    def _evict(self, key):
+        """
+        Remove an image from the cache.
+        """
+        image = self._images.pop(key)
+        self._bytes -= self._sizeof(image)
+        self.stats["evictions"] += 1
+
+    @staticmethod
+    def _sizeof(image):
+        """
+        Returns the number of bytes an image holds.  Image data that is a
+        view into a mapped file, bundle or shared memory segment counts as
+        well, as the map is held until the image is evicted.
+        """
+        return len(image.header()) + len(image.data()[0])
+
+
+#############
+# DFU Plans #
+#############
+
+class DfuPlan(object):
+    """
+    Precomputed download of an image: the 0101 LPL and every 0103/0104
+    frame with its packed command fields, stored in a file that is mapped
+    at run time.
+
+    A plan only depends on the image, the write command, the payload size
+    per frame and whether erased data is skipped, so it is built once and
+    reused by every following DFU of the same image.  The plan header binds
+    it to the image CRC and size and to the CRC of the image header sent in
+    the 0101 LPL, so an image stamped with a new version or ID gets a new
+    plan.  A CRC over the plan body guards against truncated or damaged
+    plan files.
+
+    File layout (little endian):
+        header      PLAN_HEADER
+        0101 LPL    lpl_0101_len bytes
+        frames      frame_count times FRAME_HEADER, the 8 command field
+                    bytes, lpl_len LPL bytes and epl_len EPL bytes
+    """
+    MAGIC = b"DFUP"
+    VERSION = 2
+
+    # magic, version, write command, payload size, sparse, image CRC, image
+    # header CRC, image size, frame count, bytes skipped, 0101 LPL length,
+    # body CRC
+    PLAN_HEADER = struct.Struct("<4sBHHBIIIIIII")
+
+    # image address, LPL length, EPL length
+    FRAME_HEADER = struct.Struct("<IHH")
+
+    def __init__(self, filename, contents):
+        self.filename = filename
+        self._contents = contents
+
+        (
+            _,
+            _,
+            self.write_cmd,
+            self.payload,
+            self.sparse,
+            self.image_crc,
+            self.header_crc,
+            self.image_size,
+            self.frame_count,
+            self.bytes_skipped,
+            lpl_0101_len,
+            _,
+        ) = self.PLAN_HEADER.unpack(bytes(contents[0:self.PLAN_HEADER.size]))
+
+        self._frames_offset = self.PLAN_HEADER.size + lpl_0101_len
+        self.lpl_0101 = bytes(contents[self.PLAN_HEADER.size:self._frames_offset])
+
+    @staticmethod
+    def path(plan_dir, image_crc, header_crc, image_size, write_cmd, payload, sparse):
+        """
+        Returns the file name of the plan for an image and transfer mode.
+        """
+        return os.path.join(plan_dir, "{:08x}_{:08x}_{}_{:04x}_{}{}.dfuplan".format(
+            image_crc, header_crc, image_size, write_cmd, payload, "_sparse" if sparse else ""))
+
+    @classmethod
+    def load(cls, filename, image_crc, header_crc, image_size, write_cmd, payload, sparse):
+        """
+        Map a plan file and return it, or None if there is no usable plan
+        for the image and transfer mode.
+        """
+        if not os.path.exists(filename):
+            return None
+
+        try:
+            contents = map_file(filename)
+        except (IOError, OSError):
+            return None
+
+        if len(contents) < cls.PLAN_HEADER.size:
+            return None
+
+        header = cls.PLAN_HEADER.unpack(bytes(contents[0:cls.PLAN_HEADER.size]))
+        if header[0:8] != (cls.MAGIC, cls.VERSION, write_cmd, payload, int(sparse), image_crc, header_crc,
+                           image_size):
+            return None
+
+        body_crc = header[-1]
+        if binascii.crc32(contents[cls.PLAN_HEADER.size:]) & 0xffffffff != body_crc:
+            return None
+
+        return cls(filename, contents)
+
+    @classmethod
+    def create(cls, filename, image_crc, header_crc, image_size, write_cmd, payload, sparse, lpl_0101, frames,
+               bytes_skipped):
+        """
+        Write the plan for a list of (image address, LPL, EPL, command
+        fields) frames.  The file is replaced atomically so that a plan is
+        never read half written.
+        """
+        body = bytearray(lpl_0101)
+        for image_address, lpl, epl, command_fields in frames:
+            epl = epl if epl is not None else bytearray(0)
+            body.extend(cls.FRAME_HEADER.pack(image_address, len(lpl), len(epl)))
+            body.extend(command_fields)
+            body.extend(lpl)
+            body.extend(epl)
+
+        header = cls.PLAN_HEADER.pack(cls.MAGIC, cls.VERSION, write_cmd, payload, int(sparse), image_crc,
+                                      header_crc, image_size, len(frames), bytes_skipped, len(lpl_0101),
+                                      binascii.crc32(body) & 0xffffffff)
+
+        path = os.path.dirname(filename)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+
+        temp_file = "{}.{}".format(filename, os.getpid())
+        with open(temp_file, "wb") as plan_file:
+            plan_file.write(header)
+            plan_file.write(body)
+        # os.replace doesn't exist in Python 2.7
+        getattr(os, "replace", os.rename)(temp_file, filename)
+
+    def __iter__(self):
+        return self.frames()
+
+    def frames(self):
+        """
+        Yield the (image address, LPL, EPL, command fields) frames as views
+        into the mapped plan.  EPL is None for 0103 frames.
+        """
+        contents = self._contents
+        offset = self._frames_offset
+        for _ in range(self.frame_count):
+            image_address, lpl_len, epl_len = self.FRAME_HEADER.unpack_from(contents, offset)
+            offset += self.FRAME_HEADER.size
+
+            command_fields = contents[offset:offset + CDB_COMMAND_FIELDS.size]
+            offset += CDB_COMMAND_FIELDS.size
+
+            lpl = contents[offset:offset + lpl_len]
+            offset += lpl_len
+
+            epl = contents[offset:offset + epl_len] if epl_len else None
+            offset += epl_len
+
+            yield image_address, lpl, epl, command_fields
+
+
+class _StreamedFrames(object):
+    """
+    Frames of a streamed download, built from the image each time they are
+    iterated.
+    """
+
+    def __init__(self, build):
+        self._build = build
+
+    def __iter__(self):
+        return iter(self._build())
+
+
+###################
+# Phase Scheduler #
+###################
+
+class PhaseScheduler(object):
+    """
+    Runs the stages of the upgrades of many ports, limiting how many ports
+    of a bus segment may be in a stage at the same time.
+
+    An upgrade goes through the stages in STAGES.  The transfer keeps the
+    bus busy, the other stages mostly wait for the module: the erase, the
+    reset after the restart and the retimer loading its firmware.  A limit
+    on the whole upgrade, e.g. "4 ports at a time", also holds a port while
+    it only waits.  A limit on the transfer stage alone lets any number of
+    ports wait while the limited number transfer, so on a crowded bus the
+    transfers of some ports overlap the waits of the others.
+
+    Stages without a limit are entered right away.  Each upgrader of the
+    ports has to be given the same scheduler.
+    """
+    STAGES = ("unlock", "erase", "transfer", "complete", "restart", "commit", "retimer-poll", "verify")
+
+    def __init__(self, limits=None, topology=None):
+        """
+        Args:
+            limits: dict: Stage -> ports per bus segment, e.g. {"transfer": 2}
+            topology: BusTopology: Bus segment of each port (firmware_bus),
+                without it all ports share one segment
+        """
+        self.limits = dict(limits or {})
+        self.topology = topology
+        self._lock = threading.Lock()
+        self._slots = {}
+
+        # Stage -> number of times entered, seconds spent waiting to enter
+        # and seconds spent in the stage, summed over the ports
+        self.stats = collections.OrderedDict(
+            (stage, {"count": 0, "queued": 0.0, "busy": 0.0}) for stage in self.STAGES)
+
+        # Port -> stage it is in
+        self.current = {}
+
+    @contextlib.contextmanager
+    def stage(self, port, stage):
+        """
+        Context manager running a stage of the upgrade of a port.
+        """
+        slots = self._stage_slots(port, stage)
+
+        queued = monotonic()
+        if slots is not None:
+            slots.acquire()
+        started = self._enter(port, stage, queued)
+        try:
+            yield
+        finally:
+            self._leave(port, stage, started)
+            if slots is not None:
+                slots.release()
+
+    def _enter(self, port, stage, queued):
+        """
+        Note that a port entered a stage and return the time it did.
+        """
+        started = monotonic()
+        with self._lock:
+            stats = self.stats.setdefault(stage, {"count": 0, "queued": 0.0, "busy": 0.0})
+            stats["count"] += 1
+            stats["queued"] += started - queued
+            self.current[port] = stage
+
+        return started
+
+    def _leave(self, port, stage, started):
+        """
+        Note that a port left a stage.
+        """
+        with self._lock:
+            self.stats[stage]["busy"] += monotonic() - started
+            self.current.pop(port, None)
+
+    def _stage_slots(self, port, stage):
+        """
+        Returns the semaphore limiting a stage on the segment of a port, or
+        None if the stage has no limit.
+        """
+        limit = self.limits.get(stage)
+        if not limit:
+            return None
+
+        segment = self.topology.segment(port)[0] if self.topology is not None else None
+        with self._lock:
+            key = (segment, stage)
+            if key not in self._slots:
+                self._slots[key] = self._new_slots(limit)
+
+            return self._slots[key]
+
+    def _new_slots(self, limit):
+        """
+        Returns a semaphore for limit ports.
+        """
+        return threading.BoundedSemaphore(limit)
+
+
+@contextlib.contextmanager
+def _no_stage():
+    """
+    Stage of an upgrader without a PhaseScheduler.
+    """
+    yield
+
+
+#################
+# Upgrade Steps #
+#################
+
+# The upgrade is written once, as generators of steps that don't do any I/O
+# or waiting themselves.  A generator yields what it needs done and the
+# engine running it sends back the result, or throws in the exception:
+#
+#   value = yield Io(function, *args)       call a blocking function
+#   yield Sleep(seconds)                     wait
+#   value = yield Steps(generator)           run nested steps
+#   value = yield Stage(stage, generator)    run nested steps in a stage, see PhaseScheduler
+#   yield Result(value)                      finish with a value
+#
+# FirmwareUpgrader runs the steps blocking, AsyncFirmwareUpgrader on an
+# event loop.  Generators can't return a value in Python 2.7, hence Result.
+
+class Io(object):
+    """
+    Step calling a blocking function, e.g. a driver transaction.
+    """
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+
+class Sleep(object):
+    """
+    Step waiting for a number of seconds.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class Steps(object):
+    """
+    Step running the steps of another generator.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+
+
+class Stage(Steps):
+    """
+    Step running the steps of another generator in a stage of the upgrade.
+    """
+
+    def __init__(self, stage, steps):
+        super(Stage, self).__init__(steps)
+        self.stage = stage
+
+
+class Result(object):
+    """
+    Last step of a generator, its value is the result of the steps.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+def next_step(steps, value=None, error=None):
+    """
+    Resume a generator of steps with the value or exception of its last
+    step.  Returns the next step, or a Result once the generator finished.
+    """
+    try:
+        if error is not None:
+            step = steps.throw(error)
+        else:
+            step = steps.send(value)
+    except StopIteration:
+        return Result(None)
+
+    if isinstance(step, Result):
+        steps.close()
+
+    return step
 
 
 class FirmwareUpgrader():
@@ -88,16 +980,52 @@ class FirmwareUpgrader():
     """
     upgrader_version = (1, 4)
     skip_status_check = False
+    progress_percent = 1
     module_state = None
     dfu_attempts = 3
+    # Delay before the second attempt, it doubles for every further attempt
+    dfu_attempt_delay = 0.5
+    use_epl = True
+    chunk_retries = 3
+    chunk_retry_delay = 0.005
+    # Driver exceptions of a failed bus transaction, e.g. a NACK.  A driver
+    # with its own exception for bus timeouts adds it here.
+    transient_errors = (IOError, OSError)
+    port = None
+    converge = False
+    plan_dir = None
+    image_cache = ImageCache()
+
+    # PhaseScheduler the stages of the upgrade are run through, if any
+    phases = None
+
+    # Images with more data than this are streamed: their frames are built
+    # one at a time from the mapped image instead of up front
+    stream_threshold = 256 * 1024
+
+    # Components upgraded for the component groups given by the user
+    GROUP_COMPONENTS = {
+        "ALL": ["MCU", "MSA", "DSP"],
+        "MCU": ["MCU", "MSA"],
+        "SUP": ["MCU"]
+    }
+    sparse_targets = ()
+    cdb_timing = CdbTimingProfile(os.path.join("al_logs", "cdb_timing.json"))
 
-    def __init__(self, driver_object, component, logger=None):
+    def __init__(self, driver_object, component, logger=None, chunk_size=64, port=None, phases=None):
         """
         Constructor.
 
         Args:
             driver_object: I2CDriver: driver object for communication
             component: string: one of the following: ["MCU", "MSA", "DSP", "SUP", "ALL"]
+            logger: Logger: where to log, defaults to a new log file in al_logs
+            chunk_size: int: largest I2C block transfer of the driver, the
+                constructor already reads the module with it
+            port: port of the module, keys the learned CDB timing and the
+                stages of the upgrade
+            phases: PhaseScheduler: scheduler the stages of the upgrade are
+                run through, including the unlock stage of the constructor
         Returns:
             An object of type 'FirmwareUpgrader' for a given component
         Raises:
@@ -111,6 +1039,7 @@ class FirmwareUpgrader():
                 "minor": 0,
                 "build": 0,
                 "active_image": "A",
+                "slots": {"A": None, "B": None},
                 "crc": bytearray(),
                 "filename": None
             },
@@ -138,17 +1067,9 @@ class FirmwareUpgrader():
 
         self.i2c_driver = driver_object
         self.group = component.upper()
-        self.components = []
 
         # The arguments from the user are group designations, rather than actual components
-        if self.group == "ALL":
-            self.components = ["MCU", "MSA", "DSP"]
-        elif self.group == "MCU":
-            self.components = ["MCU", "MSA"]
-        elif self.group == "SUP":
-            self.components = ["MCU"]
-        else:
-            self.components = [self.group]
+        self.components = list(self.GROUP_COMPONENTS.get(self.group, [self.group]))
 
         if logger is None:
             self.logger = logging.getLogger('firmware_upgrader')
@@ -175,23 +1096,99 @@ class FirmwareUpgrader():
         else:
             self.logger = logger
 
-        self.chunk_size = 64
+        self.chunk_size = chunk_size
+        self.port = port
+        self.phases = phases
+
+        # Download session state used to resume a transfer after a transient
+        # failure.  dfu_acked_address is the image address of the last
+        # 0103/0104 command acknowledged with a CDB status of 0x01.
+        self._dfu_session = None
+        self.dfu_acked_address = None
+        self.last_cdb_status = None
+
+        # Chunk retransmissions on this port, across all upgrades
+        self.retry_stats = {"retries": 0, "exhausted": 0}
+
+        # Bytes of erased (0xFF) data the last dfu() didn't send
+        self.dfu_bytes_skipped = 0
+
+        # Snapshot of register values, keyed by (page, offset), that read_int
+        # serves until the next write, reset, or CDB command
+        self._shadow = {}
+
+        self._prepare_module()
 
+    def _prepare_module(self):
+        """
+        Check that the module can be upgraded, unlock it and read the
+        firmware info.
+        """
+        with self._stage("unlock"):
+            self._run(self._prepare_steps())
+
+    def _prepare_steps(self):
+        """
+        Steps of _prepare_module().
+        """
         # Collect the starting module state to return to after DFU is complete
         try:
-            self.module_state = self.get_module_status()
+            self.module_state = yield Io(self.get_module_status)
         except:
             raise FirmwareUpgraderException("E999: I2C communication check failed.")
 
-        if self.read_int(2, 0x00) & 0x80:
+        module_flags = yield Io(self.read_int, 2, 0x00)
+        if module_flags & 0x80:
             raise FirmwareUpgraderException(
                 "E000: Firmware Upgrade not supported on target. Please check if module is Active.")
 
         # Unlock the system and initialize the firmware info dictionary
-        self.unlock_system()
+        yield Io(self.unlock_system)
         if "DSP" in self.components:
-            self.set_low_power_mode(False, wait=True)
-        self.update_firmware_info()
+            yield Steps(self._low_power_steps(False, wait=True))
+        yield Io(self.update_firmware_info)
+
+    def _stage(self, stage):
+        """
+        Returns a context manager running a stage of the upgrade, see
+        PhaseScheduler.
+        """
+        if self.phases is None:
+            return _no_stage()
+
+        return self.phases.stage(self.port, stage)
+
+    def _run(self, steps):
+        """
+        Run a generator of steps, blocking, and return its result.
+        """
+        step = next_step(steps)
+        while not isinstance(step, Result):
+            try:
+                value = self._perform(step)
+            except (FirmwareUpgraderException, Exception) as exc:
+                step = next_step(steps, error=exc)
+            else:
+                step = next_step(steps, value)
+
+        return step.value
+
+    def _perform(self, step):
+        """
+        Do what a step asks for and return its value.
+        """
+        if isinstance(step, Io):
+            return step.function(*step.args)
+
+        if isinstance(step, Sleep):
+            time.sleep(step.seconds)
+            return None
+
+        if isinstance(step, Stage):
+            with self._stage(step.stage):
+                return self._run(step.steps)
+
+        return self._run(step.steps)
 
     def get_upgrader_version(self):
         """
@@ -225,176 +1222,381 @@ class FirmwareUpgrader():
             DSP: <TARGET>_retimer_fw_v<MAJOR_VER>.<MINOR_VER>.<BUILD>.bin
 
         Args:
-            upgrade_file: String: path to folder containing upgrade binaries
+            upgrade_file: String: path to folder containing upgrade binaries, or to a firmware bundle
             verify: boolean: if true, needs to verify the firmware version after upgrade
             **kwargs: dict: vendor specific additional helper items
+                skip_status_check: boolean: use fixed delays instead of polling the CDB status
+                converge: boolean: only upgrade components that don't already run
+                    the version of their binary
         Returns:
             A dictionary with upgraded firmware version and CRC info
             Example: {'version': None, 'crc': None}
         Raises:
             FirmwareUpgraderException: An error occurred during the upgrade process
         """
+        return self._run(self._upgrade_firmware_steps(upgrade_file, verify, kwargs))
 
-        def upgrade_procedure():
-            expected_versions = {
-                "MCU": (0, 0, 0),
-                "MSA": (0, 0, 0),
-                "DSP": (0, 0, 0)
-            }
-            if "DSP" in self.components:
-                self.set_low_power_mode(False, wait=True)
-
-            # Initialize the version info
-            self.update_firmware_info()
+    def _upgrade_firmware_steps(self, upgrade_file, verify, kwargs):
+        """
+        Steps of upgrade_firmware(), see there for the arguments.
+        """
+        self._set_options(kwargs)
 
-            if not os.path.exists(upgrade_file):
-                self.logger.error("Invalid firmware location.")
-                raise FirmwareUpgraderException("E001: Invalid firmware location.")
+        # Attempt DFU 3 times and report last exception upon failure
+        attempts_remaining = self.dfu_attempts
+        error_occurred = False
+        exception = None
+        self._dfu_session = None
 
-            # Remove the filename and determine appropriate file internally
-            if os.path.isdir(upgrade_file):
-                fw_file = upgrade_file
+        while attempts_remaining > 0:
+            try:
+                yield Steps(self._upgrade_steps(upgrade_file, verify))
+            except (FirmwareUpgraderException, Exception) as exc:
+                exception = exc
+                error_occurred = True
+                self._attempt_failed(exc, attempts_remaining - 1)
             else:
-                fw_file = os.path.dirname(upgrade_file)
+                error_occurred = False
+                attempts_remaining = 0
+            finally:
+                attempts_remaining -= 1
 
-            if os.path.isdir(fw_file):
-                if self.fw_info["MCU"]["active_image"] == "A":
-                    mcu_file = self._find("*_module_fw_v*_b.bin", fw_file)
-                elif self.fw_info["MCU"]["active_image"] == "B":
-                    mcu_file = self._find("*_module_fw_v*_a.bin", fw_file)
-                msa_file = self._find("*_cmis_fw*_v*.bin", fw_file)
-                dsp_file = self._find("*_retimer_fw_v*.bin", fw_file)
-
-                self.fw_info["MCU"]["filename"] = os.path.abspath(mcu_file) if mcu_file else None
-                self.fw_info["MSA"]["filename"] = os.path.abspath(msa_file) if msa_file else None
-                self.fw_info["DSP"]["filename"] = os.path.abspath(dsp_file) if dsp_file else None
-            else:
-                raise FirmwareUpgraderException("E001: Invalid firmware location.")
+            if error_occurred and attempts_remaining > 0:
+                # Give a disturbed bus or a busy module time to recover, the
+                # frame retries of a transfer only cover short glitches
+                failed = self.dfu_attempts - attempts_remaining
+                yield Sleep(self.dfu_attempt_delay * (2 ** (failed - 1)))
 
-            # Do a DFU Abort in case a previous DFU was cut off during CDB 0103 transfers
-            self.dfu_abort()
+        yield Result(self._upgrade_result(error_occurred, exception))
 
-            for component in self.components:
-                if component == "MCU":
-                    file = self.fw_info["MCU"]["filename"]
-                elif component == "MSA":
-                    file = self.fw_info["MSA"]["filename"]
-                elif component == "DSP":
-                    file = self.fw_info["DSP"]["filename"]
-                else:
-                    FirmwareUpgraderException("E008: Invalid component.")
-
-                self.logger.info("Initiating FW upgrade using binary file: %s" % (file))
-
-                if verify:
-                    # Get the version information from the provided binary
-                    header = HeaderV1(file)
-                    header.load()
-                    exp_major, exp_minor, exp_build = header.get_version()
-                    expected_versions[component] = (exp_major, exp_minor, exp_build)
-
-                    # Hold onto original slot for verification purposes
-                    if component in ["MCU", "MSA"]:
-                        self.fw_info[component]["old_slot"] = self.get_active_image(component)
-
-                # Reformat the CRC value to a bytearray
-                crc_value = self.dfu(file)
-                self.fw_info[component]["crc"].append((crc_value >> 24) & 0xFF)
-                self.fw_info[component]["crc"].append((crc_value >> 16) & 0xFF)
-                self.fw_info[component]["crc"].append((crc_value >> 8) & 0xFF)
-                self.fw_info[component]["crc"].append(crc_value & 0xFF)
-                self.logger.info("File CRC: 0x%X", crc_value)
-
-            # Restart
-            if "MCU" in self.components:
-                self.dfu_restart()
-            else:
-                self.reset_module()
+    def _upgrade_steps(self, upgrade_file, verify):
+        """
+        Steps of one attempt of upgrade_firmware().
+        """
+        if self._dfu_session is not None:
+            # A transfer failed part way through an open download session.
+            # Skip the set up and continue from the last acknowledged address.
+            yield Steps(self._transfer_steps(self._dfu_session, verify))
+            return
+
+        actions = yield Stage("unlock", self._setup_steps(upgrade_file))
+
+        self._dfu_session = self._new_session(actions)
+        yield Steps(self._transfer_steps(self._dfu_session, verify))
+
+    def _setup_steps(self, upgrade_file):
+        """
+        Steps bringing the module to a state a download can start from.  The
+        result is the converge mode action of each component.
+        """
+        if "DSP" in self.components:
+            yield Steps(self._low_power_steps(False, wait=True))
+
+        # Initialize the version info
+        yield Io(self.update_firmware_info)
+
+        actions = yield Io(self._select_images, upgrade_file)
+
+        # Do a DFU Abort in case a previous DFU was cut off during CDB 0103 transfers
+        yield Steps(self._dfu_abort_steps())
+
+        yield Result(actions)
+
+    def _transfer_steps(self, session, verify):
+        """
+        Steps downloading the components of a session, restarting the module
+        and verifying the new versions.
+        """
+        for component in self.components:
+            if component in session["completed"]:
+                continue
+
+            if session["component"] == component:
+                # Continue the download session of this component with the
+                # frames already built for it
+                file = self.fw_info[component]["filename"]
+                self.logger.info("Resuming FW upgrade using binary file: %s" % (file))
+                crc_value = yield Steps(self._dfu_steps(file, resume_address=self.dfu_acked_address,
+                                                        transfer=session["transfer"]))
+                session["completed"].append(component)
+                self._record_crc(component, crc_value)
+                continue
+
+            # Loading an image may read and check all of it
+            file, header = yield Io(self._start_component, session, component, verify)
+            if header is None:
+                # Nothing to download, a switch happens with the restart below
+                session["completed"].append(component)
+                continue
+
+            session["component"] = component
+            session["transfer"] = yield Io(self._dfu_transfer, file, None, header)
+            crc_value = yield Steps(self._dfu_steps(file, transfer=session["transfer"]))
+            session["completed"].append(component)
+            self._record_crc(component, crc_value)
+
+        # All transfers are complete, so there is nothing left to resume
+        self._dfu_session = None
+
+        upgraded = self._upgraded_components(session)
+        if not upgraded:
+            self.logger.info("All components are current.")
+        else:
+            yield Stage("restart", self._restart_steps(upgraded))
+
+            if "MCU" in upgraded:
+                yield Stage("commit", self._dfu_commit_steps())
+
+            if "DSP" in upgraded:
+                yield Stage("retimer-poll", self._retimer_steps())
 
-            time.sleep(RESET_DELAY)
-            self.unlock_system()
+        yield Stage("verify", self._finish_steps(session, upgraded, verify))
 
-            if "MCU" in self.components:
-                self.dfu_commit()
+    def _restart_steps(self, upgraded):
+        """
+        Steps restarting the module into the upgraded components.
+        """
+        if "MCU" in upgraded:
+            yield Steps(self._dfu_restart_steps())
+        else:
+            yield Io(self.reset_module)
 
-            if "DSP" in self.components:
-                # Set the Taurus Firmware Load flag
-                self.write_int(221, 0xF0, 1)
+        yield Sleep(RESET_DELAY)
+        yield Io(self.unlock_system)
+
+    def _retimer_steps(self):
+        """
+        Steps loading the downloaded firmware into the retimer.
+        """
+        # Set the Taurus Firmware Load flag
+        yield Io(self.write_int, 221, 0xF0, 1)
 
-                self.set_low_power_mode(False)
+        yield Steps(self._low_power_steps(False))
 
-                # Wait for the DSP DFU to complete
-                if not self._poll_retimer():
-                    raise FirmwareUpgraderException("Retimer DFU timed out.")
+        # Wait for the DSP DFU to complete
+        success = yield Steps(self._poll_retimer_steps())
+        if not success:
+            raise FirmwareUpgraderException("Retimer DFU timed out.")
 
+    def _finish_steps(self, session, upgraded, verify):
+        """
+        Steps reading the new versions, returning the module to its starting
+        power mode and verifying the upgrade.
+        """
+        if upgraded:
             # Update the firmware version
-            self.update_firmware_info()
+            yield Io(self.update_firmware_info)
 
-            # Return the system to Low Power
-            if self.module_state != self.get_module_status():
-                if self.module_state == 1:
-                    self.set_low_power_mode(True)
-                else:
-                    self.set_low_power_mode(False, wait=True)
+        # Return the system to Low Power
+        module_state = yield Io(self.get_module_status)
+        if self.module_state != module_state:
+            if self.module_state == 1:
+                yield Steps(self._low_power_steps(True))
+            else:
+                yield Steps(self._low_power_steps(False, wait=True))
 
-            for component in self.components:
-                new_version = (
-                self.fw_info[component]["major"], self.fw_info[component]["minor"], self.fw_info[component]["build"])
-
-                if verify:
-                    # Make sure the slot has changed
-                    if component in ["MCU", "MSA"]:
-                        if self.fw_info[component]["old_slot"] == self.fw_info[component]["active_image"]:
-                            self.logger.error("Component: {}, Old Slot: {}, New Slot: {}".format(
-                                component, self.fw_info[component]["old_slot"], self.fw_info[component]["active_image"]
-                            ))
-                            raise FirmwareUpgraderException("E002: Version Verification failed. Incorrect slot.")
-
-                    if not self._assert_expected_version(expected_versions[component], new_version):
-                        print("Expected Version : {}.{}.{}".format(expected_versions[component][0],
-                                                                   expected_versions[component][1],
-                                                                   expected_versions[component][2]))
-                        print("New Version : {}.{}.{}".format(new_version[0], new_version[1], new_version[2]))
-                        raise FirmwareUpgraderException("E002: Version Verification failed. Unexpected version.")
-                    else:
-                        self.logger.info("{}: verified.".format(component.upper()))
-
-        # Check for vendor options
+        if verify:
+            self._verify_upgrade(session, upgraded)
+
+    def _set_options(self, kwargs):
+        """
+        Apply the vendor options given to upgrade_firmware().
+        """
         if "skip_status_check" in kwargs:
             if kwargs["skip_status_check"]:
                 self.skip_status_check = True
             else:
                 self.skip_status_check = False
 
-        # Attempt DFU 3 times and report last exception upon failure
-        attempts_remaining = self.dfu_attempts
-        error_occurred = False
-        exception = None
+        if "converge" in kwargs:
+            self.converge = bool(kwargs["converge"])
+
+    def _select_images(self, upgrade_file):
+        """
+        Pick the binary of every component from a firmware folder or bundle
+        and store it in the firmware info.  Returns the converge mode action
+        of each component, or an empty dictionary without converge mode.
+
+        Args:
+            upgrade_file: String: path to folder containing upgrade binaries, or to a firmware bundle
+        """
+        if not os.path.exists(upgrade_file):
+            self.logger.error("Invalid firmware location.")
+            raise FirmwareUpgraderException("E001: Invalid firmware location.")
+
+        # Remove the filename and determine appropriate file internally
+        if os.path.isdir(upgrade_file) or FirmwareBundle.is_bundle(upgrade_file):
+            fw_file = upgrade_file
+        else:
+            fw_file = os.path.dirname(upgrade_file)
+
+        if os.path.isdir(fw_file) or FirmwareBundle.is_bundle(fw_file):
+            # A firmware bundle is searched like a firmware directory
+            if os.path.isdir(fw_file):
+                catalog = FirmwareCatalog.for_path(fw_file)
+            else:
+                catalog = FirmwareBundle.open(fw_file)
+            if self.fw_info["MCU"]["active_image"] == "A":
+                mcu_file = catalog.find("MCU", "b")
+            elif self.fw_info["MCU"]["active_image"] == "B":
+                mcu_file = catalog.find("MCU", "a")
+            msa_file = catalog.find("MSA")
+            dsp_file = catalog.find("DSP")
+
+            self.fw_info["MCU"]["filename"] = os.path.abspath(mcu_file) if mcu_file else None
+            self.fw_info["MSA"]["filename"] = os.path.abspath(msa_file) if msa_file else None
+            self.fw_info["DSP"]["filename"] = os.path.abspath(dsp_file) if dsp_file else None
+        else:
+            raise FirmwareUpgraderException("E001: Invalid firmware location.")
+
+        actions = {}
+        if self.converge:
+            for component in self.components:
+                actions[component] = self._converge_action(component, self.fw_info[component]["filename"])
+
+        return actions
+
+    def _new_session(self, actions):
+        """
+        Returns the state of a new download session, used to resume the
+        transfers after a transient failure.
+
+        Args:
+            actions: dict: Converge mode action of each component
+        """
+        # Nothing of a new session was acknowledged yet
+        self.dfu_acked_address = None
+
+        return {
+            "expected_versions": {
+                "MCU": (0, 0, 0),
+                "MSA": (0, 0, 0),
+                "DSP": (0, 0, 0)
+            },
+            "actions": actions,
+            "component": None,
+            "transfer": None,
+            "completed": []
+        }
+
+    def _start_component(self, session, component, verify):
+        """
+        Load the binary of a component and note what verification needs to
+        know about it.  Returns the (filename, image) to download, with an
+        image of None if converge mode found nothing to download.
+
+        Args:
+            session: dict: Download session
+            component: string: MCU, MSA or DSP
+            verify: boolean: the firmware version is verified after the upgrade
+        """
+        if component not in ("MCU", "MSA", "DSP"):
+            raise FirmwareUpgraderException("E008: Invalid component.")
+        file = self.fw_info[component]["filename"]
+
+        # The acknowledged address of the previous component doesn't make a
+        # failure before this component's 0101 resumable
+        self.dfu_acked_address = None
+
+        action = session["actions"].get(component, "transfer")
+        if action == "current":
+            self.logger.info("{}: already running the version of {}, skipping.".format(component, file))
+        elif action == "switch":
+            self.logger.info("{}: inactive slot already holds the version of {}, switching slots."
+                             .format(component, file))
+        else:
+            self.logger.info("Initiating FW upgrade using binary file: %s" % (file))
+
+        # Load the binary once for both the verification and the
+        # transfer, other upgraders in the process share the image
+        header = self.image_cache.get(file)
+
+        if verify:
+            # Get the version information from the provided binary
+            session["expected_versions"][component] = tuple(header.get_version())
+
+            # Hold onto original slot for verification purposes
+            if component in ["MCU", "MSA"]:
+                self.fw_info[component]["old_slot"] = self.get_active_image(component)
 
-        while attempts_remaining > 0:
-            try:
-                upgrade_procedure()
-            except FirmwareUpgraderException as exc:
-                exception = exc
-                error_occurred = True
+        if action != "transfer":
+            return file, None
 
-                msg = exc.get_message()
-                explanation = exc.get_explanation()
+        return file, header
 
-                self.logger.error("Error: {}".format(msg))
-                self.logger.error("Reason: {}".format(explanation))
-                self.logger.error("Attempts remaining: {}".format(attempts_remaining - 1))
-            except Exception as exc:
-                exception = exc
-                error_occurred = True
+    def _upgraded_components(self, session):
+        """
+        Returns the components to restart and verify.  Components that
+        converge mode found already running the target version are left alone.
+        """
+        return [component for component in self.components
+                if session["actions"].get(component) != "current"]
 
-                self.logger.error("Error occurred during DFU: {}".format(exc.__str__()))
-                self.logger.error("Attempts remaining: {}".format(attempts_remaining - 1))
+    def _record_crc(self, component, crc_value):
+        """
+        Add the CRC of a downloaded image to the firmware info.
+        """
+        # Reformat the CRC value to a bytearray
+        self.fw_info[component]["crc"].append((crc_value >> 24) & 0xFF)
+        self.fw_info[component]["crc"].append((crc_value >> 16) & 0xFF)
+        self.fw_info[component]["crc"].append((crc_value >> 8) & 0xFF)
+        self.fw_info[component]["crc"].append(crc_value & 0xFF)
+        self.logger.info("File CRC: 0x%X", crc_value)
+
+    def _verify_upgrade(self, session, upgraded):
+        """
+        Check that the upgraded components run the versions of their
+        binaries, from the slot they weren't running before.
+        """
+        expected_versions = session["expected_versions"]
+
+        for component in self.components:
+            new_version = (
+            self.fw_info[component]["major"], self.fw_info[component]["minor"], self.fw_info[component]["build"])
+
+            # Make sure the slot has changed
+            if component in ["MCU", "MSA"] and component in upgraded:
+                if self.fw_info[component]["old_slot"] == self.fw_info[component]["active_image"]:
+                    self.logger.error("Component: {}, Old Slot: {}, New Slot: {}".format(
+                        component, self.fw_info[component]["old_slot"], self.fw_info[component]["active_image"]
+                    ))
+                    raise FirmwareUpgraderException("E002: Version Verification failed. Incorrect slot.")
+
+            if not self._assert_expected_version(expected_versions[component], new_version):
+                print("Expected Version : {}.{}.{}".format(expected_versions[component][0],
+                                                           expected_versions[component][1],
+                                                           expected_versions[component][2]))
+                print("New Version : {}.{}.{}".format(new_version[0], new_version[1], new_version[2]))
+                raise FirmwareUpgraderException("E002: Version Verification failed. Unexpected version.")
             else:
-                error_occurred = False
-                attempts_remaining = 0
-            finally:
-                attempts_remaining -= 1
+                self.logger.info("{}: verified.".format(component.upper()))
+
+    def _attempt_failed(self, exc, attempts_remaining):
+        """
+        Log a failed DFU attempt.  The download session is dropped if it
+        can't be resumed after the failure.
+        """
+        if isinstance(exc, FirmwareUpgraderException):
+            self.logger.error("Error: {}".format(exc.get_message()))
+            self.logger.error("Reason: {}".format(exc.get_explanation()))
+        else:
+            self.logger.error("Error occurred during DFU: {}".format(exc.__str__()))
+        self.logger.error("Attempts remaining: {}".format(attempts_remaining))
+
+        if self._dfu_session is not None and not self._dfu_resumable(exc):
+            # The download session can't be continued, start over from the 0101
+            self._dfu_session = None
+
+    def _upgrade_result(self, error_occurred, exception):
+        """
+        Save the learned CDB timing and return the firmware info of the
+        upgrade, or raise the exception of the last failed attempt.
+        """
+        # Keep the learned CDB timing for the next run
+        try:
+            self.cdb_timing.save()
+        except (IOError, OSError) as exc:
+            self.logger.warning("Unable to save CDB timing profile: {}".format(exc))
 
         if error_occurred:
             raise exception
@@ -416,6 +1618,11 @@ class FirmwareUpgrader():
         # Request the firmware info via CDB
         self.cdb_cmd(0x100)
 
+        # Snapshot every register read below with one block read per page
+        self._shadow_load(0x9F, 136, 177)
+        self._shadow_load(0x00, 39, 65)
+        self._shadow_load(0x01, 191, 206)
+
         # Read the firmware flags to determine running image
         firmware_flags = self.read_int(136, 0x9F)
         a_flags = firmware_flags & 0x0F
@@ -428,6 +1635,17 @@ class FirmwareUpgrader():
         else:
             raise FirmwareUpgraderException("E003: Invalid firmware flags.")
 
+        # Versions of the images in both slots, None when the slot is empty
+        for slot, flags, offset in (("A", a_flags, 138), ("B", b_flags, 174)):
+            if flags & 0x04:
+                self.fw_info["MCU"]["slots"][slot] = None
+            else:
+                self.fw_info["MCU"]["slots"][slot] = (
+                    self.read_int(offset, 0x9F),
+                    self.read_int(offset + 1, 0x9F),
+                    (self.read_int(offset + 2, 0x9F) << 8) | self.read_int(offset + 3, 0x9F)
+                )
+
         # We are using the CMIS spec defined version registers here for backward
         # compatibility, but these versions should match those in Page 01h, bytes
         # 128 and 129
@@ -540,8 +1758,7 @@ class FirmwareUpgrader():
         Args:
             file: string: DFU binary path
         """
-        image = HeaderV1(file)
-        image.load()
+        image = self.image_cache.get(file)
         _header_info = {
             "target": image.get_target(),
             "device_id": image.get_id(),
@@ -569,7 +1786,9 @@ class FirmwareUpgrader():
         """
         Perform a full software reset to the bootloader
         """
+        self._shadow_invalidate()
         self.i2c_driver.write(26, bytearray([0x08]), 0x00, 0)
+        self._page_invalidate()
 
     def get_module_status(self):
         """
@@ -595,8 +1814,14 @@ class FirmwareUpgrader():
           lp_mode: bool: True to move to Low Power Mode, False to move to Normal mode
           wait: bool: Block until target state is reached
         """
+        return self._run(self._low_power_steps(lp_mode, wait))
+
+    def _low_power_steps(self, lp_mode=True, wait=False):
+        """
+        Steps of set_low_power_mode().
+        """
         # self.i2c_driver.write(26, bytearray([0x00]), 0x00)
-        module_controls = self.read_int(26, 0x00)
+        module_controls = yield Io(self.read_int, 26, 0x00)
 
         if lp_mode:
             new_val = module_controls | 0x10
@@ -605,16 +1830,17 @@ class FirmwareUpgrader():
             new_val = module_controls & ~0x10
             target_state = 3
 
-        self.write_int(26, 0x00, new_val)
+        yield Io(self.write_int, 26, 0x00, new_val)
 
         if wait:
             for _ in range(8):
-                if self.get_module_status() == target_state:
-                    return True
-                time.sleep(1)
-            return False
-        else:
-            return True
+                module_state = yield Io(self.get_module_status)
+                if module_state == target_state:
+                    yield Result(True)
+                yield Sleep(1)
+            yield Result(False)
+
+        yield Result(True)
 
     ####################
     # Helper functions #
@@ -624,8 +1850,14 @@ class FirmwareUpgrader():
         """
         Send a 0102 abort firmware download command.
         """
+        self._run(self._dfu_abort_steps())
+
+    def _dfu_abort_steps(self):
+        """
+        Steps of dfu_abort().
+        """
         try:
-            self.cdb_cmd(0x0102)
+            yield Steps(self._cdb_cmd_steps(0x0102))
         except FirmwareUpgraderException as exc:
             logger.error("Previous attempt failed with: {}".format(exc.get_message()))
 
@@ -636,31 +1868,31 @@ class FirmwareUpgrader():
         Args:
             delay_ms: int: Delay period in milliseconds
         """
+        self._run(self._dfu_restart_steps(delay_ms))
 
-        def format_0109(reset_mode, reset_delay):
-            """
-            Return a byte array containing the reset mode and reset delay 0109
-            command.
-            """
-            # Struct format for the LPL data of a 0103 command
-            #   >   Big endian
-            #   B   Reserved (1 byte)
-            #   B   Reset mode (1 byte)
-            #   H   Reset delay (2 bytes)
-            format_str = ">BBH"
-
-            return struct.pack(format_str, 0, reset_mode, reset_delay)
-
+    def _dfu_restart_steps(self, delay_ms=100):
+        """
+        Steps of dfu_restart().
+        """
         # Send Run image
         self.logger.info("Resetting ...")
-        self.cdb_cmd(0x0109, lpl=format_0109(0, delay_ms))
+        try:
+            yield Steps(self._cdb_cmd_steps(0x0109, lpl=self._format_0109(0, delay_ms)))
+        finally:
+            self._page_invalidate()
 
     def dfu_commit(self):
         """
         Send a 010A commit image command.
         """
+        self._run(self._dfu_commit_steps())
+
+    def _dfu_commit_steps(self):
+        """
+        Steps of dfu_commit().
+        """
         self.logger.info("Committing image.")
-        self.cdb_cmd(0x010A)
+        yield Steps(self._cdb_cmd_steps(0x010A))
 
     def switch_slot(self, component=None):
         """
@@ -726,92 +1958,32 @@ class FirmwareUpgrader():
             rlpl_len: int: RLPL length
             verbose: bool: Display verbose output
         """
+        self._run(self._cdb_cmd_steps(cmd, lpl, rlpl_len))
 
-        def cdb_chk_code(data):
-            """
-            Given an iterable, return the 1's complement sum of the values.
-
-            Args:
-                data: list: Data to calculate the CDB check code
-            """
-            total = 0
-            for i in bytearray(data):
-                total += i
-            # Convert to 1's complement by subtracting from the largest byte.  We
-            # do this so that the number returned is positive in the range of 0 to
-            # 255.  That allows for the correct convertsion to hex for transmission.
-            chk_code = 255 - (total & 0x00FF)
-
-            return chk_code
-
-        def cdb_status(block=1):
-            """
-            Return the CDB status for the given inteface.
-
-            Args:
-                block: int: CDB block (1 or 2)
-            """
-            # Check the CDB status flag for a given block
-            if block == 1:
-                status = self.read_int(37, 0x0)
-            elif block == 2:
-                status = self.read_int(38, 0x0)
-            else:
-                raise FirmwareUpgraderException("E007: Invalid block {}".format(block))
-
-            return status
-
-        def wait_cdb(block=1, timeout=0.200):
-            """
-            Busy wait for a CDB command to complete for timeout seconds.
-            Returns True if the CDB command completed before the timeout, False otherwise.
-
-            Args:
-                block: int: CDB block (1 or 2)
-                timeout: int: Timeout period in seconds
-            """
-            if sys.version_info[:2] == (2, 7):
-                # TODO: Need to make sure this doesn't get stuck if time moves backwards during the execution
-                time_func = time.clock
-            elif sys.version_info[0] == 3:
-                time_func = time.monotonic
-            else:
-                raise Exception("Unsupported Python version: {}, requires 2.7 or 3.x".format(sys.version_info))
-
-            start = time_func()
-
-            status = cdb_status(block)
-
-            # Wait for CDB to become free (0x80 == busy)
-            while status & 0x80:
-                self.logger.debug("Waiting for CDB status to return 1, current status: {:04X}h".format(status))
-                if time_func() - start > timeout:
-                    return 0x00
+    def _cdb_cmd_steps(self, cmd=0x0, lpl=bytes(0), rlpl_len=0):
+        """
+        Steps of cdb_cmd().
+        """
+        self.logger.debug("CDB command: {:04X}h".format(cmd))
+        self.logger.debug(lpl)
 
-                time.sleep(0.002)
-                status = cdb_status(block)
+        command_fields = self._cdb_command_fields(cmd, lpl, rlpl_len)
 
-            return status
+        yield Steps(self._cdb_send_steps(cmd, lpl, command_fields))
 
-        self.logger.debug("CDB command: {:04X}h".format(cmd))
-        self.logger.debug(lpl)
+    def _cdb_command_fields(self, cmd, lpl=bytes(0), rlpl_len=0, epl_len=0):
+        """
+        Return the packed CDB command field block (bytes 128-135) for a
+        command with the given LPL data, including the CDB check code.
+        The check code does not cover EPL data.
 
-        # Struct format for the CDB command field block
-        #   >   Big endian
-        #   H   Command code (2 bytes)
-        #   H   EPL length (2 bytes)
-        #   B   LPL length (1 byte)
-        #   B   CdbChkCode (1 byte)
-        #   B   RLPLLen (1 byte)
-        #   B   RLPLChkCode (1 byte)
-        command_fields_format = ">HHBBBB"
-
-        # Struct format for the data covered by the check code
-        check_code_format = command_fields_format + "{}s".format(len(lpl))
-
-        epl_len = 0x0
+        Args:
+            cmd: int: CDB command
+            lpl: bytes: LPL data packet
+            rlpl_len: int: RLPL length
+            epl_len: int: Number of bytes staged in the EPL pages
+        """
         lpl_len = len(lpl)
-        cdb_check_code = 0x0
         rlpl_check_code = 0x0
 
         # TODO: Determine if rlpl_len should be included in the check code calculation for 0103h.
@@ -823,68 +1995,148 @@ class FirmwareUpgrader():
         # This implementation will NOT insert the length of the vendor data
         # into the check code calculation at byte 133.
 
-        # Pack the command fields and LPL data to calc the check code
-        # pylint:   disable=bad-continuation
-        data = struct.pack(check_code_format,
-                           cmd,
-                           epl_len,
-                           lpl_len,
-                           cdb_check_code,
-                           0x0,
-                           rlpl_check_code,
-                           lpl,
-                           )
-        # pylint:   enable=bad-continuation
+        # The check code covers the command fields, with the check code and
+        # RLPL length taken as zero, followed by the LPL data.
+        cdb_check_code = cdb_chk_code(
+            CDB_COMMAND_FIELDS.pack(cmd, epl_len, lpl_len, 0x0, 0x0, rlpl_check_code), lpl)
 
-        # Calc the check code
-        cdb_check_code = cdb_chk_code(data)
+        return CDB_COMMAND_FIELDS.pack(cmd, epl_len, lpl_len, cdb_check_code, rlpl_len, rlpl_check_code)
 
-        # Pack the final command fields wth the check code
-        # pylint:   disable=bad-continuation
-        command_fields = struct.pack(command_fields_format,
-                                     cmd,
-                                     epl_len,
-                                     lpl_len,
-                                     cdb_check_code,
-                                     rlpl_len,
-                                     rlpl_check_code,
-                                     )
-        # pylint:   enable=bad-continuation
+    def _cdb_send_steps(self, cmd, lpl, command_fields, epl=None):
+        """
+        Steps writing a prepared CDB command to the module and checking its
+        result.
 
-        if lpl_len:
-            # We're limited in the number of bytes that we can write in a
-            # single I2C transaction by the MKRZero.  The command will take
-            # effect when the command fields are written.  So we write all of
-            # the LPL data first and then the command fields to trigger it.
-            self.write_int(136, 0x9f, list(lpl))
-
-        self.write_int(128, 0x9f, list(command_fields))
-
-        # CDB 0101h commands performs a full erase of the target partition.
-        # The erase hangs the AHB bus, preventing I2C communication. So we
-        # need at most a 1.750s delay before continuing with I2C traffic.
-        # CDB 0103h commands perform flash writes. We give them a tiny
-        # amount of headroom to avoid any delays in acknowledging the
-        # subsequent status check for the same AHB bus reason above.
-        if (cmd == 0x0101):
-            time.sleep(1.750)
-        elif (cmd == 0x0103):
-            time.sleep(0.001)
-        # elif (cmd == 0x0107):
-        elif (cmd == 0x0107) or (cmd == 0x0100):
-            time.sleep(0.1)
+        Args:
+            cmd: int: CDB command
+            lpl: bytes: LPL data packet
+            command_fields: bytes: Packed command field block for the command
+            epl: bytes: EPL data packet, staged in pages A0h-AFh
+        """
+        issued = yield Io(self._cdb_write, lpl, command_fields, epl)
 
         # For quick DFUs, skip checking for the CDB Status. In this case,
-        # it's assumed the delays in the hardware are more than sufficient
-        # for the system to recover.
-        if not self.skip_status_check:
-            # Block until the command completesand get the result of the command
-            self.logger.debug("Checking CDB status for cmd: {:04X}h".format(cmd))
-            status = wait_cdb()
+        # it's assumed the default delays are more than sufficient for the
+        # system to recover.
+        if self.skip_status_check:
+            yield Sleep(CdbTimingProfile.DEFAULT_DELAYS.get(cmd, 0.0))
+            return
+
+        # Wait until the command completes and get the result of the command
+        self.logger.debug("Checking CDB status for cmd: {:04X}h".format(cmd))
+        status = yield Steps(self._wait_cdb_steps(cmd, issued))
+        self.last_cdb_status = status
+
+        # Check the result of the command
+        if status != 0x01:
+            raise FirmwareUpgraderException("E007: CMD {:04x} failed: 0x{:02x}".format(cmd, status))
+
+    def _cdb_write(self, lpl, command_fields, epl=None):
+        """
+        Write a prepared CDB command to the module and return the
+        monotonic() time it was issued.
+
+        Args:
+            lpl: bytes: LPL data packet
+            command_fields: bytes: Packed command field block for the command
+            epl: bytes: EPL data packet, staged in pages A0h-AFh
+        """
+        self.last_cdb_status = None
+
+        burst = getattr(self.i2c_driver, "burst", None)
+        if burst is not None:
+            # A driver scheduled on a shared bus (firmware_bus) holds the
+            # bus for the whole command, other ports don't interleave
+            with burst():
+                return self._cdb_write_block(lpl, command_fields, epl)
+
+        return self._cdb_write_block(lpl, command_fields, epl)
+
+    def _cdb_write_block(self, lpl, command_fields, epl=None):
+        """
+        Write the EPL, LPL and command fields of a CDB command, see _cdb_write().
+        """
+        if epl:
+            # Each EPL page holds 128 bytes of the payload in its upper half
+            for index in range(0, len(epl), 128):
+                self.write_int(128, CDB_EPL_PAGE + index // 128, epl[index:index + 128])
+
+        # The command fields (128-135) and the LPL (136-) are contiguous, so
+        # they are written as one block in as few chunk_size transactions as
+        # the driver allows.  The command will take effect when the command
+        # fields are written, so the transaction holding them goes out last,
+        # once the rest of the LPL data is in place.
+        block = bytearray(command_fields)
+        if lpl:
+            block.extend(lpl)
+
+        writes = [(index, block[index:index + self.chunk_size])
+                  for index in range(0, len(block), self.chunk_size)]
+
+        for index, chunk in writes[1:] + writes[:1]:
+            self.write_int(128 + index, 0x9f, chunk)
+
+        return monotonic()
+
+    def _cdb_status(self, block=1):
+        """
+        Return the CDB status for the given inteface.
 
-            # Check the result of the command
-            if status != 0x01:
-                raise FirmwareUpgraderException("E007: CMD {:04x} failed: 0x{:02x}".format(cmd, status))
+        Args:
+            block: int: CDB block (1 or 2)
+        """
+        # Check the CDB status flag for a given block
+        if block == 1:
+            status = self.read_int(37, 0x0)
+        elif block == 2:
+            status = self.read_int(38, 0x0)
+        else:
+            raise FirmwareUpgraderException("E007: Invalid block {}".format(block))
+
+        return status
+
+    def _wait_cdb_steps(self, cmd, issued, block=1):
+        """
+        Steps waiting for a CDB command to complete.  The first status poll
+        is made near the completion time learned for the command, after which
+        the poll interval backs off until the timeout from the timing profile.
+        The result is the CDB status, or 0x00 if the command is still busy at
+        the timeout.
+
+        Args:
+            cmd: int: CDB command
+            issued: float: monotonic() time the command was written
+            block: int: CDB block (1 or 2)
+        """
+        key = CdbTimingProfile.key(cmd, (getattr(self, "mcu_major", None), getattr(self, "mcu_minor", None)),
+                                   self.port)
+        delay, timeout = self.cdb_timing.schedule(cmd, key)
+        interval = CdbTimingProfile.POLL_INTERVAL
+
+        yield Sleep(delay)
+
+        while True:
+            try:
+                status = yield Io(self._cdb_status, block)
+            except self.transient_errors as exc:
+                # The module may not answer while a command (e.g. a 0101
+                # erase) holds its bus, so treat that as busy until timeout.
+                if monotonic() - issued > timeout:
+                    raise
+                self.logger.debug("CDB status read failed while busy: {}".format(exc))
+                status = 0x80
+
+            # Wait for CDB to become free (0x80 == busy)
+            if not status & 0x80:
+                self.cdb_timing.record(key, monotonic() - issued)
+                yield Result(status)
+
+            self.logger.debug("Waiting for CDB status to return 1, current status: {:04X}h".format(status))
+            if monotonic() - issued > timeout:
+                yield Result(0x00)
+
+            yield Sleep(interval)
+            interval = min(interval * 2, CdbTimingProfile.MAX_POLL_INTERVAL)
 
     def read_int(self, offset, page):
         """
@@ -897,6 +2149,11 @@ class FirmwareUpgrader():
         if page != 0 and offset >= 128:
             offset = offset - 128
 
+        if self._shadow:
+            output = self._shadow.get((page, offset))
+            if output is not None:
+                return output
+
         data = self.i2c_driver.read(page=page, offset=offset, count=1)
 
         try:
@@ -914,29 +2171,71 @@ class FirmwareUpgrader():
         Args:
             offset: int: Byte offset
             page: int: CMIS page
-            data: int|array: Data byte as integer or list
+            data: int|array: Data byte as integer, list, bytes, bytearray or memoryview
         """
-        if isinstance(data, list) == False:
+        self._shadow_invalidate()
+
+        if not isinstance(data, (list, bytes, bytearray, memoryview)):
             data = [data]
 
         if page != 0 and offset >= 128:
             offset = offset - 128
 
-        din = bytearray(data)
-        length = len(data)
+        if isinstance(data, bytearray):
+            din = data
+        else:
+            din = bytearray(data)
 
         # Break up data into chunks
-        out_buf = list(self._chunks(din, self.chunk_size))
-
-        for chunk in out_buf:
-            length = len(chunk)
-
+        for chunk in self._chunks(din, self.chunk_size):
             self.i2c_driver.write(page=page, offset=offset, data=chunk)
 
             # Update the offset
             offset = offset + self.chunk_size
 
-    def dfu(self, filename, limit=None, verbose=False):
+    def _shadow_load(self, page, first, last):
+        """
+        Read the registers first..last of a page as block reads of up to
+        chunk_size bytes and add them to the register shadow.
+
+        Args:
+            page: int: CMIS page
+            first: int: First byte offset
+            last: int: Last byte offset (inclusive)
+        """
+        if page != 0 and first >= 128:
+            first = first - 128
+            last = last - 128
+
+        for offset in range(first, last + 1, self.chunk_size):
+            count = min(self.chunk_size, last + 1 - offset)
+            data = self.i2c_driver.read(page=page, offset=offset, count=count)
+
+            try:
+                data = list(data)
+            except TypeError:
+                data = [data]
+
+            for index, value in enumerate(data):
+                self._shadow[(page, offset + index)] = value
+
+    def _page_invalidate(self):
+        """
+        Tell a page tracking driver that the module no longer has a known
+        page selected, e.g. after a reset.
+        """
+        invalidate_page = getattr(self.i2c_driver, "invalidate_page", None)
+        if invalidate_page is not None:
+            invalidate_page()
+
+    def _shadow_invalidate(self):
+        """
+        Drop the register shadow so read_int goes back to the module.
+        """
+        if self._shadow:
+            self._shadow = {}
+
+    def dfu(self, filename, limit=None, verbose=False, resume_address=None, image=None):
         """
         Open an image file and send it via CDB commands for DFU.
 
@@ -944,12 +2243,92 @@ class FirmwareUpgrader():
             filename: string: Path fo binary file
             limit: int: Limit as offset from start of file to use for DFU
             verbose: bool: Display verbose info
+            resume_address: int: Continue the open download session after
+                the command acknowledged at this image address instead of
+                starting a new one
+            image: HeaderV1: Already loaded image of filename
         Returns:
             CRC of the image file
         """
+        return self._run(self._dfu_steps(filename, limit, verbose, resume_address, image))
+
+    def _dfu_steps(self, filename, limit=None, verbose=False, resume_address=None, image=None, transfer=None):
+        """
+        Steps of dfu(), see there for the arguments.  transfer is the
+        download prepared by _dfu_transfer() for filename, if there is one.
+        """
+        if transfer is None:
+            transfer = yield Io(self._dfu_transfer, filename, limit, image)
+
+        if resume_address is None:
+            # Send the CDB command 0101h to start a firmware download
+            self.dfu_acked_address = None
+            yield Stage("erase", self._cdb_cmd_steps(0x0101, lpl=transfer["lpl_0101"]))
+            resume_address = -1
+        else:
+            self.logger.info("Resuming download after address 0x{:08X}".format(resume_address))
+
+        self.dfu_acked_address = resume_address
+
+        # Send a series of 0103/0104 commands with the image data
+        yield Stage("transfer", self._frame_steps(transfer, resume_address, verbose))
+
+        if limit is None:
+            # Send the Firmware Download Complete
+            yield Stage("complete", self._cdb_cmd_steps(0x0107))
+
+        yield Result(self._dfu_finished(transfer))
+
+    def _frame_steps(self, transfer, resume_address, verbose=False):
+        """
+        Steps sending the 0103/0104 frames of a download after the address
+        the module acknowledged last.
+        """
+        total = transfer["total"]
+        progress_step = self._progress_step(total)
+        count = 0
+        for image_address, lpl, epl, command_fields in transfer["frames"]:
+            # Show progress in non-verbose mode.  It only moves in
+            # progress_percent steps, so don't spend time on it for every
+            # frame.  Frames of erased data may be missing, so count by address.
+            count = image_address // transfer["payload"] + 1
+            if not verbose and (count % progress_step == 0 or count == total):
+                self._progress(count, total, "DFU")
+
+            # Skip the data the module already acknowledged
+            if image_address <= resume_address:
+                continue
+
+            # Send the data
+            yield Steps(self._send_frame_steps(transfer["write_cmd"], image_address, lpl, command_fields, epl))
+            self.dfu_acked_address = image_address
+
+        if not verbose and count != total:
+            self._progress(total, total, "DFU")
+
+    def _dfu_transfer(self, filename, limit=None, image=None):
+        """
+        Prepare the download of an image and return it as a dictionary:
+            image: HeaderV1: The image
+            write_cmd: int: 0103 or 0104
+            payload: int: Image bytes per frame
+            total: int: Number of frames, including left out erased frames
+            stream: bool: The frames are built while they are sent
+            sparse: bool: Erased (0xFF) frames are left out
+            lpl_0101: bytes: LPL of the 0101 command that starts the download
+            frames: iterable: (image address, LPL, EPL, command fields)
+                frames, can be iterated again to resume the download
+
+        Args:
+            filename: string: Path fo binary file
+            limit: int: Limit as offset from start of file to use for DFU
+            image: HeaderV1: Already loaded image of filename
+        """
         # Open a firmware image with a version 1 header
-        image_file = HeaderV1(filename)
-        image_file.load()
+        if image is None:
+            image = HeaderV1(filename)
+            image.load()
+        image_file = image
 
         # Get the data to send
         header_data = image_file.header()
@@ -961,43 +2340,200 @@ class FirmwareUpgrader():
         # Remove the state section from the data to send
         image_data = image_data[0:image_offset]
 
-        # Send the CDB command 0101h to start a firmware download
-        lpl = self._format_0101(len(image_data) + header_size, header_data)
-        self.cdb_cmd(0x0101, lpl=lpl)
+        # Use EPL writes (0104) when the module supports them, otherwise LPL
+        # writes (0103).
+        epl_size = self._epl_size()
+        if epl_size:
+            self.logger.info("Using EPL transfers of {} bytes.".format(epl_size))
+            write_cmd = 0x0104
+        else:
+            write_cmd = 0x0103
+        payload = epl_size or self.chunk_size
 
-        # Set the starting address we're writing to
-        image_address = 0
+        # The 0101 command erases the whole partition, so for the targets
+        # listed in sparse_targets the frames that only hold 0xFF are left out.
+        sparse = Header.MAP_TARGET_DEVICE_ARG.get(image_file.get_target()) in self.sparse_targets
 
         # For debugging allow the ability to not send the entire image
         if limit is not None:
             image_data = image_data[0:limit]
+        total = (len(image_data) + payload - 1) // payload
+
+        # Large images are streamed so that only the frame being sent is held
+        # in memory.  If the image CRC isn't known yet, it is calculated from
+        # the frames as they go by.
+        stream = len(image_data) > self.stream_threshold
+
+        # Reuse the stored plan of an earlier DFU of this image if there is
+        # one.  Otherwise build every frame up front so the transfer loop
+        # below only has to move bytes over I2C.
+        plan = None
+        plan_file = None
+        if self.plan_dir and limit is None and not stream:
+            # The header goes to the module in the 0101 LPL of the plan
+            header_crc = binascii.crc32(header_data) & 0xffffffff
+            plan_file = DfuPlan.path(self.plan_dir, image_file.get_crc(), header_crc, len(image_data), write_cmd,
+                                     payload, sparse)
+            plan = DfuPlan.load(plan_file, image_file.get_crc(), header_crc, len(image_data), write_cmd, payload,
+                                sparse)
+
+        if plan is not None:
+            self.logger.info("Using DFU plan {}".format(plan_file))
+            lpl_0101 = plan.lpl_0101
+            frames = plan
+            self.dfu_bytes_skipped = plan.bytes_skipped
+        else:
+            lpl_0101 = self._format_0101(len(image_data) + header_size, header_data)
 
-        # Send a series of 0103 commands with the image data
+            def build_frames():
+                if epl_size:
+                    frames = self._frames_0104(image_data, epl_size)
+                else:
+                    frames = self._frames_0103(image_data)
 
-        # Create a list of all of the chunks
-        segments = list(self._chunks(image_data, self.chunk_size))
-        count = 1
-        total = len(segments)
-        for i in segments:
-            # Show a progress bar in non-verbose mode.  If we're verbose, the
-            # cmis_self.cdb_cmd() method will do a hex dump of what it's sending.
-            if not verbose:
-                self._progress(count, total, "DFU")
-                count += 1
+                if stream and limit is None and image_file.get_data_crc() is None:
+                    frames = self._crc_frames(frames, image_file)
+
+                self.dfu_bytes_skipped = 0
+                if sparse:
+                    frames = self._drop_erased(frames)
+
+                return frames
+
+            # The frames of a stream are built again if the download is
+            # resumed, so they can be iterated more than once like a list
+            if stream:
+                frames = _StreamedFrames(build_frames)
+            else:
+                frames = list(build_frames())
+
+            if plan_file:
+                try:
+                    DfuPlan.create(plan_file, image_file.get_crc(), header_crc, len(image_data), write_cmd, payload,
+                                   sparse, lpl_0101, frames, self.dfu_bytes_skipped)
+                except (IOError, OSError) as exc:
+                    self.logger.warning("Unable to save DFU plan {}: {}".format(plan_file, exc))
+
+        if sparse and not stream:
+            self.logger.info("Skipping {} bytes of erased (0xFF) data.".format(self.dfu_bytes_skipped))
+
+        return {
+            "image": image_file,
+            "write_cmd": write_cmd,
+            "payload": payload,
+            "total": total,
+            "stream": stream,
+            "sparse": sparse,
+            "lpl_0101": lpl_0101,
+            "frames": frames
+        }
+
+    def _dfu_finished(self, transfer):
+        """
+        Report the end of a download and return the CRC of the image.
+        """
+        if transfer["sparse"] and transfer["stream"]:
+            self.logger.info("Skipped {} bytes of erased (0xFF) data.".format(self.dfu_bytes_skipped))
+
+        stats = getattr(self.i2c_driver, "stats", None)
+        if isinstance(stats, dict):
+            self.logger.info("I2C transactions: {}".format(
+                ", ".join("{} {}".format(key, stats[key]) for key in sorted(stats))))
+
+        return transfer["image"].get_crc()
+
+    def _frames_0103(self, image_data):
+        """
+        Split image data into chunk_size pieces and yield the
+        (image address, LPL, EPL, command fields) frames for the 0103
+        commands that send them.  0103 commands carry no EPL data.
+
+        Args:
+            image_data: bytes: Image data to send, without the state section
+        """
+        for image_address in range(0, len(image_data), self.chunk_size):
+            chunk = image_data[image_address:image_address + self.chunk_size]
 
             # Format the LPL data for a 0103 command
-            lpl = self._format_0103(image_address, i)
+            lpl = bytearray(self._format_0103(image_address, chunk))
+            command_fields = bytearray(self._cdb_command_fields(0x0103, lpl, rlpl_len=len(chunk)))
 
-            # Send the data
-            self.cdb_cmd(0x0103, lpl=lpl, rlpl_len=len(i), verbose=verbose)
+            yield image_address, lpl, None, command_fields
 
-            image_address += len(i)
+    def _frames_0104(self, image_data, epl_size):
+        """
+        Split image data into epl_size pieces and yield the
+        (image address, LPL, EPL, command fields) frames for the 0104
+        commands that send them.  The LPL of a 0104 command only holds the image address.
 
-        if limit is None:
-            # Send the Firmware Download Complete
-            self.cdb_cmd(0x0107)
+        Args:
+            image_data: bytes: Image data to send, without the state section
+            epl_size: int: Number of bytes that fit in the supported EPL pages
+        """
+        for image_address in range(0, len(image_data), epl_size):
+            epl = bytearray(image_data[image_address:image_address + epl_size])
+
+            lpl = bytearray(CDB_IMAGE_ADDRESS.pack(image_address))
+            command_fields = bytearray(self._cdb_command_fields(0x0104, lpl, epl_len=len(epl)))
+
+            yield image_address, lpl, epl, command_fields
+
+    def _frame_data(self, frame):
+        """
+        Returns the image data carried by a frame.  0104 frames carry it in
+        the EPL, 0103 frames after the image address in the LPL.
+        """
+        image_address, lpl, epl, command_fields = frame
+        if epl is not None:
+            return epl
+
+        return lpl[CDB_IMAGE_ADDRESS.size:]
 
-        return image_file.get_crc()
+    def _crc_frames(self, frames, image):
+        """
+        Yield the frames of a complete image and calculate the image CRC from
+        their data on the way.  The CRC is stored in the image once the last
+        frame was seen, so get_crc() doesn't read the image again.
+
+        Args:
+            frames: iterable: (image address, LPL, EPL, command fields) frames
+            image: HeaderV1: Image the frames were built from
+        """
+        crc = 0
+        for frame in frames:
+            crc = binascii.crc32(self._frame_data(frame), crc)
+            yield frame
+
+        image.set_data_crc(crc & 0xffffffff)
+
+    def _drop_erased(self, frames):
+        """
+        Leave out the frames whose image data is entirely 0xFF.  Only valid
+        right after a 0101 erase, when the module flash already holds 0xFF.
+        The number of bytes left out is added to dfu_bytes_skipped.
+
+        Args:
+            frames: iterable: (image address, LPL, EPL, command fields) frames
+        """
+        for frame in frames:
+            data = self._frame_data(frame)
+            if data.strip(b"\xff"):
+                yield frame
+            else:
+                self.dfu_bytes_skipped += len(data)
+
+    def _epl_size(self):
+        """
+        Return the number of EPL bytes available for a 0104 command, or 0
+        if EPL transfers are disabled or not advertised by the module.
+        """
+        if not self.use_epl:
+            return 0
+
+        # Page 01h, byte 163, bits 3-0: CdbMaxPagesEPL
+        max_pages_epl = self.read_int(163, 0x01) & 0x0F
+
+        return CDB_EPL_PAGES_SUPPORTED.get(max_pages_epl, 0) * 128
 
     def _format_0101(self, image_size, vendor_data):
         """
@@ -1018,45 +2554,128 @@ class FirmwareUpgrader():
         Return a byte array containing the address and lpl formatted for a
         0103 command.
         """
-        # Struct format for the LPL data of a 0103 command
+        # The LPL data of a 0103 command is the big endian image address
+        # (CDB_IMAGE_ADDRESS) followed by the data to write at that address.
+        return CDB_IMAGE_ADDRESS.pack(address) + pack_s(lpl)
+
+    def _format_0109(self, reset_mode, reset_delay):
+        """
+        Return a byte array containing the reset mode and reset delay 0109
+        command.
+        """
+        # Struct format for the LPL data of a 0109 command
         #   >   Big endian
-        #   I   Image size (4 bytes)
-        #   ?s  LPL data (variable length)
-        format_str = ">I{}s".format(len(lpl))
+        #   B   Reserved (1 byte)
+        #   B   Reset mode (1 byte)
+        #   H   Reset delay (2 bytes)
+        format_str = ">BBH"
+
+        return struct.pack(format_str, 0, reset_mode, reset_delay)
+
+    def _send_frame_steps(self, cmd, image_address, lpl, command_fields, epl=None):
+        """
+        Steps sending one 0103/0104 frame of a download.  Transient failures
+        are retried in place up to chunk_retries times, with a backoff
+        starting at chunk_retry_delay, before the failure is raised to the
+        session.
+
+        A frame that failed on I2C is sent again.  A frame that was still
+        busy at the timeout has been accepted by the module, so it is not
+        sent again but polled until it completes.
+        """
+        retries = 0
+        while True:
+            try:
+                if self.last_cdb_status == 0x00 and retries:
+                    # Still busy from the previous try, check if it has completed
+                    status = yield Io(self._cdb_status)
+                    if status & 0x80:
+                        self.last_cdb_status = 0x00
+                        raise FirmwareUpgraderException("E007: CMD {:04x} failed: 0x{:02x}".format(cmd, 0x00))
+                    self.last_cdb_status = status
+                    if status != 0x01:
+                        raise FirmwareUpgraderException("E007: CMD {:04x} failed: 0x{:02x}".format(cmd, status))
+                else:
+                    yield Steps(self._cdb_send_steps(cmd, lpl, command_fields, epl))
+                return
+            except (FirmwareUpgraderException, Exception) as exc:
+                if not self._transient_failure(exc):
+                    raise
+                if retries >= self.chunk_retries:
+                    self.retry_stats["exhausted"] += 1
+                    self.logger.error("Port {}: {:04X}h at 0x{:08X} failed after {} retries.".format(
+                        self.port, cmd, image_address, retries))
+                    raise
+
+                retries += 1
+                self.retry_stats["retries"] += 1
+                self.logger.warning("Port {}: retrying {:04X}h at 0x{:08X} ({} of {}): {}".format(
+                    self.port, cmd, image_address, retries, self.chunk_retries, exc))
+
+            yield Sleep(self.chunk_retry_delay * (2 ** (retries - 1)))
+
+    def _transient_failure(self, exc):
+        """
+        Returns True if the exception is a transient failure: an I2C error
+        (see transient_errors) or a CDB command that was still busy at the
+        timeout.  A CDB failure status means the module rejected the command,
+        any other exception is a bug and not retried.
+        """
+        if isinstance(exc, FirmwareUpgraderException):
+            return exc.get_message().startswith("E007") and self.last_cdb_status == 0x00
+
+        return isinstance(exc, self.transient_errors)
+
+    def _dfu_resumable(self, exc):
+        """
+        Returns True if the download session can be continued after the
+        given exception, False if the DFU needs a full restart.
+
+        Only transient failures after the 0101 was acknowledged are
+        resumable: I2C errors and CDB commands that were still busy at the
+        timeout.  A CDB failure status means the module rejected the
+        command, so the session is treated as aborted.
+        """
+        if self.dfu_acked_address is None:
+            return False
 
-        return struct.pack(format_str, address, lpl)
+        return self._transient_failure(exc)
 
-    def _poll_retimer(self):
+    def _poll_retimer_steps(self):
         """
-        Polls the retimer, waiting for it to return to the Ready State.
+        Steps polling the retimer, waiting for it to return to the Ready
+        State.
 
         Return: 0 on failure, 1 on success
         """
-        success = 0
+        self.logger.info("Updating DSP firmware...")
 
-        sys.stdout.write("Updating DSP firmware...\n")
-        sys.stdout.flush()
+        progress_step = self._progress_step(60)
 
         # Fails if retimer doesn't return to Ready in 1:20
         for i in range(0, 60):
             # Read the retimer status
-            status = self.get_module_status()
-
-            # Show progress bar
-            self._progress(i, 60, "DFU on Retimer")
+            status = yield Io(self.get_module_status)
 
             if status == 3:
-                success = 1
-
                 # Force the progress bar to jump to 100%
                 self._progress(100, 100, "DFU on Retimer")
-                break
+                yield Result(1)
+
+            # Show progress bar
+            if i % progress_step == 0:
+                self._progress(i, 60, "DFU on Retimer")
 
-            time.sleep(1)
+            yield Sleep(1)
 
-        self.logger.info("\n")
+        yield Result(0)
 
-        return success
+    def _progress_step(self, total):
+        """
+        Returns how many of total steps there are between two progress
+        updates, for updates every progress_percent.
+        """
+        return max(1, total * self.progress_percent // 100)
 
     def _progress(self, count, total, process):
         """
@@ -1075,20 +2694,37 @@ class FirmwareUpgrader():
             sys.stdout.write("\n")
             sys.stdout.flush()
 
-    def _find(self, pattern, path):
+    def _converge_action(self, component, filename):
         """
-        Find and return the first file starting from 'path' matching 'pattern'
+        Compare the version in the header of a binary with the module and
+        return what has to be done to run it:
+            "current": the component already runs the version
+            "switch": the inactive MCU slot holds the version, restart into it
+            "transfer": the binary has to be downloaded
+
+        The module doesn't report image CRCs, so versions are compared.
+
+        Args:
+            component: string: MCU, MSA or DSP
+            filename: string: Binary that would be downloaded for the component
         """
-        result = []
-        for root, dirs, files in os.walk(path):
-            for name in files:
-                if fnmatch.fnmatch(name, pattern):
-                    result.append(os.path.join(root, name))
+        if not filename:
+            return "transfer"
 
-        if not result:
-            return None
+        catalog = FirmwareBundle.containing(filename) or FirmwareCatalog.for_path(os.path.dirname(filename))
+        target = catalog.info(filename)["version"]
+
+        info = self.fw_info[component]
+        if self._assert_expected_version(target, (info["major"], info["minor"], info["build"])):
+            return "current"
+
+        if component == "MCU":
+            inactive = "B" if info["active_image"] == "A" else "A"
+            slot_version = info["slots"][inactive]
+            if slot_version is not None and self._assert_expected_version(target, slot_version):
+                return "switch"
 
-        return result[0]
+        return "transfer"
 
     def _assert_expected_version(self, expected, actual):
         """
@@ -1132,6 +2768,25 @@ def check_magic(actual, expected):
         )
 
 
+def map_file(filename):
+    """
+    Map a file read-only and return its contents without copying them.  This
+    is a memoryview of the map for Python 3.  Python 2.7 can't create a
+    memoryview of a map, so the map itself is returned.
+    """
+    with open(filename, "rb") as image:
+        try:
+            contents = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return pack_s(bytearray(0))
+
+    if sys.version_info[0] == 3:
+        return memoryview(contents)
+
+    return contents
+
+
 def pack_s(value):
     """
     Convert a bytearray to string for Python 2 or to a bytes object for Python
@@ -1251,6 +2906,11 @@ class HeaderV1(Header):
         ]
     )
 
+    # Files larger than this are mapped by load() instead of read, which is
+    # also the size from which FirmwareUpgrader streams an image.  A mapped
+    # file must not be overwritten in place while the image is in use.
+    map_threshold = 256 * 1024
+
     def __init__(self, filename, verbose=True):
         if sys.version_info[:2] == (2, 7):
             super(HeaderV1, self).__init__(filename, verbose)
@@ -1282,20 +2942,46 @@ class HeaderV1(Header):
         self._full_header = pack_s(bytearray(0))
         self._offset = 0
 
+        # CRC of self._data[0:self._offset], computed on first use
+        self._data_crc = None
+
+        # The header fields and CRCs are up to date with the image data
+        self._crc_current = False
+
         self._magic = Header.IMAGE_HEADER_MAGIC
         self._size = struct.calcsize(self.FORMAT)
         self._version = 1
 
-    def load(self, debug=False):
+    def load(self, debug=False, contents=None, data_crc=None):
         """
         Load the header and image data into memory.
+
+        contents        The contents of the image file, e.g. a view into a
+                        firmware bundle.  The file is mapped if not given.
+
+        data_crc        The CRC of the image data if it is already known, e.g.
+                        from a check of the same file.  get_crc() then doesn't
+                        read the image data.
         """
+        # Read the file, or map a large one once.  The image data and the
+        # state section of a mapped file are views into the map, only the
+        # small header is copied.  The path, size and mtime of the file
+        # identify it for the cache of state offsets.
+        state_key = None
+        if contents is None:
+            try:
+                stat = os.stat(self._filename)
+                if stat.st_size > self.map_threshold:
+                    contents = map_file(self._filename)
+                else:
+                    with open(self._filename, "rb") as image:
+                        contents = image.read()
+            except:
+                raise FirmwareUpgraderException("E001: File not found")
+            state_key = (os.path.abspath(self._filename), stat.st_size, stat.st_mtime)
+
         # Load the common header
-        try:
-            with open(self._filename, "rb") as image:
-                self._common_header = image.read(struct.calcsize(Header.FORMAT))
-        except:
-            raise FirmwareUpgraderException("E001: File not found")
+        self._common_header = bytes(contents[0:struct.calcsize(Header.FORMAT)])
 
         # Extract the components
         (
@@ -1312,16 +2998,15 @@ class HeaderV1(Header):
             raise FirmwareUpgraderException("E002: Can't read a version {} image header".format(self._version))
 
         # Load the full header and the image data
-        with open(self._filename, "rb") as image:
-            # Read the full header
-            self._full_header = image.read(self._size)
-            if debug:
-                self.logger.info("Header size: 0x{0:08x} ({0})".format(len(self._full_header)))
+        self._full_header = bytes(contents[0:self._size])
+        if debug:
+            self.logger.info("Header size: 0x{0:08x} ({0})".format(len(self._full_header)))
 
-            # Read the image data
-            self._data = image.read()
-            if debug:
-                self.logger.info("Data size: 0x{0:08x} ({0})".format(len(self._data)))
+        self._data = contents[self._size:]
+        self._data_crc = data_crc
+        self._crc_current = False
+        if debug:
+            self.logger.info("Data size: 0x{0:08x} ({0})".format(len(self._data)))
 
         # Unpack the header
         (
@@ -1341,19 +3026,13 @@ class HeaderV1(Header):
             self._pad,
         ) = struct.unpack(self.FORMAT, self._full_header)
 
-        # Create an instance of the state section for this image.  This will
-        # give the offset to the start of the state section if it exists.
-        try:
-            state = StateV1(self._filename)
-        except FirmwareUpgraderException as e:
-            # We don't really care if the state version is incorrect, we just
-            # need to know where the state section starts for purposes of
-            # calculating the CRC.
-            pass
+        # Find the state section of this image.  Images without one end at
+        # the end of the file.
+        state_offset = State.locate(contents, start=self._size, key=state_key)
 
         # We need to adjust the offset by the size of the header because the
         # CRC calculation is performed over the image data only.
-        self._offset = state.offset() - len(self._full_header)
+        self._offset = state_offset - len(self._full_header)
         if debug:
             self.logger.info("State offset: 0x{:08x}".format(self._offset))
 
@@ -1368,31 +3047,127 @@ class HeaderV1(Header):
         build           A 16 bit integer that is the build number.
 
         """
-        if major_version:
+        if major_version is not None:
             self._major_version = int(major_version)
 
-        if minor_version:
+        if minor_version is not None:
             self._minor_version = int(minor_version)
 
-        if build:
+        if build is not None:
             self._build = int(build)
 
         self._update_crc()
 
+    def set_id(self, image_id=None, image_target=None):
+        """
+        Set the firmware ID and target device and recalculate the header CRC.
+
+        image_id        A string describing the ID to set.  It must be a value
+                        of the MAP_FW_ID dictionary.
+
+        image_target    A string describing the target device.  It must be
+                        value of the MAP_TARGET_DEVICE dictionary.
+        """
+        if image_id:
+            try:
+                self._fw_identifier = self.MAP_FW_ID_ARG[image_id]
+            except KeyError:
+                raise FirmwareUpgraderException("E003: Unexpected id: '{}'".format(image_id))
+
+        if image_target:
+            try:
+                self._target_device = self.MAP_TARGET_DEVICE_ARG[image_target]
+            except KeyError:
+                raise FirmwareUpgraderException("E005: Unexpected target: '{}'".format(image_target))
+
+        self._update_crc()
+
     def get_version(self):
         """
         Returns the major, minor, and build versions of the current image
         """
         return self._major_version, self._minor_version, self._build
 
+    def get_data_crc(self):
+        """
+        Returns the CRC of the image data if it is already known, otherwise
+        None.  Unlike get_crc() this never reads the image data.
+        """
+        return self._data_crc
+
+    def set_data_crc(self, crc):
+        """
+        Set the CRC of the image data, e.g. calculated while the data was
+        sent, so get_crc() doesn't read the image data again.
+
+        crc             The CRC of the image data of the loaded image.
+        """
+        self._data_crc = crc
+        self._crc_current = False
+
+    def info(self):
+        """
+        Returns a dictionary of the header fields, as found in the header
+        after load() or raw().
+        """
+        return {
+            "magic": self._magic,
+            "header_version": self._version,
+            "header_size": self._size,
+            "target_device": self._target_device,
+            "fw_identifier": self._fw_identifier,
+            "major_version": self._major_version,
+            "minor_version": self._minor_version,
+            "build": self._build,
+            "image_size": self._image_size,
+            "image_crc": self._image_crc,
+            "git_sha": self._git_sha,
+            "header_crc": self._header_crc
+        }
+
     def get_crc(self):
         """
-        Returns the CRC for the loaded firmware image
+        Returns the CRC for the loaded firmware image.  The CRC over the image
+        data is only calculated once per load, and once it is known the image
+        isn't changed, so images shared between threads can be asked for it.
         """
-        self._update_crc()
+        if not self._crc_current:
+            self._update_crc()
 
         return self._image_crc
 
+    def check(self):
+        """
+        Verify the loaded image against its header: the image size, image
+        CRC and header CRC and, if the image has one, the state section.
+
+        Raises:
+            FirmwareUpgraderException: The image doesn't match its header
+        """
+        image_size, image_crc, header_crc = self._image_size, self._image_crc, self._header_crc
+        self._update_crc()
+
+        if image_size != self._image_size:
+            raise FirmwareUpgraderException("E004: Image size mismatch: header 0x{:08x}, data 0x{:08x}".format(
+                image_size, self._image_size))
+
+        if image_crc != self._image_crc:
+            raise FirmwareUpgraderException("E004: Image CRC mismatch: header 0x{:08x}, data 0x{:08x}".format(
+                image_crc, self._image_crc))
+
+        if header_crc != self._header_crc:
+            raise FirmwareUpgraderException("E004: Header CRC mismatch: header 0x{:08x}, data 0x{:08x}".format(
+                header_crc, self._header_crc))
+
+        state = self.state()
+        if len(state) >= struct.calcsize(State.FORMAT):
+            magic, version, _ = struct.unpack(State.FORMAT, bytes(state[0:struct.calcsize(State.FORMAT)]))
+            if magic != State.IMAGE_STATE_MAGIC:
+                raise FirmwareUpgraderException("E004: Invalid state section magic 0x{:08x}".format(magic))
+
+            if version != 1:
+                raise FirmwareUpgraderException("E002: Can't read a version {} state header".format(version))
+
     def get_target(self):
         """
         Returns the target device as a string (stm32, taurus, taurus1)
@@ -1420,6 +3195,7 @@ class HeaderV1(Header):
         with open(self._filename, "rb") as image:
             # Load the image data
             self._data = image.read()
+        self._data_crc = None
 
         # Set the file offset to the file size.  When we're creating a header,
         # we're assuming we're adding a header to a non-STM32 binary.  So it
@@ -1515,8 +3291,13 @@ class HeaderV1(Header):
         if debug:
             self.logger.info("Image size: 0x{0:08x} ({0})".format(len(image_data)))
 
+        # The image data doesn't change with the header fields, so its CRC is
+        # kept until the data is reloaded or update() asks for a new one
+        if self._data_crc is None:
+            self._data_crc = binascii.crc32(image_data) & 0xffffffff
+
         self._image_size = len(image_data)
-        self._image_crc = binascii.crc32(image_data) & 0xffffffff
+        self._image_crc = self._data_crc
 
         # Create a bytearray of the header with all of the values set so that
         # we can calculate the header CRC
@@ -1581,6 +3362,8 @@ class HeaderV1(Header):
             self._pad,
         ) = struct.unpack(self.FORMAT, self._full_header)
 
+        self._crc_current = True
+
     def update(self, image_id=None, image_target=None):
         """
         Update the image header information to write the CRC's and image size.
@@ -1591,25 +3374,10 @@ class HeaderV1(Header):
         image_target    A string describing the target device.  It must be
                         value of the MAP_TARGET_DEVICE dictionary.
         """
-        self._image_size = len(self._data[0:self._offset])
-        self._image_crc = binascii.crc32(self._data[0:self._offset]) & 0xffffffff
-
-        # Create a bytearray of the header with all of the values set so that
-        # we can calculate the header CRC
-
-        if image_id:
-            try:
-                self._fw_identifier = self.MAP_FW_ID_ARG[image_id]
-            except KeyError:
-                raise FirmwareUpgraderException("E003: Unexpected id: '{}'".format(image_id))
-
-        if image_target:
-            try:
-                self._target_device = self.MAP_TARGET_DEVICE_ARG[image_target]
-            except KeyError:
-                raise FirmwareUpgraderException("E005: Unexpected target: '{}'".format(image_target))
+        # Recalculate the CRC of the image data
+        self._data_crc = None
 
-        self._update_crc()
+        self.set_id(image_id, image_target)
 
     def write(self, filename=None):
         """
@@ -1620,8 +3388,16 @@ class HeaderV1(Header):
             if self._verbose:
                 self.logger.info("Updating {}".format(self._filename))
                 self.logger.info("{}".format(self))
+
+            # Patch the header in place through a map of the file, the image
+            # data is left alone
             with open(self._filename, "r+b") as image:
-                image.write(self._full_header)
+                contents = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_WRITE)
+                try:
+                    contents[0:len(self._full_header)] = self._full_header
+                    contents.flush()
+                finally:
+                    contents.close()
         else:
             with open(filename, "wb") as image:
                 image.write(self._full_header)
@@ -1636,10 +3412,18 @@ class HeaderV1(Header):
         """
         Return a tuple consisting of a byte array of the image data and the
         offset to where the CRC stops.  That is, the CRC only covers
-        data[0:offset].
+        data[0:offset].  After load() of a file larger than map_threshold the
+        image data is a read-only view of the mapped file.
         """
         return self._data, self._offset
 
+    def state(self):
+        """
+        Return the state section of the image data, empty if the image has
+        no state section.
+        """
+        return self._data[self._offset:self._offset + State.SECTION_SIZE]
+
 
 class State(object):
     """
@@ -1681,8 +3465,15 @@ class State(object):
     # the A or B image.
     #
     # offset = image_a_state - image_a
+    #
+    # Images built from other linker scripts are supported by locate(), which
+    # looks for the state section at every ALIGNMENT boundary if it isn't at
+    # OFFSET.
     OFFSET = 0x0803F800 - 0x0801C800
 
+    # State sections start on a flash page boundary
+    ALIGNMENT = 0x800
+
     # The FW_STATE values must match the fw_state_t enumeration.
     # pylint:   disable=bad-whitespace
     FW_STATE_IMAGE_DEFAULT = 0
@@ -1708,10 +3499,74 @@ class State(object):
     # Dictionary to convert a command line argument of the state to a value.
     MAP_FW_STATE_ARG = {value: key for key, value in MAP_FW_STATE.items()}
 
+    # State offsets found by locate(), by image
+    _offsets = {}
+    _offsets_lock = threading.Lock()
+
     def __init__(self, filename, verbose):
         self._filename = filename
         self._verbose = verbose
 
+    @classmethod
+    def locate(cls, contents, start=0, key=None):
+        """
+        Returns the offset of the state section in the contents of an image
+        file, or the size of the contents if it has no state section.
+
+        The state section is looked for at OFFSET first and then at every
+        ALIGNMENT boundary from the end of the image back to start, so that
+        images from any linker script are found.  Only a STATE_KEY followed
+        by a plausible version and size counts as a state section.
+
+        contents        The contents of the image file, a bytes like object
+                        or a view of a mapped file.
+
+        start           Offset to stop looking at, e.g. the header size.
+
+        key             Hashable that identifies the contents, e.g. the path,
+                        size and mtime of the file.  The offset found is
+                        cached under it.
+        """
+        if key is not None:
+            with cls._offsets_lock:
+                if key in cls._offsets:
+                    return cls._offsets[key]
+
+        offset = len(contents)
+        if cls._valid(contents, cls.OFFSET):
+            offset = cls.OFFSET
+        else:
+            # Comparing the aligned offsets only doesn't copy the contents
+            # and avoids false matches of the magic number inside the code
+            last = (len(contents) - struct.calcsize(cls.FORMAT)) // cls.ALIGNMENT * cls.ALIGNMENT
+            for candidate in range(last, start - 1, -cls.ALIGNMENT):
+                if candidate > start and cls._valid(contents, candidate):
+                    offset = candidate
+                    break
+
+        if key is not None:
+            with cls._offsets_lock:
+                cls._offsets[key] = offset
+
+        return offset
+
+    @classmethod
+    def _valid(cls, contents, offset):
+        """
+        Returns True if a state section header is at offset.
+        """
+        header_size = struct.calcsize(cls.FORMAT)
+        if offset < 0 or offset + header_size > len(contents):
+            return False
+
+        if bytes(contents[offset:offset + len(STATE_KEY)]) != STATE_KEY:
+            return False
+
+        magic, version, size = struct.unpack(cls.FORMAT, bytes(contents[offset:offset + header_size]))
+
+        # Version 1 is the only state section version there is
+        return version == 1 and header_size <= size < cls.SECTION_SIZE
+
 
 class StateV1(State):
     """
@@ -1753,19 +3608,18 @@ class StateV1(State):
         """
         Load the state section into memory if possible.
         """
-        with open(self._filename, "rb") as image:
-            data = image.read()
+        data = map_file(self._filename)
 
-        try:
-            # Save the state section
-            self._state = data[self._offset:self._offset + State.SECTION_SIZE]
-        except IndexError:
-            # Data read isn't large enough to have a state section, so set the
-            # offset to the data size
+        self._offset = State.locate(data)
+        if self._offset >= len(data):
+            # The image doesn't have a state section, so the offset is the
+            # data size
             self._state = None
-            self._offset = len(data)
             return
 
+        # Save the state section
+        self._state = bytes(data[self._offset:self._offset + State.SECTION_SIZE])
+
         # Extract the common header
         common_header = self._state[0:struct.calcsize(State.FORMAT)]
 
@@ -1897,3 +3751,501 @@ STATE_KEY = struct.pack(
     ),
     State.IMAGE_STATE_MAGIC
 )
+
+
+####################
+# Firmware Catalog #
+####################
+
+class FirmwareCatalog(object):
+    """
+    Index of the firmware images below a directory.
+
+    The directory tree is walked once and the images are indexed by
+    component and slot using the same file name patterns that the upgrader
+    always used, in os.walk order, so a lookup returns the file the old
+    walk would have found first.  The HeaderV1 of every image is read during
+    the walk, only the header and not the image data, to index the images
+    by component, slot and version and by component, slot and target too.
+
+    The catalog revalidates itself on every lookup: a changed directory
+    mtime triggers a rescan, and an image found by version or target whose
+    size or mtime changed, e.g. because it was stamped in place, has its
+    header read again.  Catalogs are shared by all upgraders in the process
+    through for_path().
+    """
+
+    # (component, slot, file name pattern)
+    PATTERNS = (
+        ("MCU", "a", "*_module_fw_v*_a.bin"),
+        ("MCU", "b", "*_module_fw_v*_b.bin"),
+        ("MSA", None, "*_cmis_fw*_v*.bin"),
+        ("DSP", None, "*_retimer_fw_v*.bin"),
+    )
+
+    _catalogs = {}
+    _catalogs_lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, path):
+        """
+        Returns the shared catalog for a directory.
+
+        Args:
+            path: string: Directory holding the firmware images
+        """
+        path = os.path.abspath(path)
+        with cls._catalogs_lock:
+            catalog = cls._catalogs.get(path)
+            if catalog is None:
+                catalog = cls(path)
+                cls._catalogs[path] = catalog
+
+        return catalog
+
+    def __init__(self, path):
+        """
+        Constructor.
+
+        Args:
+            path: string: Directory holding the firmware images
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+        # Directory mtimes seen by the last scan, None before the first one
+        self._dirs = None
+
+        # Image paths in walk order, keyed by (component, slot)
+        self._images = {}
+
+        # Header information keyed by path, with the (size, mtime) it was
+        # read at.  The information is None if the header can't be read.
+        self._headers = {}
+
+        # Image paths in walk order, keyed by (component, slot, version) and
+        # by (component, slot, target)
+        self._versions = {}
+        self._targets = {}
+
+    def find(self, component, slot=None, version=None, target=None):
+        """
+        Returns the first image for a component and slot, or None.
+
+        Args:
+            component: string: MCU, MSA or DSP
+            slot: string: "a" or "b" for the MCU, None otherwise
+            version: tuple: Only return an image with this (major, minor, build)
+            target: string: Only return an image for this target device
+        """
+        with self._lock:
+            self._validate()
+
+            if version is None and target is None:
+                images = self._images.get((component, slot))
+                return images[0] if images else None
+
+            filename = self._lookup(component, slot, version, target)
+            if filename is None or not self._current(filename):
+                # An image may have been changed in place
+                self._refresh(component, slot)
+                filename = self._lookup(component, slot, version, target)
+
+        return filename
+
+    def info(self, filename):
+        """
+        Returns a dictionary with the id, target and version of an image.
+
+        Args:
+            filename: string: Path of the image
+        """
+        filename = os.path.abspath(filename)
+        with self._lock:
+            if not self._current(filename):
+                self._read_header(filename)
+                for (component, slot), images in self._images.items():
+                    if filename in images:
+                        self._index(component, slot)
+
+            info = self._headers[filename][1]
+            if info is None:
+                raise FirmwareUpgraderException("E004: Invalid image header: {}".format(filename))
+
+            return info
+
+    def _validate(self):
+        """
+        Rescan the directory tree if it changed since the last scan.
+        """
+        if self._dirs is not None:
+            try:
+                changed = any(os.stat(directory).st_mtime != mtime for directory, mtime in self._dirs.items())
+            except OSError:
+                changed = True
+
+            if not changed:
+                return
+
+        dirs = {}
+        images = {}
+        for root, _, files in os.walk(self.path):
+            dirs[root] = os.stat(root).st_mtime
+            for name in files:
+                for component, slot, pattern in self.PATTERNS:
+                    if fnmatch.fnmatch(name, pattern):
+                        images.setdefault((component, slot), []).append(os.path.join(root, name))
+
+        self._dirs = dirs
+        self._images = images
+
+        headers = self._headers
+        self._headers = {}
+        for filename in set(itertools.chain(*images.values())):
+            if filename in headers:
+                self._headers[filename] = headers[filename]
+            if not self._current(filename):
+                self._read_header(filename)
+
+        self._versions = {}
+        self._targets = {}
+        for component, slot in images:
+            self._index(component, slot)
+
+    def _lookup(self, component, slot, version, target):
+        """
+        Returns the first indexed image with a version and target, or None.
+        """
+        if version is not None:
+            images = self._versions.get((component, slot, tuple(version)), ())
+        else:
+            images = self._targets.get((component, slot, target), ())
+
+        for filename in images:
+            if target is None or self._headers[filename][1]["target"] == target:
+                return filename
+
+        return None
+
+    def _refresh(self, component, slot):
+        """
+        Read the headers of the images of a component and slot again if
+        their files changed.
+        """
+        changed = False
+        for filename in self._images.get((component, slot), ()):
+            if not self._current(filename):
+                self._read_header(filename)
+                changed = True
+
+        if changed:
+            self._index(component, slot)
+
+    def _index(self, component, slot):
+        """
+        Index the images of a component and slot by version and target.
+        """
+        for index in (self._versions, self._targets):
+            for key in [key for key in index if key[0:2] == (component, slot)]:
+                del index[key]
+
+        for filename in self._images.get((component, slot), ()):
+            info = self._headers[filename][1]
+            if info is not None:
+                self._versions.setdefault((component, slot, info["version"]), []).append(filename)
+                self._targets.setdefault((component, slot, info["target"]), []).append(filename)
+
+    def _current(self, filename):
+        """
+        Returns True if the header information of an image was read from
+        the file as it is now.
+        """
+        cached = self._headers.get(filename)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+
+        return cached is not None and cached[0] == (stat.st_size, stat.st_mtime)
+
+    def _read_header(self, filename):
+        """
+        Read the header information of an image, without its image data.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            raise FirmwareUpgraderException("E001: File not found")
+
+        header = HeaderV1(filename, verbose=False)
+        info = None
+        try:
+            header.raw()
+            fields = header.info()
+            if fields["magic"] == Header.IMAGE_HEADER_MAGIC and fields["header_version"] == 1:
+                info = {
+                    "id": header.get_id(),
+                    "target": header.get_target(),
+                    "version": header.get_version()
+                }
+        except (struct.error, KeyError):
+            # A file shorter than a header, or an unknown id or target
+            pass
+
+        self._headers[filename] = ((stat.st_size, stat.st_mtime), info)
+
+
+###################
+# Firmware Bundle #
+###################
+
+class FirmwareBundle(object):
+    """
+    Single file holding all images of a firmware release.
+
+    A bundle starts with BUNDLE_HEADER, followed by a JSON manifest and the
+    image files themselves.  The manifest lists every image with its
+    component, slot, HeaderV1 id, target and version, image data CRC and
+    its byte offset and size in the bundle.  Images are read as views into
+    the mapped bundle.  Every image is checked against its header and its
+    manifest CRC once per bundle file, when open() first returns it.
+
+    Images in a bundle are addressed like files in a directory named after
+    the bundle, e.g. EM200QDX.0.52.0.fwb/em200qdx_cmis_fw_v0.52.0.bin, so
+    the upgrader can treat a bundle like a firmware directory.
+    """
+    MAGIC = b"DFUB"
+    VERSION = 1
+
+    # magic, version, manifest length
+    BUNDLE_HEADER = struct.Struct("<4sBI")
+
+    _bundles = {}
+    _bundles_lock = threading.Lock()
+
+    def __init__(self, filename):
+        """
+        Constructor.
+
+        Args:
+            filename: string: Path of the bundle
+        """
+        self.filename = os.path.abspath(filename)
+        self._contents = map_file(self.filename)
+
+        magic, version, manifest_len = self.BUNDLE_HEADER.unpack(
+            bytes(self._contents[0:self.BUNDLE_HEADER.size]))
+        if magic != self.MAGIC:
+            raise FirmwareUpgraderException("E001: Not a firmware bundle: {}".format(self.filename))
+
+        if version != self.VERSION:
+            raise FirmwareUpgraderException("E002: Can't read a version {} firmware bundle".format(version))
+
+        start = self.BUNDLE_HEADER.size
+        self.manifest = json.loads(bytes(self._contents[start:start + manifest_len]).decode("utf-8"))
+        self._entries = dict((entry["name"], entry) for entry in self.manifest["images"])
+
+    @classmethod
+    def is_bundle(cls, filename):
+        """
+        Returns True if the file is a firmware bundle.
+
+        Args:
+            filename: string: Path of the file
+        """
+        try:
+            with open(filename, "rb") as bundle_file:
+                return bundle_file.read(len(cls.MAGIC)) == cls.MAGIC
+        except (IOError, OSError):
+            return False
+
+    @classmethod
+    def open(cls, filename):
+        """
+        Returns the checked bundle of a file, shared by all upgraders in the
+        process until the file changes.
+
+        Args:
+            filename: string: Path of the bundle
+
+        Raises:
+            FirmwareUpgraderException: An image of the bundle is corrupted
+        """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        key = (filename, stat.st_size, stat.st_mtime)
+
+        # The result of the check is kept as well, so a corrupted bundle
+        # isn't checked again by every upgrader
+        with cls._bundles_lock:
+            bundle = cls._bundles.get(filename)
+            if bundle is None or bundle[0] != key:
+                try:
+                    opened = cls(filename)
+                    opened.check()
+                    bundle = (key, opened, None)
+                except FirmwareUpgraderException as exc:
+                    bundle = (key, None, exc.get_message())
+                cls._bundles[filename] = bundle
+
+        if bundle[2] is not None:
+            raise FirmwareUpgraderException(bundle[2])
+
+        return bundle[1]
+
+    @classmethod
+    def containing(cls, filename):
+        """
+        Returns the bundle an image path points into, or None if the path
+        isn't inside a bundle.
+
+        Args:
+            filename: string: Path of the image
+        """
+        path = os.path.dirname(os.path.abspath(filename))
+        if os.path.isfile(path) and cls.is_bundle(path):
+            return cls.open(path)
+
+        return None
+
+    @classmethod
+    def create(cls, filename, path):
+        """
+        Bundle the images in a firmware directory.  Every image is checked
+        against its header before it is added.
+
+        Args:
+            filename: string: Path of the bundle to write
+            path: string: Firmware directory
+        """
+        images = []
+        for root, _, files in os.walk(path):
+            for name in files:
+                for component, slot, pattern in FirmwareCatalog.PATTERNS:
+                    if fnmatch.fnmatch(name, pattern):
+                        images.append((component, slot, os.path.join(root, name)))
+
+        entries = []
+        names = set()
+        for component, slot, image_file in images:
+            name = os.path.basename(image_file)
+            if name in names:
+                raise FirmwareUpgraderException("E001: Duplicate image name in bundle: {}".format(name))
+            names.add(name)
+
+            image = HeaderV1(image_file, verbose=False)
+            image.load()
+            image.check()
+
+            entries.append({
+                "name": name,
+                "component": component,
+                "slot": slot,
+                "id": image.get_id(),
+                "target": image.get_target(),
+                "version": list(image.get_version()),
+                "crc": image.get_crc(),
+                "size": os.path.getsize(image_file),
+                "offset": 0
+            })
+
+        # The image offsets depend on the manifest size, which depends on the
+        # offsets, so lay the images out until the manifest size is stable.
+        manifest_len = 0
+        while True:
+            offset = cls.BUNDLE_HEADER.size + manifest_len
+            for entry in entries:
+                entry["offset"] = offset
+                offset += entry["size"]
+
+            manifest = json.dumps({"version": cls.VERSION, "images": entries}, sort_keys=True).encode("utf-8")
+            if len(manifest) == manifest_len:
+                break
+            manifest_len = len(manifest)
+
+        temp_file = "{}.{}".format(filename, os.getpid())
+        with open(temp_file, "wb") as bundle_file:
+            bundle_file.write(cls.BUNDLE_HEADER.pack(cls.MAGIC, cls.VERSION, manifest_len))
+            bundle_file.write(manifest)
+            for _, _, image_file in images:
+                with open(image_file, "rb") as image:
+                    bundle_file.write(image.read())
+
+        # os.replace doesn't exist in Python 2.7
+        getattr(os, "replace", os.rename)(temp_file, filename)
+
+    def check(self):
+        """
+        Verify every image of the bundle against its header and the CRC in
+        the manifest, which image() hands to the upgraders.
+
+        Raises:
+            FirmwareUpgraderException: An image doesn't match
+        """
+        for entry in self.manifest["images"]:
+            image = HeaderV1(os.path.join(self.filename, entry["name"]), verbose=False)
+            try:
+                image.load(contents=self._contents[entry["offset"]:entry["offset"] + entry["size"]])
+                image.check()
+            except FirmwareUpgraderException as exc:
+                raise FirmwareUpgraderException("E004: Bundle image {}: {}".format(entry["name"], exc.get_message()))
+            except Exception as exc:
+                # An invalid header magic
+                raise FirmwareUpgraderException("E004: Bundle image {}: {}".format(entry["name"], exc))
+
+            if image.get_crc() != entry["crc"]:
+                raise FirmwareUpgraderException("E004: Bundle image {}: CRC mismatch: manifest 0x{:08x}, "
+                                                "data 0x{:08x}".format(entry["name"], entry["crc"], image.get_crc()))
+
+    def find(self, component, slot=None):
+        """
+        Returns the path of the first image for a component and slot, or None.
+
+        Args:
+            component: string: MCU, MSA or DSP
+            slot: string: "a" or "b" for the MCU, None otherwise
+        """
+        for entry in self.manifest["images"]:
+            if entry["component"] == component and entry["slot"] == slot:
+                return os.path.join(self.filename, entry["name"])
+
+        return None
+
+    def info(self, filename):
+        """
+        Returns a dictionary with the id, target and version of an image.
+
+        Args:
+            filename: string: Path of the image inside the bundle
+        """
+        entry = self._entry(filename)
+
+        return {
+            "id": entry["id"],
+            "target": entry["target"],
+            "version": tuple(entry["version"])
+        }
+
+    def image(self, filename):
+        """
+        Returns the loaded HeaderV1 image of a bundle member.  The image data
+        is a view into the bundle and the CRC is taken from the manifest.
+
+        Args:
+            filename: string: Path of the image inside the bundle
+        """
+        entry = self._entry(filename)
+
+        image = HeaderV1(os.path.join(self.filename, entry["name"]))
+        image.load(contents=self._contents[entry["offset"]:entry["offset"] + entry["size"]], data_crc=entry["crc"])
+
+        return image
+
+    def _entry(self, filename):
+        """
+        Returns the manifest entry of an image.
+        """
+        try:
+            return self._entries[os.path.basename(filename)]
+        except KeyError:
+            raise FirmwareUpgraderException("E001: File not found")
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Fixtures for the tests of the upgrade engine: firmware images and a
+simulated CMIS module behind a fake I2C driver.
+"""
+import logging
+import os
+import random
+import struct
+import sys
+import time
+
+import pytest
+
+# The modules of gui4dfu import each other by their plain names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import firmware_upgrader  # noqa: E402
+
+
+class FakeModule(object):
+    """
+    CMIS module accepting the CDB firmware download commands.  The images
+    it receives are kept in images_done as (fw identifier, image data).
+
+    A write fails with IOError while fail_next is non zero, and fail_count
+    writes from the one numbered fail_at fail, like NACKs on the bus.  Reads fail while
+    the module erases, as the erase hangs its bus.
+    """
+    # Time the module is busy after a CDB command, by command
+    BUSY = {0x0100: 0.001, 0x0101: 0.01, 0x0103: 0.0005, 0x0104: 0.001, 0x0107: 0.002}
+
+    def __init__(self, epl_pages=0):
+        self.lower = bytearray(128)
+        self.pages = {}
+        # Module ready, firmware version 0.52.7 in image A
+        self.lower[3] = 3 << 1
+        self.lower[39] = 0
+        self.lower[40] = 52
+        self.lower[64] = 0
+        self.lower[65] = 7
+        self.lower[37] = 0x01
+        page = self.page(0x01)
+        page[202 - 128] = 0x01
+        page[204 - 128:207 - 128] = bytearray([1, 2, 3])
+        page[194 - 128] = 227
+        page[196 - 128] = 36
+        page[163 - 128] = epl_pages
+        self.active = "A"
+        self.slots = {"A": (0, 52, 7), "B": None}
+        self.session = None
+        self.pending = []
+        self.commands = []
+        self.images_done = []
+        self.writes = 0
+        self.fail_next = 0
+        self.fail_at = None
+        self.fail_count = 1
+        self.busy_cmd = None
+        self.busy_until = 0
+
+    def page(self, page):
+        return self.pages.setdefault(page, bytearray(128))
+
+    def _locate(self, offset, page):
+        # The upper half of a page is addressed from 0 or from 128
+        if page == 0 and offset < 128:
+            return self.lower, offset
+        return self.page(page), offset % 128
+
+    def read(self, offset, page, count=1):
+        if time.time() < self.busy_until:
+            if self.busy_cmd == 0x0101:
+                raise IOError("Bus hung by the erase")
+            if page == 0 and offset == 37:
+                return [0x80]
+        memory, start = self._locate(offset, page)
+        return list(memory[start:start + count])
+
+    def write(self, offset, data, page):
+        self.writes += 1
+        if self.fail_next:
+            self.fail_next -= 1
+            raise IOError("NACK")
+        if self.fail_at is not None and 0 <= self.writes - self.fail_at < self.fail_count:
+            raise IOError("NACK at write {}".format(self.writes))
+
+        data = bytes(bytearray(data))
+        memory, start = self._locate(offset, page)
+        memory[start:start + len(data)] = data
+        if page == 0x9F and start <= 1 < start + len(data):
+            self._execute()
+
+        if page == 0 and offset == 26 and data[0] & 0x08:
+            # A software reset starts the pending CMIS image
+            for _, major, minor, build in [pending for pending in self.pending if pending[0] == "MSA"]:
+                self._run_msa(major, minor, build)
+            self.pending = [pending for pending in self.pending if pending[0] != "MSA"]
+
+    def _run_msa(self, major, minor, build):
+        page = self.page(0x01)
+        page[202 - 128] = 0x02 if page[202 - 128] & 0x01 else 0x01
+        page[204 - 128:207 - 128] = bytearray([major, minor, build & 0xFF])
+
+    def _execute(self):
+        page = self.page(0x9F)
+        cmd, epl_len, lpl_len, chk_code, _, _ = struct.unpack(">HHBBBB", bytes(page[0:8]))
+        lpl = bytes(page[8:8 + lpl_len])
+        self.commands.append(cmd)
+
+        status = 0x01
+        if firmware_upgrader.cdb_chk_code(page[0:5], b"\x00\x00", page[7:8], lpl) != chk_code:
+            status = 0x45
+        elif cmd == 0x0100:
+            page[8] = 0x01 if self.active == "A" else 0x10
+            for slot, offset, shift in (("A", 10, 0), ("B", 46, 4)):
+                version = self.slots[slot]
+                if version is None:
+                    page[8] |= 0x04 << shift
+                else:
+                    page[offset:offset + 4] = bytearray([version[0], version[1], version[2] >> 8,
+                                                         version[2] & 0xFF])
+        elif cmd == 0x0101:
+            self.session = {"size": struct.unpack(">I", lpl[0:4])[0], "header": lpl[8:], "data": {}}
+        elif cmd in (0x0103, 0x0104):
+            if self.session is None:
+                status = 0x46
+            else:
+                address = struct.unpack(">I", lpl[0:4])[0]
+                if cmd == 0x0103:
+                    payload = lpl[4:]
+                else:
+                    payload = b"".join(bytes(self.page(0xA0 + index)) for index in range(16))[:epl_len]
+                self.session["data"][address] = payload
+        elif cmd == 0x0107:
+            self._complete()
+        elif cmd == 0x0102:
+            self.session = None
+        elif cmd == 0x0109:
+            self._run_images()
+
+        self.lower[37] = status
+        self.busy_cmd = cmd
+        self.busy_until = time.time() + self.BUSY.get(cmd, 0)
+
+    def _complete(self):
+        session = self.session
+        image = bytearray(b"\xff" * (session["size"] - len(session["header"])))
+        for address, payload in session["data"].items():
+            image[address:address + len(payload)] = payload
+
+        header = bytearray(session["header"])
+        fw_id, major, minor = header[7], header[8], header[9]
+        build = header[10] | (header[11] << 8)
+        self.images_done.append((fw_id, bytes(image)))
+        if fw_id in (1, 2):
+            self.slots["B" if self.active == "A" else "A"] = (major, minor, build)
+            self.pending.append(("MCU", major, minor, build))
+        elif fw_id == 3:
+            self.pending.append(("MSA", major, minor, build))
+        else:
+            page = self.page(0x01)
+            page[194 - 128:198 - 128] = bytearray([major, minor, build & 0xFF, build >> 8])
+
+    def _run_images(self):
+        if not any(pending[0] == "MCU" for pending in self.pending):
+            other = "B" if self.active == "A" else "A"
+            if self.slots[other]:
+                self.pending.append(("MCU",) + self.slots[other])
+        for component, major, minor, build in self.pending:
+            if component == "MCU":
+                self.active = "B" if self.active == "A" else "A"
+                self.lower[39:41] = bytearray([major, minor])
+                self.lower[64:66] = bytearray([build >> 8, build & 0xFF])
+            else:
+                self._run_msa(major, minor, build)
+        self.pending = []
+
+
+class FakeDriver(object):
+    """
+    I2C driver of a FakeModule, with the page select of a real module.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.page = 0
+
+    def _select(self, offset, page):
+        if page is None:
+            return 0 if offset < 128 else self.page
+        if page != 0 or offset >= 128:
+            self.page = page
+        return page
+
+    def read(self, offset, page, count=1):
+        return self.module.read(offset, self._select(offset, page), count)
+
+    def write(self, offset, data, page, *args):
+        if page is None and offset == 127:
+            self.page = data[0] if isinstance(data, (list, bytes, bytearray)) else data
+        return self.module.write(offset, data, self._select(offset, page))
+
+
+def make_image(filename, image_id, target, data):
+    """
+    Write an image file with a HeaderV1 for version 0.52.7.
+    """
+    with open(filename, "wb") as image_file:
+        image_file.write(data)
+
+    firmware_upgrader.HeaderV1(filename, verbose=False).create(image_id, target)
+
+    image = firmware_upgrader.HeaderV1(filename, verbose=False)
+    image.load()
+    image.set_version(0, 52, 7)
+    image.update()
+    image.write()
+
+
+@pytest.fixture
+def firmware_dir(tmp_path):
+    """
+    Firmware directory with MCU, CMIS and retimer images.
+    """
+    rand = random.Random(1)
+    path = tmp_path / "firmware"
+    path.mkdir()
+
+    def data(size, erased=0):
+        return bytes(bytearray(rand.getrandbits(8) for _ in range(size))) + b"\xff" * erased
+
+    make_image(str(path / "em200qdx_module_fw_v0.52.7_a.bin"), "a", "stm32", data(3000, 1000))
+    make_image(str(path / "em200qdx_module_fw_v0.52.7_b.bin"), "b", "stm32", data(3000, 1000))
+    make_image(str(path / "em200qdx_cmis_fw_v1.2.3.bin"), "crs", "stm32", data(500))
+    make_image(str(path / "em200qdx_retimer_fw_v227.0.36.bin"), "taurus_qdd", "taurus", data(5000))
+
+    return path
+
+
+@pytest.fixture
+def fast_upgrader(monkeypatch, tmp_path):
+    """
+    Shorten the delays of the upgrader to the timing of a FakeModule, and
+    keep the learned CDB timing and logs out of the working directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(firmware_upgrader, "RESET_DELAY", 0)
+    monkeypatch.setattr(firmware_upgrader.CdbTimingProfile, "DEFAULT_DELAYS",
+                        {0x0100: 0.001, 0x0101: 0.02, 0x0103: 0.0005, 0x0104: 0.001, 0x0107: 0.002})
+    monkeypatch.setattr(firmware_upgrader.FirmwareUpgrader, "cdb_timing", firmware_upgrader.CdbTimingProfile())
+    monkeypatch.setattr(firmware_upgrader.FirmwareUpgrader, "dfu_attempt_delay", 0.01)
+    monkeypatch.setattr(firmware_upgrader.FirmwareUpgrader, "image_cache", firmware_upgrader.ImageCache())
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("test_dfu")
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests of the cable pairing of the station slots.
+"""
+import threading
+import time
+
+from TestMonitor import CableMonitor
+
+
+def test_slot_outside_every_cable_is_its_own_cable():
+    monitor = CableMonitor([(1, 2)])
+
+    assert monitor.cable(1) == (1, 2)
+    assert monitor.cable(2) == (1, 2)
+    assert monitor.cable(5) == (5,)
+    assert monitor.wait(5, timeout=0)
+
+
+def test_wait_times_out_while_the_other_end_runs():
+    monitor = CableMonitor([(1, 2)])
+    monitor.finish(1, True)
+
+    started = time.time()
+    assert not monitor.wait(1, timeout=0.05)
+    assert time.time() - started >= 0.05
+    assert not monitor.result(1)
+
+
+def test_wait_wakes_when_the_other_end_finishes():
+    monitor = CableMonitor([(1, 2)])
+    threading.Timer(0.01, monitor.finish, args=(2, True)).start()
+
+    started = time.time()
+    assert monitor.wait(1, timeout=5)
+    assert time.time() - started < 1
+
+
+def test_cable_passes_when_every_end_passes():
+    monitor = CableMonitor([(1, 2), (3, 4)])
+    monitor.finish(1, True)
+    monitor.finish(2, True)
+    monitor.finish(3, True)
+    monitor.finish(4, False)
+
+    assert monitor.result(1) and monitor.result(2)
+    assert not monitor.result(3) and not monitor.result(4)
+
+
+def test_cable_is_reported_once_per_run():
+    monitor = CableMonitor([(1, 2)])
+
+    assert monitor.claim_report(2)
+    assert not monitor.claim_report(1)
+
+    monitor.finish(1, True)
+    monitor.reset()
+    assert monitor.claim_report(1)
+    assert not monitor.wait(2, timeout=0)
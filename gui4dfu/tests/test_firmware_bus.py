@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests of the bus topology and the transaction slots of BusScheduler.
+"""
+import threading
+import time
+
+from firmware_bus import BusScheduler, BusTopology, ScheduledDriver
+
+
+def new_scheduler():
+    topology = BusTopology()
+    for port in range(1, 5):
+        topology.add(port, "i2c-34", "i2c-{}".format(40 + port))
+    topology.add(5, "i2c-35")
+
+    return BusScheduler(topology)
+
+
+def segment_state(busy=False, channel=None, batch=0, waiting=None):
+    return {"busy": busy, "channel": channel, "batch": batch, "waiting": waiting or {}}
+
+
+def test_topology():
+    topology = BusTopology()
+    topology.add(1, "i2c-34", "i2c-41")
+    topology.add(2, "i2c-34", "i2c-42")
+    topology.add(3, "i2c-35")
+
+    assert topology.segment(1) == ("i2c-34", "i2c-41")
+    assert topology.segment(9) == (("port", 9), None)
+    assert topology.segments() == {"i2c-34": [1, 2], "i2c-35": [3]}
+    assert BusTopology.parse("/sys/devices/i2c-34/i2c-41/41-0050/eeprom") == ("i2c-34", "i2c-41")
+    assert BusTopology.parse("/sys/devices/i2c-35/35-0050/eeprom") == ("i2c-35", None)
+
+
+def test_busy_segment_is_not_granted():
+    scheduler = new_scheduler()
+
+    assert not scheduler._grantable(segment_state(busy=True, channel="a"), "a")
+    assert not scheduler._grantable(segment_state(busy=True, channel="a"), "b")
+
+
+def test_selected_channel_is_granted_until_its_batch_is_used_up():
+    scheduler = new_scheduler()
+    last = scheduler.max_batch - 1
+
+    assert scheduler._grantable(segment_state(channel="a", batch=last, waiting={"b": 1}), "a")
+    assert not scheduler._grantable(segment_state(channel="a", batch=last + 1, waiting={"b": 1}), "a")
+    # Nobody else waits, so the batch goes on
+    assert scheduler._grantable(segment_state(channel="a", batch=last + 1, waiting={"a": 2}), "a")
+
+
+def test_channel_switches_once_the_selected_channel_is_done():
+    scheduler = new_scheduler()
+
+    assert scheduler._grantable(segment_state(), "a")
+    assert scheduler._grantable(segment_state(channel="a", batch=1), "b")
+    assert not scheduler._grantable(segment_state(channel="a", batch=1, waiting={"a": 1}), "b")
+    assert scheduler._grantable(segment_state(channel="a", batch=scheduler.max_batch, waiting={"a": 1}), "b")
+
+
+def test_segments_are_independent():
+    scheduler = new_scheduler()
+
+    with scheduler.slot(1):
+        done = threading.Event()
+        thread = threading.Thread(target=lambda: (scheduler.acquire(5), scheduler.release(5), done.set()))
+        thread.start()
+        assert done.wait(1)
+        thread.join()
+
+    assert scheduler.stats["waits"] == 0
+
+
+def test_waiting_ports_are_batched_by_channel():
+    scheduler = new_scheduler()
+    scheduler.max_batch = 2
+    order = []
+    lock = threading.Lock()
+
+    def transactions(port, count):
+        for _ in range(count):
+            with scheduler.slot(port):
+                with lock:
+                    order.append(port)
+                time.sleep(0.001)
+
+    # Port 1 holds the segment until ports 2 and 3 wait on other channels
+    scheduler.acquire(1)
+    threads = [threading.Thread(target=transactions, args=(port, 4)) for port in (2, 3)]
+    for thread in threads:
+        thread.start()
+    while scheduler.stats["waits"] < 2:
+        time.sleep(0.001)
+    scheduler.release(1)
+    for thread in threads:
+        thread.join()
+
+    assert sorted(order) == [2] * 4 + [3] * 4
+    # A channel keeps the segment for up to max_batch slots in a row
+    runs = [1]
+    for previous, port in zip(order, order[1:]):
+        if port == previous:
+            runs[-1] += 1
+        else:
+            runs.append(1)
+    assert max(runs) <= scheduler.max_batch
+    assert scheduler.stats["slots"] == 9
+    assert scheduler.stats["channel_switches"] == len(runs)
+
+
+def test_scheduled_driver_holds_one_slot_per_burst():
+    scheduler = new_scheduler()
+    calls = []
+
+    class Driver(object):
+        name = "fake"
+
+        def read(self, offset, page, count=1):
+            calls.append(("read", offset, page, count))
+            return [0] * count
+
+        def write(self, offset, data, page, *args):
+            calls.append(("write", offset, page))
+
+    driver = ScheduledDriver(Driver(), scheduler, 1)
+    with driver.burst():
+        driver.write(128, [1], 0x9f)
+        assert driver.read(37, 0) == [0]
+    driver.read(0, 0, 2)
+
+    assert calls == [("write", 128, 0x9f), ("read", 37, 0, 1), ("read", 0, 0, 2)]
+    assert scheduler.stats["slots"] == 2
+    assert driver.name == "fake"
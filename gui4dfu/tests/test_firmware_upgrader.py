@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests of the upgrade engine against a simulated module.
+"""
+import os
+import struct
+
+import pytest
+
+import firmware_async
+from conftest import FakeDriver, FakeModule
+from firmware_upgrader import (CDB_COMMAND_FIELDS, DfuPlan, FirmwareBundle, FirmwareUpgrader,
+                               FirmwareUpgraderException, HeaderV1, State, cdb_chk_code)
+
+
+def image_data(filename):
+    """
+    Returns the data of an image file without its header.
+    """
+    image = HeaderV1(str(filename), verbose=False)
+    image.load()
+
+    return bytes(image.data()[0])
+
+
+def state_header(size=8):
+    return struct.pack("<IBBB", State.IMAGE_STATE_MAGIC, 1, size, 0)
+
+
+#######
+# CDB #
+#######
+
+def test_cdb_chk_code_is_ones_complement_of_the_byte_sum():
+    assert cdb_chk_code(b"\x01\x00\x00\x00\x00\x00\x00\x00") == 0xFE
+    assert cdb_chk_code(b"") == 0xFF
+    assert cdb_chk_code(b"\xff\x01") == 0xFF
+
+
+def test_cdb_chk_code_spans_blocks():
+    header = bytearray(b"\x01\x03\x00\x00\x24\x00\x00\x00")
+    lpl = bytearray(range(36))
+
+    chk_code = cdb_chk_code(header, lpl)
+
+    assert chk_code == cdb_chk_code(header + lpl)
+    assert (sum(header + lpl) + chk_code) & 0xFF == 0xFF
+
+
+#############
+# DFU Plans #
+#############
+
+def plan_frames():
+    fields = b"\x5a" * CDB_COMMAND_FIELDS.size
+    return [
+        (0, b"\x00\x00\x00\x00" + b"\x11" * 32, None, fields),
+        (32, b"\x00\x00\x00\x20", b"\x22" * 2048, fields),
+        (2080, b"\x00\x00\x08\x20" + b"\x33" * 8, None, fields),
+    ]
+
+
+def test_dfu_plan_round_trip(tmp_path):
+    args = (0x12345678, 0x9abcdef0, 2088, 0x0104, 2048, True)
+    filename = DfuPlan.path(str(tmp_path / "plans"), *args)
+
+    DfuPlan.create(filename, *args, lpl_0101=b"\x01" * 40, frames=plan_frames(), bytes_skipped=512)
+    plan = DfuPlan.load(filename, *args)
+
+    assert plan is not None
+    assert (plan.write_cmd, plan.payload, plan.sparse) == (0x0104, 2048, 1)
+    assert (plan.image_crc, plan.header_crc, plan.image_size) == args[0:3]
+    assert (plan.frame_count, plan.bytes_skipped) == (3, 512)
+    assert plan.lpl_0101 == b"\x01" * 40
+
+    frames = [(address, bytes(lpl), None if epl is None else bytes(epl), bytes(fields))
+              for address, lpl, epl, fields in plan]
+    assert frames == plan_frames()
+
+
+def test_dfu_plan_of_another_image_is_not_loaded(tmp_path):
+    args = (0x12345678, 0x9abcdef0, 2088, 0x0104, 2048, True)
+    filename = DfuPlan.path(str(tmp_path), *args)
+    DfuPlan.create(filename, *args, lpl_0101=b"\x01" * 40, frames=plan_frames(), bytes_skipped=0)
+
+    assert DfuPlan.load(filename, 0x12345679, *args[1:]) is None
+    assert DfuPlan.load(filename, *(args[0:4] + (1024, True))) is None
+    assert DfuPlan.load(filename, *(args[0:5] + (False,))) is None
+    assert DfuPlan.load(str(tmp_path / "missing.dfuplan"), *args) is None
+
+
+def test_damaged_dfu_plan_is_not_loaded(tmp_path):
+    args = (0x12345678, 0x9abcdef0, 2088, 0x0103, 32, False)
+    filename = DfuPlan.path(str(tmp_path), *args)
+    DfuPlan.create(filename, *args, lpl_0101=b"\x01" * 40, frames=plan_frames(), bytes_skipped=0)
+
+    with open(filename, "r+b") as plan_file:
+        plan_file.seek(-1, os.SEEK_END)
+        plan_file.write(b"\x00")
+
+    assert DfuPlan.load(filename, *args) is None
+
+
+###################
+# Firmware Bundle #
+###################
+
+def test_bundle_round_trip(tmp_path, firmware_dir):
+    filename = str(tmp_path / "release.fwb")
+    FirmwareBundle.create(filename, str(firmware_dir))
+
+    assert FirmwareBundle.is_bundle(filename)
+    assert not FirmwareBundle.is_bundle(str(firmware_dir / "em200qdx_cmis_fw_v1.2.3.bin"))
+
+    bundle = FirmwareBundle.open(filename)
+    assert FirmwareBundle.open(filename) is bundle
+
+    for component, slot, name in (("MCU", "a", "em200qdx_module_fw_v0.52.7_a.bin"),
+                                  ("MCU", "b", "em200qdx_module_fw_v0.52.7_b.bin"),
+                                  ("MSA", None, "em200qdx_cmis_fw_v1.2.3.bin"),
+                                  ("DSP", None, "em200qdx_retimer_fw_v227.0.36.bin")):
+        member = bundle.find(component, slot)
+        assert member == os.path.join(bundle.filename, name)
+        assert FirmwareBundle.containing(member) is bundle
+        assert bundle.info(member)["version"] == (0, 52, 7)
+
+        image = bundle.image(member)
+        original = HeaderV1(str(firmware_dir / name), verbose=False)
+        original.load()
+        assert bytes(image.data()[0]) == bytes(original.data()[0])
+        assert image.get_crc() == original.get_crc()
+
+    assert bundle.find("MCU", None) is None
+    with pytest.raises(FirmwareUpgraderException):
+        bundle.image(os.path.join(bundle.filename, "missing.bin"))
+
+
+def test_corrupted_bundle_is_refused(tmp_path, firmware_dir):
+    filename = str(tmp_path / "release.fwb")
+    FirmwareBundle.create(filename, str(firmware_dir))
+
+    bundle = FirmwareBundle(filename)
+    entry = bundle.manifest["images"][-1]
+    del bundle
+
+    with open(filename, "r+b") as bundle_file:
+        bundle_file.seek(entry["offset"] + entry["size"] - 1)
+        bundle_file.write(b"\x00")
+    stat = os.stat(filename)
+    os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+
+    for _ in range(2):
+        with pytest.raises(FirmwareUpgraderException) as info:
+            FirmwareBundle.open(filename)
+        assert info.value.get_message().startswith("E004: Bundle image {}".format(entry["name"]))
+
+
+#################
+# State Section #
+#################
+
+def test_state_located_at_offset():
+    contents = bytearray(State.OFFSET + State.SECTION_SIZE)
+    contents[State.OFFSET:State.OFFSET + 7] = state_header()
+
+    assert State.locate(contents) == State.OFFSET
+
+
+def test_state_located_at_moved_offset():
+    contents = bytearray(8 * State.ALIGNMENT)
+    offset = 3 * State.ALIGNMENT
+    contents[offset:offset + 7] = state_header()
+    # The magic inside the code doesn't count
+    contents[100:107] = state_header()
+
+    assert State.locate(contents) == offset
+    assert State.locate(contents, start=offset) == len(contents)
+
+
+def test_state_not_located():
+    contents = bytearray(8 * State.ALIGNMENT)
+    # Unaligned, and a header with an impossible size
+    contents[0x1001:0x1008] = state_header()
+    contents[0x2000:0x2007] = state_header(size=2)
+
+    assert State.locate(contents) == len(contents)
+
+
+def test_state_offset_cached_by_key():
+    contents = bytearray(8 * State.ALIGNMENT)
+    contents[0x2000:0x2007] = state_header()
+    key = ("test_state_offset_cached_by_key", len(contents))
+
+    assert State.locate(contents, key=key) == 0x2000
+    assert State.locate(bytearray(8 * State.ALIGNMENT), key=key) == 0x2000
+
+
+###########
+# Upgrade #
+###########
+
+def new_upgrader(cls, module, logger):
+    upgrader = cls(FakeDriver(module), "MCU", logger=logger)
+    upgrader.chunk_size = 32
+    return upgrader
+
+
+def check_upgraded(module, firmware_dir):
+    assert module.images_done == [
+        (2, image_data(firmware_dir / "em200qdx_module_fw_v0.52.7_b.bin")),
+        (3, image_data(firmware_dir / "em200qdx_cmis_fw_v1.2.3.bin")),
+    ]
+    assert module.active == "B"
+    assert module.slots["B"] == (0, 52, 7)
+
+
+def run_async(upgrader, firmware_dir):
+    results = firmware_async.run_ports({1: upgrader}, str(firmware_dir), verify=True)
+    if isinstance(results[1], BaseException):
+        raise results[1]
+    return results[1]
+
+
+def run_sync(upgrader, firmware_dir):
+    return upgrader.upgrade_firmware(str(firmware_dir), verify=True)
+
+
+# Upgrader classes with how to run an upgrade through _run() and _run_async()
+RUNNERS = [
+    (FirmwareUpgrader, run_sync),
+    (firmware_async.AsyncFirmwareUpgrader, run_async),
+]
+
+
+@pytest.mark.usefixtures("fast_upgrader")
+@pytest.mark.parametrize("epl_pages", [0, 4])
+def test_upgrade(firmware_dir, logger, epl_pages):
+    module = FakeModule(epl_pages)
+    upgrader = new_upgrader(FirmwareUpgrader, module, logger)
+
+    run_sync(upgrader, firmware_dir)
+
+    check_upgraded(module, firmware_dir)
+
+
+@pytest.mark.usefixtures("fast_upgrader")
+@pytest.mark.parametrize("epl_pages", [0, 4])
+def test_upgrade_async(firmware_dir, logger, epl_pages):
+    module = FakeModule(epl_pages)
+    upgrader = new_upgrader(firmware_async.AsyncFirmwareUpgrader, module, logger)
+
+    run_async(upgrader, firmware_dir)
+
+    check_upgraded(module, firmware_dir)
+
+
+@pytest.mark.usefixtures("fast_upgrader")
+@pytest.mark.parametrize("cls, run", RUNNERS, ids=["run", "run_async"])
+@pytest.mark.parametrize("fail_count", [1, 2 * FirmwareUpgrader.chunk_retries])
+def test_upgrade_recovers_from_i2c_failures(firmware_dir, logger, cls, run, fail_count):
+    module = FakeModule()
+    upgrader = new_upgrader(cls, module, logger)
+    # A few NACKs in the middle of the transfer are retried frame by frame,
+    # a longer run of them fails the attempt and the next one resumes
+    module.fail_at = module.writes + 150
+    module.fail_count = fail_count
+
+    run(upgrader, firmware_dir)
+
+    check_upgraded(module, firmware_dir)
+    assert module.writes >= module.fail_at + fail_count
+    # The transfer was resumed, not erased and started over
+    assert module.commands.count(0x0101) == 2
+
+
+@pytest.mark.usefixtures("fast_upgrader")
+@pytest.mark.parametrize("cls, run", RUNNERS, ids=["run", "run_async"])
+def test_upgrade_fails_on_a_dead_bus(firmware_dir, logger, cls, run):
+    module = FakeModule()
+    upgrader = new_upgrader(cls, module, logger)
+    module.fail_next = 10 ** 6
+
+    with pytest.raises((FirmwareUpgraderException, IOError)):
+        run(upgrader, firmware_dir)
+
+    assert module.images_done == []
+
+
+@pytest.mark.usefixtures("fast_upgrader")
+def test_upgrade_from_bundle(tmp_path, firmware_dir, logger):
+    filename = str(tmp_path / "release.fwb")
+    FirmwareBundle.create(filename, str(firmware_dir))
+    module = FakeModule()
+    upgrader = new_upgrader(FirmwareUpgrader, module, logger)
+
+    upgrader.upgrade_firmware(filename, verify=True)
+
+    check_upgraded(module, firmware_dir)
+
+
+def test_upgrader_retries_transient_errors_only():
+    upgrader = FirmwareUpgrader.__new__(FirmwareUpgrader)
+
+    assert upgrader._transient_failure(IOError("NACK"))
+    assert not upgrader._transient_failure(TypeError("bad argument"))